@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+
+import yaml
+
+__doc__ = """Synthetic url_monitor configs of N testSets x M testElements"""
+
+
+def generate(testsets, elements, http_port, trapper_port, workdir,
+             workers=1, engine='thread', datatypes='string',
+             response_cache=False):
+    """
+    :param testsets: number of testSets, each polls /ts<N> on the stub
+    :param elements: testElements per testSet, reading value0..value<M-1>
+    :param http_port: port of the benchmarks.servers.StubHTTPServer
+    :param trapper_port: port of the benchmarks.servers.FakeTrapper
+    :param workdir: directory for the pidfile, log and caches
+    :param workers: `config: concurrency`
+    :param engine: `config: engine`
+    :param datatypes: datatype of every testElement, e.g. "counter,string"
+    :param response_cache: leave the conditional GET cache enabled
+    :return dict: the config
+    """
+    config = {
+        'pidfile': os.path.join(workdir, 'url_monitor.pid'),
+        'request_timeout': 30,
+        'request_verify_ssl': False,
+        'concurrency': workers,
+        'engine': engine,
+        'response_cache_size': 1000 if response_cache else 0,
+        'logging': {
+            'level': 'error',
+            'outputs': 'file',
+            'logfile': os.path.join(workdir, 'url_monitor.log'),
+            'logformat': '%(asctime)s - %(name)s - %(levelname)s - '
+                         '%(message)s',
+        },
+        'identity_providers': {
+            'benchmark': {'HTTPBasicAuth': {'username': 'benchmark',
+                                            'password': 'benchmark'}},
+        },
+        'skip_run_when': {
+            'environment': {'variable': 'URL_MONITOR_BENCHMARK_SKIP',
+                            'value': 'true'},
+        },
+        'zabbix': {
+            'host': 'benchmark.localdomain',
+            'server': '127.0.0.1:{0}'.format(trapper_port),
+            'send_timeout': 30,
+            'item_key_format': 'url_monitor[{datatype}, {metricname}, '
+                               '{uri}]',
+            'checksummary_key_format': 'url_monitor[EXECUTION_STATUS]',
+        },
+    }
+    test_sets = {}
+    for index in range(testsets):
+        test_sets['ts{0}'.format(index)] = {
+            'uri': 'http://127.0.0.1:{0}/ts{1}'.format(http_port, index),
+            'response_type': 'json',
+            'identity_provider': 'benchmark',
+            'ok_http_code': 'any',
+            'testElements': [{
+                'key': 'value{0}'.format(element),
+                'jsonvalue': './value{0}'.format(element),
+                'datatype': datatypes,
+                'metricname': 'value{0}'.format(element),
+            } for element in range(elements)],
+        }
+    return {'config': config, 'testSet': test_sets}
+
+
+def write(path, config):
+    with open(path, 'w') as config_file:
+        yaml.safe_dump(config, config_file, default_flow_style=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('output', help="path of the yaml file to write")
+    parser.add_argument('--testsets', '-n', type=int, default=100)
+    parser.add_argument('--elements', '-m', type=int, default=5)
+    parser.add_argument('--http-port', type=int, default=18080)
+    parser.add_argument('--trapper-port', type=int, default=10051)
+    parser.add_argument('--workdir', default='/tmp')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', default='thread')
+    args = parser.parse_args()
+    write(args.output, generate(args.testsets, args.elements, args.http_port,
+                                args.trapper_port, args.workdir,
+                                args.workers, args.engine))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import configgen
+from servers import FakeTrapper, StubHTTPServer
+
+__doc__ = """End to end throughput of `url_monitor check` against local
+stand-ins for the monitored APIs and the Zabbix trapper. Results are
+written as json so runs of different releases can be compared."""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs url_monitor from this checkout in a fresh interpreter, so the
+# wall time and peak RSS include start up like a cron run would.
+RUNNER = 'import sys; from url_monitor.main import main; main(sys.argv)'
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_once(config_path, trapper, python):
+    """
+    One `url_monitor check` run.
+
+    :return dict: measurements of the run
+    """
+    trapper.reset()
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    started = time.time()
+    process = subprocess.Popen(
+        [python, '-c', RUNNER, 'check', '-c', config_path],
+        cwd=ROOT, env=env,
+        stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.time() - started
+    process.returncode = os.WEXITSTATUS(status)  # reaped by wait4
+    stderr = process.stderr.read()
+
+    return {
+        'wall_seconds': round(wall, 4),
+        'exit_code': process.returncode,
+        'peak_rss_kb': usage.ru_maxrss,
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 4),
+        'sender_round_trips': trapper.stats['round_trips'],
+        'metrics': trapper.stats['values'],
+        'sent_bytes': trapper.stats['bytes'],
+        'stderr_tail': stderr[-2000:] if process.returncode else '',
+    }
+
+
+def summarize(runs, checks):
+    """
+    Median of every run, with throughput rates.
+    """
+    def median(values):
+        values = sorted(values)
+        middle = len(values) // 2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle]) / 2.0
+
+    wall = median([run['wall_seconds'] for run in runs])
+    metrics = median([run['metrics'] for run in runs])
+    return {
+        'wall_seconds': wall,
+        'checks_per_second': round(checks / wall, 2) if wall else None,
+        'metrics_per_second': round(metrics / wall, 2) if wall else None,
+        'peak_rss_kb': max(run['peak_rss_kb'] for run in runs),
+        'sender_round_trips': median(
+            [run['sender_round_trips'] for run in runs]),
+        'failed_runs': len([run for run in runs if run['exit_code']]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--testsets', '-n', type=int, default=100,
+                        help="testSets in the generated config")
+    parser.add_argument('--elements', '-m', type=int, default=5,
+                        help="testElements per testSet")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds the stub API waits before answering")
+    parser.add_argument('--payload-bytes', type=int, default=1024,
+                        help="size of each API response")
+    parser.add_argument('--status', default='200',
+                        help="comma separated HTTP statuses, testSet N gets "
+                        "the Nth (cycling)")
+    parser.add_argument('--workers', '-w', type=int, default=16)
+    parser.add_argument('--engine', '-e', default='thread',
+                        choices=['thread', 'async'])
+    parser.add_argument('--runs', '-r', type=int, default=3,
+                        help="repetitions, the summary is their median")
+    parser.add_argument('--response-cache', action='store_true',
+                        help="leave the conditional GET cache enabled")
+    parser.add_argument('--python', default=sys.executable,
+                        help="interpreter url_monitor runs under")
+    parser.add_argument('--output', '-o',
+                        help="write the results json here, default stdout")
+    args = parser.parse_args()
+
+    http = StubHTTPServer(latency=args.latency,
+                          payload_bytes=args.payload_bytes,
+                          elements=args.elements,
+                          statuses=[int(status) for status in
+                                    args.status.split(',')]).start()
+    trapper = FakeTrapper().start()
+    workdir = tempfile.mkdtemp(prefix='url_monitor-benchmark')
+    try:
+        config_path = os.path.join(workdir, 'url_monitor.yaml')
+        configgen.write(config_path, configgen.generate(
+            args.testsets, args.elements, http.port, trapper.port, workdir,
+            workers=args.workers, engine=args.engine,
+            response_cache=args.response_cache))
+
+        runs = []
+        for _ in range(args.runs):
+            runs.append(run_once(config_path, trapper, args.python))
+    finally:
+        http.stop()
+        trapper.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'benchmark': 'check',
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': {'python': platform.python_version(),
+                 'platform': platform.platform(),
+                 'cpus': os.sysconf('SC_NPROCESSORS_ONLN')},
+        'parameters': dict(vars(args), output=None),
+        'summary': summarize(runs, args.testsets),
+        'runs': runs,
+    }
+    rendered = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(rendered + '\n')
+    else:
+        print(rendered)
+    return 1 if results['summary']['failed_runs'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import json
+import SocketServer
+import struct
+import threading
+import time
+
+__doc__ = """Local stand-ins for the monitored APIs and the Zabbix trapper"""
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn,
+                          SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class _Server(object):
+    """
+    Runs a SocketServer on a background thread.
+    """
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+
+def payload(elements, size):
+    """
+    The json document served for every testSet: value0..value<elements-1>
+    plus a padding string bringing it to about size bytes.
+    """
+    document = dict(('value{0}'.format(i), i) for i in range(elements))
+    document['padding'] = ''
+    base = len(json.dumps(document))
+    document['padding'] = 'x' * max(size - base, 0)
+    return json.dumps(document)
+
+
+class StubHTTPServer(_Server):
+    """
+    Answers GET /ts<N> after latency seconds with the payload() document,
+    with the status statuses[N % len(statuses)]. Connections are kept
+    alive (HTTP/1.1) like a real API would.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 payload_bytes=1024, elements=1, statuses=(200,)):
+        body = payload(elements, payload_bytes)
+        statuses = tuple(statuses)
+        stats = self.stats = {'requests': 0}
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with lock:
+                    stats['requests'] += 1
+                if latency:
+                    time.sleep(latency)
+                try:
+                    index = int(self.path.strip('/').split('?')[0][2:])
+                except ValueError:
+                    index = 0
+                self.send_response(statuses[index % len(statuses)])
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+
+
+class FakeTrapper(_Server):
+    """
+    Speaks the trapper side of the ZBXD\\1 protocol used by
+    zbxsend.send_to_zabbix: reads one framed packet per connection,
+    answers success, and counts what it received.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        stats = self.stats = {'round_trips': 0, 'values': 0, 'bytes': 0}
+        lock = threading.Lock()
+
+        class Handler(SocketServer.BaseRequestHandler):
+            def read(self, size):
+                data = ''
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        raise EOFError
+                    data += chunk
+                return data
+
+            def handle(self):
+                try:
+                    header = self.read(13)
+                    if header[:5] != 'ZBXD\1':
+                        return
+                    length = struct.unpack('<Q', header[5:])[0]
+                    packet = json.loads(self.read(length))
+                except (EOFError, ValueError):
+                    return
+                values = len(packet.get('data', []))
+                with lock:
+                    stats['round_trips'] += 1
+                    stats['values'] += values
+                    stats['bytes'] += 13 + length
+                response = json.dumps({
+                    'response': 'success',
+                    'info': 'processed: {0}; failed: 0; total: {0}; '
+                            'seconds spent: 0.000001'.format(values)})
+                self.request.sendall(
+                    'ZBXD\1' + struct.pack('<Q', len(response)) + response)
+
+        self.server = _ThreadingTCPServer((host, port), Handler)
+
+    def reset(self):
+        for key in self.stats:
+            self.stats[key] = 0
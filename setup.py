@@ -51,5 +51,9 @@ if __name__ == "__main__":
             'oauthlib',
             'argparse',
             'facterpy'
-        ]
+        ],
+        extras_require={
+            'async': ['gevent'],
+            'stream': ['ijson'],
+        }
     )
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import copy
+import json
+import SocketServer
+import threading
+import time
+
+import pytest
+import yaml
+
+from url_monitor import configuration
+
+
+# A valid config, make_config() overrides parts of it per test
+CONFIG = {
+    'config': {
+        'pidfile': '/tmp/url_monitor.pid',
+        'request_timeout': 5,
+        'request_verify_ssl': False,
+        'identity_providers': {
+            'basic': {'HTTPBasicAuth': {'username': 'u', 'password': 'p'}},
+        },
+        'zabbix': {
+            'host': 'zabbix.localdomain',
+            'server': '127.0.0.1',
+            'item_key_format': 'url_monitor[{datatype}, {metricname}]',
+            'checksummary_key_format': 'url_monitor[EXECUTION_STATUS]',
+        },
+    },
+    'testSet': {
+        'health': {
+            'uri': 'http://localhost/health',
+            'identity_provider': 'none',
+            'response_type': 'json',
+            'ok_http_code': 200,
+            'testElements': [{'key': 'a', 'jsonvalue': './a',
+                              'datatype': 'integer', 'metricname': 'a'}],
+        },
+    },
+}
+
+
+def _testset(uri, identity_provider='basic', ok_http_code=200, **elements):
+    return {
+        'uri': uri,
+        'identity_provider': identity_provider,
+        'response_type': 'json',
+        'ok_http_code': ok_http_code,
+        'testElements': [{'key': key, 'jsonvalue': path,
+                          'datatype': 'integer', 'metricname': key}
+                         for key, path in sorted(elements.items())],
+    }
+
+
+@pytest.fixture
+def make_testset():
+    """
+    Builds a json testSet, call it with the uri, optionally the
+    identity_provider and ok_http_code, and an integer testElement per
+    keyword argument, e.g. success='./jobSuccess'.
+    """
+    return _testset
+
+
+def _merge(settings, overrides):
+    for name, value in overrides.items():
+        if value is None:
+            settings.pop(name, None)
+        elif isinstance(value, dict) and isinstance(settings.get(name), dict):
+            _merge(settings[name], value)
+        else:
+            settings[name] = value
+
+
+@pytest.fixture
+def make_config(tmpdir):
+    """
+    Writes CONFIG to tmpdir and loads it, call it with:
+
+        config: merged into the `config:` section, a None value removes
+                the setting
+        testSet: the testSets, replacing the default health one
+    """
+    def make(config=None, testSet=None):
+        document = copy.deepcopy(CONFIG)
+        document['config']['pidfile'] = str(tmpdir.join('url_monitor.pid'))
+        _merge(document['config'], config or {})
+        if testSet is not None:
+            document['testSet'] = testSet
+        path = tmpdir.join('url_monitor.yaml')
+        path.write(yaml.safe_dump(document, default_flow_style=False))
+        configinstance = configuration.ConfigObject()
+        configinstance.load_yaml_file(str(path))
+        return configinstance
+    return make
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        body = self.server.body
+        if not isinstance(body, bytes):
+            body = json.dumps(body)
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Answers every GET with status and body as json, or body itself when
+    it is bytes, counting the requests and the connections they came on.
+    """
+    daemon_threads = True  # sessions keep their connections open
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.requests = []  # paths
+        self.connections = 0
+        self.status = 200
+        self.body = {'jobSuccess': 5, 'jobFailure': 1}
+        self.delay = 0  # seconds before answering
+
+    def url(self, path='/status'):
+        return 'http://127.0.0.1:{0}{1}'.format(self.server_address[1], path)
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class Telemetry(object):
+    """
+    Stands in for zbxsend.BackgroundSender, keeps what each testSet sent.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, metrics):
+        self.metrics[name] = dict(
+            (metric.key, metric.value) for metric in metrics)
+
+
+@pytest.fixture
+def telemetry():
+    return Telemetry()
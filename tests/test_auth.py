@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import stat
+
+import pytest
+
+from url_monitor import commons
+
+
+logger = logging.getLogger(__name__)
+
+PROVIDER = '''
+import requests.auth
+
+logins = []
+
+
+class TokenAuth(requests.auth.AuthBase):
+    token_cache = None
+
+    def __init__(self, username, password):
+        self.username = username
+
+    def login(self):
+        token = self.token_cache.get()
+        if token is None:
+            logins.append(self.username)
+            token = 'token-{0}'.format(len(logins))
+            self.token_cache.set(token, 3600)
+        return token
+
+    def __call__(self, request):
+        request.headers['X-Auth-Token'] = self.login()
+        return request
+'''
+
+
+@pytest.fixture
+def provider(tmpdir, monkeypatch):
+    tmpdir.join('token_provider.py').write(PROVIDER)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(commons, 'auth_handlers', commons.AuthRegistry())
+    import token_provider
+    del token_provider.logins[:]
+    return token_provider
+
+
+@pytest.fixture
+def config(tmpdir, make_config):
+    """
+    The loaded config, call it with the username of the api provider.
+    """
+    def make(username='u'):
+        return make_config({
+            'token_cache_file': str(tmpdir.join('tokens')),
+            'identity_providers': {'api': {'token_provider/TokenAuth': {
+                'username': username, 'password': 's3cret'}}},
+        }).load()
+    return make
+
+
+def session_auth(config, identity_provider):
+    webcaller = commons.WebCaller(logger)
+    webcaller.auth(config, identity_provider)
+    return webcaller.session.auth
+
+
+def test_built_once(provider, config):
+    loaded = config()
+    assert session_auth(loaded, 'api') is session_auth(loaded, 'api')
+    assert session_auth(loaded, 'basic') is session_auth(loaded, 'basic')
+
+
+def test_rebuilt_when_changed(provider, config):
+    handler = session_auth(config(), 'api')
+    assert session_auth(config('v'), 'api') is not handler
+
+
+def test_none_provider(provider, config):
+    assert session_auth(config(), 'none') is None
+    assert session_auth(config(), 'None') is None
+
+
+def test_token_reused_between_runs(tmpdir, provider, config, monkeypatch):
+    loaded = config()
+    assert session_auth(loaded, 'api').login() == 'token-1'
+    assert session_auth(loaded, 'api').login() == 'token-1'
+
+    # a new run, with nothing in memory
+    monkeypatch.setattr(commons, 'auth_handlers', commons.AuthRegistry())
+    assert session_auth(loaded, 'api').login() == 'token-1'
+    assert provider.logins == ['u']
+    mode = os.stat(str(tmpdir.join('tokens'))).st_mode
+    assert stat.S_IMODE(mode) == 0o600
+    assert 'token-1' in tmpdir.join('tokens').read()
+    assert 's3cret' not in tmpdir.join('tokens').read()
+
+
+def test_token_dropped_with_credentials(provider, config):
+    session_auth(config(), 'api').login()
+    session_auth(config('v'), 'api').login()
+    assert provider.logins == ['u', 'v']
+
+
+def test_expired_token(monkeypatch):
+    cache = commons.TokenCache()
+    cache.put('api', 'token', 60)
+    assert cache.get('api') == 'token'
+    now = commons.time.time()
+    monkeypatch.setattr(commons.time, 'time', lambda: now + 61)
+    assert cache.get('api') is None
+
+
+def test_readable_cache_ignored(tmpdir):
+    path = tmpdir.join('tokens')
+    path.write('{"api": [9999999999, "token"]}')
+    path.chmod(0o644)
+    assert commons.TokenCache(str(path), logger).get('api') is None
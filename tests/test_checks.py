@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from url_monitor import action
+from url_monitor import commons
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def configinstance(server, make_config, make_testset):
+    return make_config(testSet=dict(
+        ('check{0}'.format(index),
+         make_testset(server.url('/{0}'.format(index)),
+                      success='./jobSuccess'))
+        for index in range(4)))
+
+
+def run_checks_within(seconds, *args, **kwargs):
+    """
+    run_checks on another thread, None if it hasn't returned in seconds.
+    """
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        action.run_checks(*args, **kwargs)))
+    thread.daemon = True
+    thread.start()
+    thread.join(seconds)
+    return results[0] if results else None
+
+
+def test_thread_pool(configinstance, telemetry):
+    checks = list(configinstance.load()['checks'])
+    results = run_checks_within(10, checks, configinstance, logger,
+                                workers=2, telemetry=telemetry)
+    assert sorted((key, rc) for rc, key, _ in results) == [
+        ('check{0}'.format(index), 0) for index in range(4)]
+    assert telemetry.metrics['check3'] == {'url_monitor[integer, success]': 5}
+
+
+def test_exiting_check_does_not_hang_pool(configinstance, telemetry,
+                                          monkeypatch):
+    check = action.check
+
+    def exiting_check(testSet, *args, **kwargs):
+        if testSet['key'] == 'check1':
+            sys.exit(1)
+        return check(testSet, *args, **kwargs)
+    monkeypatch.setattr(action, 'check', exiting_check)
+
+    checks = list(configinstance.load()['checks'])
+    results = run_checks_within(10, checks, configinstance, logger,
+                                workers=2, telemetry=telemetry)
+    assert results is not None, "run_checks hung on a worker exiting"
+    assert sorted(key for rc, key, _ in results) == [
+        'check0', 'check2', 'check3']
+
+
+# Runs on the async engine in a child process, gevent's monkey patching
+# would otherwise carry over to every later test
+ASYNC_RUN = """
+import json, logging, sys, time
+from url_monitor import engine
+assert engine.requested_engine(['check', '-c', sys.argv[1]]) == 'async'
+assert engine.patch('async')  # as main does, before anything else
+import gevent
+from url_monitor import action, commons, configuration
+
+configinstance = configuration.ConfigObject()
+configinstance.load_yaml_file(sys.argv[1])
+logger = logging.getLogger()
+
+logins = []
+auth_handler = commons.WebCaller.auth_handler
+def login(self, config, identity_provider):
+    logins.append(identity_provider)
+    gevent.sleep(0.1)  # a login waits on the network, other checks run
+    return auth_handler(self, config, identity_provider)
+commons.WebCaller.auth_handler = login
+
+class Telemetry(object):
+    metrics = {}
+    def add(self, name, metrics):
+        self.metrics[name] = dict((m.key, m.value) for m in metrics)
+telemetry = Telemetry()
+
+started = time.time()
+results = action.run_checks(
+    list(configinstance.load()['checks']), configinstance, logger,
+    workers=4, engine='async', sessions=commons.SessionRegistry(logger),
+    telemetry=telemetry)
+json.dump({'seconds': time.time() - started,
+           'results': sorted((key, rc) for rc, key, _ in results),
+           'logins': logins,
+           'metrics': telemetry.metrics}, sys.stdout)
+"""
+
+
+def test_async_engine(configinstance, make_config, server, tmpdir):
+    pytest.importorskip('gevent')
+    server.delay = 0.5
+    make_config(
+        {'engine': 'async',
+         'zabbix': {'timing_key_format': 'timing[{checkname}, {phase}]'}},
+        configinstance.config['testSet'])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(action.__file__))] + sys.path))
+    output = subprocess.check_output(
+        [sys.executable, '-c', ASYNC_RUN,
+         str(tmpdir.join('url_monitor.yaml'))], env=env)
+    run = json.loads(output)
+
+    assert run['results'] == [
+        ['check{0}'.format(index), 0] for index in range(4)]
+    # Greenlets waited on the first login instead of each logging in
+    assert run['logins'] == ['basic']
+    # Concurrent, the requests alone take 2 seconds one after another
+    assert run['seconds'] < 1.5
+    for index in range(4):
+        metrics = run['metrics']['check{0}'.format(index)]
+        assert metrics['url_monitor[integer, success]'] == 5
+        # Each check timed on its own, not with the other greenlets
+        assert 0.5 <= metrics['timing[check{0}, total]'.format(index)] < 1.0
+
+
+# Streaming stops at jobSuccess, well before the end of this body
+LARGE_BODY = {'jobSuccess': 5, 'padding': ['x' * 100] * 10000}
+
+
+@pytest.mark.parametrize('response_type, body, connections', [
+    ('json', LARGE_BODY, 3),
+    # Little left after jobSuccess, read to keep the connection
+    ('json-stream', {'jobSuccess': 5, 'padding': 'x' * 1000}, 3),
+    # Too much left to read, each check closes its connection
+    ('json-stream', LARGE_BODY, 6),
+])
+def test_sessions_reused(server, make_config, make_testset, telemetry,
+                         response_type, body, connections):
+    server.body = body
+    testSets = {}
+    for index in range(6):
+        testSet = make_testset(server.url('/{0}'.format(index)),
+                               identity_provider='basic' if index < 4
+                               else 'none', success='./jobSuccess')
+        testSet['response_type'] = response_type
+        testSet['request_verify_ssl'] = index not in (2, 3)
+        testSets['check{0}'.format(index)] = testSet
+    configinstance = make_config(testSet=testSets)
+    sessions = commons.SessionRegistry(logger)
+
+    checks = list(configinstance.load()['checks'])
+    results = action.run_checks(checks, configinstance, logger,
+                                sessions=sessions, telemetry=telemetry)
+    assert sorted(rc for rc, key, _ in results) == [0] * 6
+    assert sorted(sessions.sessions) == [
+        ('basic', False), ('basic', True), ('none', True)]
+    # Two checks per session, one after another on the same connection
+    # unless it was closed
+    assert len(server.requests) == 6
+    assert server.connections == connections
+    sessions.close()
+
+
+def test_streamed_body_not_read_to_the_end(server, make_config,
+                                           make_testset, telemetry):
+    server.body = LARGE_BODY
+    testSet = make_testset(server.url(), success='./jobSuccess')
+    testSet['response_type'] = 'json-stream'
+    configinstance = make_config(testSet={'large': testSet})
+    stats = action.RunStats()
+
+    rc, check = action.check(configinstance.load()['checks'][0],
+                             configinstance, logger, telemetry=telemetry,
+                             stats=stats)
+    assert telemetry.metrics['large']['url_monitor[integer, success]'] == 5
+    assert stats.take()['bytes_downloaded'] < len(json.dumps(LARGE_BODY)) / 2
+
+
+def test_not_modified_without_response_cache(server, make_config,
+                                             make_testset, telemetry):
+    server.status = 304
+    server.body = b''
+    configinstance = make_config(testSet={'jobs': make_testset(
+        server.url(), ok_http_code='any', success='./jobSuccess')})
+
+    rc, check = action.check(configinstance.load()['checks'][0],
+                             configinstance, logger, telemetry=telemetry)
+    # Checked like any other status without a body, nothing to report
+    assert (rc, check['request_statuscode']) == (1, 304)
+    assert telemetry.metrics['jobs'] == {
+        'url_monitor[integer, success]': None}
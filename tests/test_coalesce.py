@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pytest
+
+from url_monitor import action
+from url_monitor import commons
+
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def configinstance(server, make_config, make_testset):
+    return make_config(testSet={
+        'jobs': make_testset(server.url(), success='./jobSuccess'),
+        'failures': make_testset(server.url(), failure='./jobFailure'),
+        'strict': make_testset(server.url(), ok_http_code=201,
+                               strict='./jobSuccess'),
+        'anonymous': make_testset(server.url(), 'none',
+                                  anonymous='./jobSuccess'),
+    })
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_one_fetch_per_group(server, configinstance, telemetry, workers):
+    checks = list(configinstance.load()['checks'])
+    fetches = action.coalescefacade(configinstance, checks, logger)
+    results = action.run_checks(checks, configinstance, logger,
+                                workers=workers, telemetry=telemetry,
+                                fetches=fetches)
+
+    # basic is fetched once for three testSets, none on its own
+    assert len(server.requests) == 2
+    assert fetches.saved == 2
+    assert fetches.fetches == {}
+    assert dict((key, rc) for rc, key, _ in results) == {
+        'jobs': 0, 'failures': 0, 'strict': 1, 'anonymous': 0}
+    assert telemetry.metrics['jobs'] == {'url_monitor[integer, success]': 5}
+    assert telemetry.metrics['failures'] == {
+        'url_monitor[integer, failure]': 1}
+
+
+class Responses(object):
+    """
+    Stands in for httpcache.ResponseCache, keeps the keys stored.
+    """
+
+    def __init__(self):
+        self.stored = []
+
+    def headers(self, key, uri, paths):
+        return {}
+
+    def store(self, key, uri, response, values):
+        self.stored.append(key)
+
+
+def test_shared_responses_not_cached(configinstance, telemetry):
+    checks = list(configinstance.load()['checks'])
+    responses = Responses()
+    action.run_checks(checks, configinstance, logger, telemetry=telemetry,
+                      responses=responses,
+                      fetches=action.coalescefacade(configinstance, checks,
+                                                    logger))
+    assert responses.stored == ['anonymous']
+
+
+def test_disabled(make_config):
+    configinstance = make_config({'coalesce_requests': False})
+    checks = list(configinstance.load()['checks'])
+    assert action.coalescefacade(configinstance, checks, logger) is None
+
+
+def test_failed_fetch_shared():
+    calls = []
+    fetches = commons.FetchGroups({'group': 2})
+
+    def fetch():
+        calls.append(1)
+        raise IOError("connection refused")
+    with pytest.raises(IOError):
+        fetches.fetch('group', fetch)
+    assert fetches.fetch('group', fetch) is None
+    assert calls == [1]
+    assert fetches.fetches == {}
+
+
+def test_single_testset_not_shared():
+    fetches = commons.FetchGroups({'group': 1, 'other': 3})
+    assert not fetches.shared('group')
+    assert fetches.shared('other')
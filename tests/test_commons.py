@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import io
+import logging
+
+import pytest
+
+parametrize = pytest.mark.parametrize
+
+from url_monitor import action
+from url_monitor import commons
+
+
+logger = logging.getLogger(__name__)
+
+ELEMENTS = {
+    'json': [{'jsonvalue': './status'}, {'jsonvalue': './jobs[1]'},
+             {'jsonvalue': './missing'}],
+    'json-stream': [{'jsonvalue': './status'}, {'jsonvalue': './jobs[1]'},
+                    {'jsonvalue': './missing'}],
+    'xml': [{'xpath': './status'}, {'xpath': './jobs/job[2]'},
+            {'xpath': './missing'}],
+}
+BODIES = {
+    'json': b'{"status": "ok", "jobs": [1, 2, 3]}',
+    'json-stream': b'{"status": "ok", "jobs": [1, 2, 3]}',
+    'xml': b'<api><status>ok</status><jobs><job>1</job><job>2</job></jobs>'
+           b'</api>',
+}
+
+
+class CountingReader(io.BytesIO):
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.consumed = 0
+
+    def read(self, *args):
+        data = io.BytesIO.read(self, *args)
+        self.consumed += len(data)
+        return data
+
+
+@parametrize('type', ['json', 'json-stream', 'xml'])
+def test_document_shared_by_paths(type, monkeypatch):
+    decoded = []
+
+    def counting(decode):
+        def counting_decode(*args, **kwargs):
+            decoded.append(args)
+            return decode(*args, **kwargs)
+        return counting_decode
+    monkeypatch.setattr(commons.json, 'loads', counting(commons.json.loads))
+    for name in ('jpath', 'jpath_stream', 'xpath', 'xpath_stream'):
+        monkeypatch.setattr(commons, name, counting(getattr(commons, name)))
+
+    if type == 'json':
+        body = BODIES[type]
+    else:
+        body = CountingReader(BODIES[type])
+    document = commons.load_document(body, type, ELEMENTS[type])
+    values = [commons.omnipath(document, type, element, parsed=True)
+              for element in ELEMENTS[type]]
+    assert [None if value is None else str(value) for value in values] == [
+        'ok', '2', None]
+    assert len(decoded) == 1  # one decode answers every path
+    if type != 'json':
+        # ./missing is never found, the single pass reads to the end once
+        assert body.consumed == len(BODIES[type])
+
+
+def test_json_decoded_once(monkeypatch):
+    loads = commons.json.loads
+    decoded = []
+
+    def counting_loads(*args, **kwargs):
+        decoded.append(args)
+        return loads(*args, **kwargs)
+    monkeypatch.setattr(commons.json, 'loads', counting_loads)
+    document = commons.load_document(BODIES['json'], 'json')
+    for element in ELEMENTS['json']:
+        commons.omnipath(document, 'json', element, parsed=True)
+    assert len(decoded) == 1
+
+
+@pytest.fixture
+def checked(server, make_config, make_testset, telemetry, monkeypatch):
+    """
+    Runs a json check of three testElements against server, returns the
+    bodies load_document decoded.
+    """
+    decoded = []
+    load_document = commons.load_document
+
+    def counting_load_document(data, *args, **kwargs):
+        decoded.append(data)
+        return load_document(data, *args, **kwargs)
+    monkeypatch.setattr(commons, 'load_document', counting_load_document)
+
+    def check():
+        configinstance = make_config(testSet={'jobs': make_testset(
+            server.url(), identity_provider='none', success='./jobSuccess',
+            failure='./jobFailure', missing='./jobMissing')})
+        testSet = configinstance.load()['checks'][0]
+        action.check(testSet, configinstance, logger, telemetry=telemetry)
+        return decoded
+    return check
+
+
+def test_check_decodes_once(checked, telemetry):
+    assert len(checked()) == 1
+    metrics = telemetry.metrics['jobs']
+    assert metrics['url_monitor[integer, success]'] == 5
+    assert metrics['url_monitor[integer, failure]'] == 1
+
+
+def test_malformed_body_reported_once(checked, server, caplog):
+    server.body = b'{"jobSuccess": 5, '
+    assert len(checked()) == 1
+    errors = [record for record in caplog.records
+              if record.getMessage().startswith('Could not decode')]
+    assert len(errors) == 1
+
+
+class TestAtomicWrite(object):
+    def test_replaces_file(self, tmpdir):
+        path = tmpdir.join('cache.json')
+        path.write('old')
+        path.chmod(0o644)
+        commons.atomic_write(str(path), b'new')
+        assert path.read() == 'new'
+        assert path.stat().mode & 0o777 == 0o600
+        assert tmpdir.listdir() == [path]
+
+    def test_mode(self, tmpdir):
+        path = tmpdir.join('cache.json')
+        commons.atomic_write(str(path), b'{}', mode=0o640)
+        assert path.stat().mode & 0o777 == 0o640
+
+    def test_cleans_up_on_error(self, tmpdir):
+        path = tmpdir.mkdir('cache.json')  # can't be renamed over
+        with pytest.raises(OSError):
+            commons.atomic_write(str(path), b'{}')
+        assert tmpdir.listdir() == [path]
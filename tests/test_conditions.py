@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from url_monitor import commons
+
+
+logger = logging.getLogger(__name__)
+
+
+def script(tmpdir, name, body):
+    path = tmpdir.join(name)
+    path.write('#!/bin/sh\n' + body)
+    path.chmod(0o755)
+    return str(path)
+
+
+class TestConditionCache(object):
+    def test_reused_until_expired(self, monkeypatch):
+        calls = []
+        cache = commons.ConditionCache()
+        observe = lambda: calls.append(1) or len(calls)
+        assert cache.observe('key', 60, observe) == 1
+        assert cache.observe('key', 60, observe) == 1
+        now = commons.time.time()
+        monkeypatch.setattr(commons.time, 'time', lambda: now + 61)
+        assert cache.observe('key', 60, observe) == 2
+
+    def test_no_ttl_not_cached(self):
+        calls = []
+        cache = commons.ConditionCache()
+        observe = lambda: calls.append(1) or len(calls)
+        assert cache.observe('key', 0, observe) == 1
+        assert cache.observe('key', 0, observe) == 2
+
+    def test_shared_between_runs(self, tmpdir):
+        path = str(tmpdir.join('skip'))
+        cache = commons.ConditionCache(path, logger)
+        cache.observe('key', 60, lambda: [1, 'standby'])
+        cache.save()
+
+        def observe():
+            raise AssertionError("observed again")
+        assert commons.ConditionCache(path).observe('key', 60, observe) == \
+            [1, 'standby']
+
+
+class TestSkipConditions(object):
+    def test_shell_cached(self, tmpdir):
+        ran = tmpdir.join('ran')
+        path = script(tmpdir, 'ha_status.sh',
+                      'echo x >> {0}\necho standby\n'.format(ran))
+        cache = commons.ConditionCache()
+        for _ in range(3):
+            assert commons.skip_on_external_condition(
+                logger, 'shell', (path, 'standby', 1, 60), cache)
+        assert len(ran.readlines()) == 1
+
+    def test_facter_asks_for_one_fact(self, tmpdir):
+        args = tmpdir.join('args')
+        path = script(tmpdir, 'facter',
+                      'echo "$@" > {0}\necho "ha_state: slave"\n'.format(args))
+        assert commons.skip_on_external_condition(
+            logger, 'facter', (path, 'ha_state', 'slave', 0))
+        assert args.read().split() == ['--puppet', '--yaml', 'ha_state']
+
+    def test_parsed_once(self, make_config):
+        configinstance = make_config({'skip_run_when': {
+            'shell': {'script': '/opt/ha_status.sh', 'stdout': 'standby',
+                      'cache_ttl': '5m'},
+            'environment': {'variable': 'HA_STATE', 'value': 'standby'},
+        }})
+        conditions = configinstance.skip_conditions
+        assert conditions == [
+            {'shell': ('/opt/ha_status.sh', 'standby', 0, 300.0)},
+            {'env': ('HA_STATE', 'standby')},
+        ]
+        assert configinstance.skip_conditions is conditions
+
+    def test_none_defined(self, make_config):
+        assert make_config().skip_conditions == []
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+import yaml
+
+from url_monitor import configuration
+
+
+CONFIG = '''
+config:
+  pidfile: "/tmp/url_monitor.pid"
+testSet:
+  health:
+    uri: "http://localhost/health"
+'''
+
+
+def load(path):
+    return configuration.ConfigObject().load_yaml_file(str(path))
+
+
+class TestSnapshot(object):
+    def test_snapshot_next_to_yaml(self, tmpdir):
+        path = tmpdir.join('url_monitor.yaml')
+        path.write(CONFIG)
+        config = load(path)
+        assert config['testSet']['health']['uri'] == 'http://localhost/health'
+        assert tmpdir.join('.url_monitor.yaml.snapshot').check()
+
+    def test_unchanged_yaml_not_parsed(self, tmpdir, monkeypatch):
+        path = tmpdir.join('url_monitor.yaml')
+        path.write(CONFIG)
+        config = load(path)
+
+        def parse(*args, **kwargs):
+            raise AssertionError("yaml parsed again")
+        monkeypatch.setattr(yaml, 'load', parse)
+        assert load(path) == config
+
+    def test_changed_yaml_parsed(self, tmpdir):
+        path = tmpdir.join('url_monitor.yaml')
+        path.write(CONFIG)
+        load(path)
+        path.write(CONFIG.replace('/health', '/status'))
+        os.utime(str(path), (0, 0))
+        config = load(path)
+        assert config['testSet']['health']['uri'] == 'http://localhost/status'
+
+    def test_foreign_snapshot_ignored(self, tmpdir, monkeypatch):
+        path = tmpdir.join('url_monitor.yaml')
+        path.write(CONFIG)
+        load(path)
+        snapshot = tmpdir.join('.url_monitor.yaml.snapshot')
+        snapshot.chmod(0o666)  # writable by anyone, can't be trusted
+
+        parsed = []
+        yaml_load = yaml.load
+
+        def parse(*args, **kwargs):
+            parsed.append(args)
+            return yaml_load(*args, **kwargs)
+        monkeypatch.setattr(yaml, 'load', parse)
+        load(path)
+        assert parsed
+
+
+class TestYamlLoader(object):
+    @pytest.mark.parametrize('value', [
+        '!!python/tuple [200, 201]',
+        '!!python/name:os.getcwd',
+        '!!python/object/apply:os.getcwd []',
+        '!!python/object:url_monitor.configuration.ConfigObject {}',
+    ])
+    def test_python_tags_rejected(self, tmpdir, capsys, value):
+        path = tmpdir.join('url_monitor.yaml')
+        path.write(CONFIG + '    ok_http_code: {0}\n'.format(value))
+        with pytest.raises(SystemExit):
+            load(path)
+        out, err = capsys.readouterr()
+        assert 'YAML Parse Error' in out
+        assert 'python/' in out
+        assert not tmpdir.join('.url_monitor.yaml.snapshot').check()
+
+
+TESTSETS = {
+    'health': {
+        'uri': 'http://localhost/health',
+        'identity_provider': 'basic',
+        'response_type': 'json',
+        'ok_http_code': 200,
+        'request_timeout': 5,
+        'request_verify_ssl': False,
+        'testElements': [{'key': 'a', 'jsonvalue': './a',
+                          'datatype': 'string,integer', 'metricname': 'a'}],
+    },
+    'status': {
+        'uri': 'http://localhost/status',
+        'identity_provider': 'basic',
+        'response_type': 'xml',
+        'ok_http_code': 200,
+        'testElements': [{'key': 'b', 'xpath': './b', 'datatype': 'string',
+                          'metricname': 'b'}],
+    },
+    'broken': {
+        'uri': 'http://localhost/broken',
+        'identity_provider': 'undeclared',
+        'response_type': 'yaml',
+        'testElements': [
+            {'key': 'c', 'jsonvalue': './c'},
+            {'key': 'd', 'jsonvalue': './d[x]', 'datatype': 'string',
+             'metricname': 'd'},
+        ],
+    },
+}
+
+
+@pytest.fixture
+def indexed(make_config):
+    """
+    The config of the index and validation tests, call it with overrides
+    of its `config:` section.
+    """
+    def make(config=None):
+        settings = {'request_timeout': 30, 'request_verify_ssl': True}
+        settings.update(config or {})
+        return make_config(settings, TESTSETS)
+    return make
+
+
+class TestIndex(object):
+    def test_by_key(self, indexed):
+        configinstance = indexed()
+        assert configinstance.get_test_set_by_key('status')['data']['uri'] \
+            == 'http://localhost/status'
+        assert configinstance.get_test_set_by_key('missing') is None
+
+    def test_by_provider(self, indexed):
+        configinstance = indexed()
+        checks = configinstance._load_checks(withIdentityProvider='BASIC')
+        assert sorted(testSet['key'] for testSet in checks) == [
+            'health', 'status']
+
+    def test_by_datatype(self, indexed):
+        configinstance = indexed()
+        assert sorted(element['key'] for testSet, element in
+                      configinstance.get_elements_by_datatype('string')) == [
+            'a', 'b']
+        assert [element['key'] for testSet, element in
+                configinstance.get_elements_by_datatype('integer')] == ['a']
+
+    def test_settings(self, indexed):
+        configinstance = indexed()
+        health = configinstance.get_test_set_by_key('health')
+        status = configinstance.get_test_set_by_key('status')
+        assert configinstance.get_request_timeout(health) == 5
+        assert configinstance.get_request_timeout(status) == 30
+        assert configinstance.get_verify_ssl(health) is False
+        assert configinstance.get_verify_ssl(status) is True
+
+    def test_load_is_built_once(self, indexed):
+        configinstance = indexed()
+        assert configinstance.load() is configinstance.load()
+
+
+class TestValidation(object):
+    def test_broken_test_set_skipped(self, indexed):
+        configinstance = indexed()
+        assert sorted(testSet['key'] for testSet in
+                      configinstance.load()['checks']) == ['health', 'status']
+        assert configinstance.get_test_set_by_key('broken') is None
+
+    def test_every_error_reported(self, indexed):
+        errors = indexed().get_invalid_test_sets()['broken']
+        assert errors == [
+            "missing `ok_http_code`",
+            "identity_provider `undeclared` is not declared in "
+            "`config: identity_providers`",
+            "unsupported response_type `yaml`, use one of json, "
+            "json-stream, xml",
+            "testElements[0] missing `datatype`",
+            "testElements[0] has no 'metricname' for `item_key_format`",
+        ]
+
+    def test_invalid_path(self, indexed):
+        configinstance = indexed()
+        testSet = {'key': 'paths', 'data': {
+            'uri': 'http://localhost/', 'identity_provider': 'none',
+            'ok_http_code': 200, 'response_type': 'json',
+            'testElements': [{'key': 'd', 'jsonvalue': './d[x]',
+                              'datatype': 'string', 'metricname': 'd'}]}}
+        errors = configinstance._validate_test_set(testSet)
+        assert len(errors) == 1
+        assert errors[0].startswith('testElements[0] invalid jsonvalue: ')
+
+    @pytest.mark.parametrize('timeout, error', [
+        (None, "missing `request_timeout`, set it on the testSet or in "
+               "`config:`"),
+        (-1, "`request_timeout` must be a positive number of seconds, "
+             "not -1"),
+        ('soon', "`request_timeout` must be a positive number of seconds, "
+                 "not 'soon'"),
+    ])
+    def test_request_timeout(self, indexed, timeout, error):
+        invalid = indexed({'request_timeout': timeout}).get_invalid_test_sets()
+        # health sets its own
+        assert sorted(invalid) == ['broken', 'status']
+        assert error in invalid['status']
+
+    def test_test_set_request_timeout(self, indexed):
+        configinstance = indexed()
+        testSet = configinstance.get_test_set_by_key('health')
+        data = dict(testSet['data'], request_timeout=0)
+        assert configinstance._validate_test_set(
+            {'key': 'health', 'data': data}) == [
+            "`request_timeout` must be a positive number of seconds, not 0"]
+
+    def test_fractional_request_timeout(self, indexed):
+        configinstance = indexed({'request_timeout': 0.5})
+        status = configinstance.get_test_set_by_key('status')
+        assert configinstance.get_request_timeout(status) == 0.5
+
+    @pytest.mark.parametrize('key_format, error', [
+        ('url_monitor[{0}]', "tuple index out of range"),
+        ('url_monitor[{metricname!z}]', "Unknown conversion specifier z"),
+    ])
+    def test_bad_item_key_format(self, indexed, key_format, error):
+        invalid = indexed({'zabbix': {'item_key_format': key_format}}) \
+            .get_invalid_test_sets()
+        assert sorted(invalid) == ['broken', 'health', 'status']
+        assert invalid['status'] == [
+            "testElements[0] can't be formatted with `item_key_format`: "
+            "{0}".format(error)]
+
+    def test_config_errors(self, tmpdir):
+        path = tmpdir.join('url_monitor.yaml')
+        path.write('config:\n  zabbix: {host: h}\n')
+        configinstance = configuration.ConfigObject()
+        configinstance.load_yaml_file(str(path))
+        assert configinstance._validate_config() == [
+            "`pidfile` not defined in yaml config",
+            "missing `config: zabbix: server:`",
+            "missing `config: zabbix: item_key_format:`",
+            "missing `config: zabbix: checksummary_key_format:`",
+            "missing `config: identity_providers:` structure",
+            "missing `testSet:` structure",
+        ]
+
+    def test_timing_key_format(self, indexed):
+        configinstance = indexed({'zabbix': {
+            'timing_key_format': 'timing[{checkname}, {step}]'}})
+        assert configinstance._validate_config() == [
+            "`config: zabbix: timing_key_format:` can only use {phase}, "
+            "{checkname}, {uri}, {originhost}: KeyError('step',)"]
+
+    def test_shard(self, indexed):
+        configinstance = indexed({'shard': '3/2'})
+        assert configinstance._validate_config() == [
+            "`config: shard:` shard 3/2 is out of range, use 1/2 to 2/2"]
+        assert str(configinstance.get_shard('2/2')) == '2/2'
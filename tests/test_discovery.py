@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import copy
+import logging
+
+from url_monitor import action
+from url_monitor import sharding
+
+
+TESTSET = {'health': {
+    'uri': 'http://localhost/health',
+    'identity_provider': 'none',
+    'response_type': 'json',
+    'ok_http_code': 200,
+    'testElements': [
+        {'key': 'a', 'jsonvalue': './a', 'datatype': 'string,integer',
+         'metricname': 'a'},
+        {'key': 'b', 'jsonvalue': './b', 'datatype': 'counter',
+         'metricname': 'b'},
+    ],
+}}
+
+
+def test_discovery_items(make_config):
+    configinstance = make_config(testSet=TESTSET)
+    assert action.discovery_items(configinstance, 'integer') == [{
+        '{#KEY}': 'a',
+        '{#JSONVALUE}': './a',
+        '{#DATATYPE}': 'string,integer',
+        '{#METRICNAME}': 'a',
+        '{#CHECKNAME}': 'health',
+        '{#RESOURCE_URI}': 'http://localhost/health',
+    }]
+    assert action.discovery_items(configinstance, 'missing') == []
+
+
+def test_discovery_leaves_config_alone(make_config):
+    configinstance = make_config(testSet=TESTSET)
+    checks = copy.deepcopy(configinstance.load()['checks'])
+    action.discovery_items(configinstance, 'string')
+    assert configinstance.load()['checks'] == checks
+
+
+def test_cache_per_config_version(make_config):
+    configinstance = make_config(testSet=TESTSET)
+    logger = logging.getLogger(__name__)
+    assert action.cached_discovery(configinstance, 'string') is None
+    assert action.cache_discovery(configinstance, 'string', 'S', logger)
+    assert action.cache_discovery(configinstance, 'counter', 'C', logger)
+    assert action.cached_discovery(configinstance, 'string') == 'S'
+    assert action.cached_discovery(configinstance, 'counter') == 'C'
+
+    configinstance.version = 'changed'
+    assert action.cached_discovery(configinstance, 'string') is None
+
+
+def test_discovery_per_shard(make_config):
+    configinstance = make_config(testSet=TESTSET)
+    shards = [sharding.Shard(index, 2) for index in (1, 2)]
+    owner, other = sorted(shards, key=lambda shard: not shard.owns('health'))
+    assert len(action.discovery_items(configinstance, 'counter', owner)) == 1
+    assert action.discovery_items(configinstance, 'counter', other) == []
+
+    logger = logging.getLogger(__name__)
+    assert action.cache_discovery(configinstance, 'counter', 'C1', logger,
+                                  owner)
+    assert action.cached_discovery(configinstance, 'counter', owner) == 'C1'
+    assert action.cached_discovery(configinstance, 'counter', other) is None
+    assert action.cached_discovery(configinstance, 'counter') is None
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+parametrize = pytest.mark.parametrize
+
+from url_monitor import engine
+
+
+@pytest.fixture
+def config_path(make_config, tmpdir):
+    make_config({'engine': 'async'})
+    return str(tmpdir.join('url_monitor.yaml'))
+
+
+@parametrize('arguments, expected', [
+    (['check', '--engine', 'thread'], 'thread'),
+    (['check', '-e', 'async', '-k', 'health'], 'async'),
+    (['check', '--config'], None),  # left for main() to report
+    (['check', '-c', '/nonexistent/url_monitor.yaml'], None),
+])
+def test_requested_engine(arguments, expected):
+    assert engine.requested_engine(arguments) == expected
+
+
+def test_engine_from_config(config_path):
+    assert engine.requested_engine(['check', '-c', config_path]) == 'async'
+    # The flag wins over the config
+    assert engine.requested_engine(
+        ['check', '-c', config_path, '-e', 'thread']) == 'thread'
+
+
+def test_broken_config(tmpdir, capsys):
+    path = tmpdir.join('url_monitor.yaml')
+    path.write('config: [')
+    assert engine.requested_engine(['check', '-c', str(path)]) is None
+    assert capsys.readouterr() == ('', '')  # main() prints the error
+
+
+def test_thread_engine_not_patched():
+    assert not engine.patch('thread')
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import requests
+
+from url_monitor.httpcache import ResponseCache
+
+
+URI = 'http://api.example.com/health'
+PATHS = ['./status', './jobs[0]/name']
+VALUES = {'./status': 'ok', './jobs[0]/name': 'backup'}
+
+
+def make_response(**headers):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers.update(headers)
+    return response
+
+
+def test_roundtrip(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = ResponseCache(path)
+    cache.store('ts', URI, make_response(
+        ETag='"v1"', **{'Last-Modified': 'Mon, 05 Oct 2026 10:00:00 GMT'}),
+        VALUES)
+    assert cache.save()
+
+    cache = ResponseCache(path)
+    assert cache.headers('ts', URI, PATHS) == {
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Mon, 05 Oct 2026 10:00:00 GMT',
+    }
+    assert cache.values('ts', URI, PATHS) == VALUES
+    assert cache.hits == 1
+
+
+def test_changed_testset_not_used(tmpdir):
+    cache = ResponseCache(str(tmpdir.join('cache')))
+    cache.store('ts', URI, make_response(ETag='"v1"'), VALUES)
+    assert cache.headers('ts', URI + '?v=2', PATHS) == {}
+    assert cache.headers('ts', URI, PATHS + ['./new']) == {}
+    assert cache.values('ts', URI, PATHS + ['./new']) is None
+    assert cache.headers('other', URI, PATHS) == {}
+
+
+def test_no_validators_forgets(tmpdir):
+    cache = ResponseCache(str(tmpdir.join('cache')))
+    cache.store('ts', URI, make_response(ETag='"v1"'), VALUES)
+    cache.store('ts', URI, make_response(), VALUES)
+    assert cache.headers('ts', URI, PATHS) == {}
+
+
+def test_evicts_least_recently_used(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = ResponseCache(path, max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.store(key, URI, make_response(ETag='"v1"'), VALUES)
+    cache.entries['a']['used'] = cache.entries['c']['used'] + 1
+    cache.save()
+
+    assert sorted(ResponseCache(path).entries) == ['a', 'c']
+
+
+def test_unreadable_file(tmpdir):
+    path = tmpdir.join('cache')
+    path.write('{not json')
+    cache = ResponseCache(str(path))
+    assert cache.entries == {}
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+from io import BytesIO
+
+from pytest import raises
+
+import pytest
+
+parametrize = pytest.mark.parametrize
+
+from url_monitor import jpath
+
+
+DOCUMENT = {
+    'status': 'ok',
+    'elements': [0, 1, {'name': 'two'}],
+    'api_status': {'mongo': 'failed'},
+}
+
+
+class TestCompilePath(object):
+    @parametrize('path, steps', [
+        ('./status', (('status', None),)),
+        ('status', (('status', None),)),
+        ('./elements[2]/name', (('elements', 2), ('name', None))),
+        ('./api_status/mongo', (('api_status', None), ('mongo', None))),
+    ])
+    def test_steps(self, path, steps):
+        assert jpath.compile_path(path) == steps
+
+    @parametrize('path', ['./', './a//b', './elements[x]'])
+    def test_invalid(self, path):
+        with raises(ValueError):
+            jpath.compile_path(path)
+
+
+class TestJpathCompiled(object):
+    @parametrize('path, value', [
+        ('./status', 'ok'),
+        ('./elements[1]', 1),
+        ('./elements[2]/name', 'two'),
+        ('./api_status/mongo', 'failed'),
+        ('./missing', None),
+        ('./elements[9]', None),
+    ])
+    def test_matches_jpath(self, path, value):
+        steps = jpath.compile_path(path)
+        assert jpath.jpath_compiled(DOCUMENT, steps) == value
+        assert jpath.jpath_document(DOCUMENT, path) == value
+
+    def test_throw(self):
+        steps = jpath.compile_path('./missing')
+        with raises(KeyError):
+            jpath.jpath_compiled(DOCUMENT, steps, 'throw')
+
+
+class TestJpathStream(object):
+    @parametrize('path', [
+        './status', './elements[1]', './elements[2]', './elements[2]/name',
+        './api_status', './api_status/mongo', './missing', './elements[9]',
+    ])
+    def test_matches_jpath(self, path):
+        pytest.importorskip('ijson')
+        stream = BytesIO(json.dumps(DOCUMENT).encode('utf-8'))
+        values = jpath.jpath_stream(stream, [path])
+        assert values == {path: jpath.jpath_document(DOCUMENT, path)}
+
+    def test_many_paths(self):
+        pytest.importorskip('ijson')
+        paths = ['./status', './elements[2]/name', './elements']
+        stream = BytesIO(json.dumps(DOCUMENT).encode('utf-8'))
+        values = jpath.jpath_stream(stream, paths)
+        assert values == dict(
+            (path, jpath.jpath_document(DOCUMENT, path)) for path in paths)
+
+    def test_stops_reading(self):
+        pytest.importorskip('ijson')
+        body = b'{"status": "ok", "rest": [' + b'1, ' * 100000 + b'1]}'
+        stream = BytesIO(body)
+        assert jpath.jpath_stream(stream, ['./status']) == {'./status': 'ok'}
+        assert stream.tell() < len(body)
+
+    def test_malformed(self):
+        pytest.importorskip('ijson')
+        with raises(ValueError):
+            jpath.jpath_stream(BytesIO(b'{"status": '), ['./status'])
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pytest
+from pytest import raises
+
+parametrize = pytest.mark.parametrize
+
+from url_monitor import commons
+
+
+ELEMENTS = {
+    'json': [{'jsonvalue': './status'}, {'jsonvalue': './jobs[1]'}],
+    'json-stream': [{'jsonvalue': './status'}, {'jsonvalue': './jobs[1]'}],
+    'xml': [{'xpath': './status'}, {'xpath': './jobs/job[2]'}],
+}
+BODIES = {
+    'json': b'{"status": "ok", "jobs": [1, 2, 3]}',
+    'json-stream': b'{"status": "ok", "jobs": [1, 2, 3]}',
+    'xml': b'<api><status>ok</status><jobs><job>1</job><job>2</job></jobs>'
+           b'</api>',
+}
+
+
+@pytest.fixture
+def parsers():
+    pool = commons.ParsePool(logging.getLogger(__name__), 2, threshold=10)
+    yield pool
+    pool.close()
+
+
+@parametrize('type', ['json', 'json-stream', 'xml'])
+def test_extract_values(type):
+    values = commons.extract_values(BODIES[type], type, ELEMENTS[type])
+    paths = [commons.element_path(element, type)
+             for element in ELEMENTS[type]]
+    assert [str(values[path]) for path in paths] == ['ok', '2']
+
+
+@parametrize('type', ['json', 'xml'])
+def test_extract_in_worker(parsers, type):
+    assert parsers.extract(BODIES[type], type, ELEMENTS[type]) == \
+        commons.extract_values(BODIES[type], type, ELEMENTS[type])
+
+
+def test_decode_error_raised(parsers):
+    with raises(ValueError):
+        parsers.extract(b'{"status": ', 'json', ELEMENTS['json'])
+
+
+def test_offload_threshold(parsers):
+    assert parsers.offload(10)
+    assert not parsers.offload(9)
+    assert not parsers.offload(None)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import pstats
+import threading
+from StringIO import StringIO
+
+from url_monitor import profiling
+
+
+def busy():
+    return sum(i * i for i in range(1000))
+
+
+def profiled_functions(path):
+    return set(name for _, _, name in pstats.Stats(path).stats)
+
+
+def test_run_profile(tmpdir):
+    profiler = profiling.Profiler(str(tmpdir.join('profiles')))
+    profiler.start()
+    busy()
+    path = profiler.stop()
+    assert 'busy' in profiled_functions(path)
+
+
+def test_worker_checks_added_to_run(tmpdir):
+    profiler = profiling.Profiler(str(tmpdir), checks=True)
+    profiler.start()
+
+    def worker():
+        with profiler.check('health/api'):
+            busy()
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    path = profiler.stop()
+
+    assert 'busy' in profiled_functions(path)
+    checks = tmpdir.listdir('check-health_api-*.pstats')
+    assert len(checks) == 1
+    assert 'busy' in profiled_functions(str(checks[0]))
+
+
+def test_check_on_run_thread(tmpdir):
+    profiler = profiling.Profiler(str(tmpdir), checks=True)
+    profiler.start()
+    with profiler.check('health'):
+        busy()
+    path = profiler.stop()
+    assert 'busy' in profiled_functions(path)
+    assert len(tmpdir.listdir('check-health-*.pstats')) == 1
+
+
+def test_report(tmpdir):
+    profiler = profiling.Profiler(str(tmpdir))
+    profiler.start()
+    busy()
+    profiler.dump()
+    busy()
+    profiler.stop()
+
+    output = StringIO()
+    assert profiling.report(str(tmpdir), last=2, top=5, stream=output) == 0
+    assert 'across 2 profiles' in output.getvalue()
+    assert 'busy' in output.getvalue()
+
+
+def test_report_without_profiles(tmpdir):
+    output = StringIO()
+    assert profiling.report(str(tmpdir), stream=output) == 1
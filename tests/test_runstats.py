@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from url_monitor import action
+from url_monitor import commons
+from url_monitor import zbxsend
+
+
+CONFIG = {'config': {'zabbix': {'host': 'zabbix.localdomain',
+                                'run_metrics_key_format': 'run[{metric}]'}}}
+
+
+def test_take_starts_over():
+    stats = action.RunStats(started=0)
+    stats.add('checks_attempted')
+    stats.add('checks_attempted')
+    stats.add('bytes_downloaded', 512)
+    counters = stats.take()
+    assert counters['checks_attempted'] == 2
+    assert counters['bytes_downloaded'] == 512
+    assert counters['duration'] > 0
+    assert counters['peak_rss_kb'] > 0
+    assert 'checks_attempted' not in stats.take()
+
+
+def test_sender_counted_per_run(monkeypatch):
+    monkeypatch.setattr(zbxsend, 'send_to_zabbix', lambda *args: True)
+    sender = zbxsend.BackgroundSender(zbxsend.logger)
+    sender.put([zbxsend.Metric('host', 'key', 1)])
+    sender.flush()
+    stats = action.RunStats(sender)
+    sender.put([zbxsend.Metric('host', 'key', 1)] * 3)
+    sender.flush()
+    assert stats.take()['metrics_sent'] == 3
+    assert stats.take()['metrics_sent'] == 0
+    sender.close()
+
+
+def test_run_check_counts(monkeypatch):
+    results = iter([(0, None), (1, None)])
+
+    def check(*args, **kwargs):
+        result = next(results, None)
+        if result is None:
+            raise RuntimeError('check blew up')
+        return result
+    monkeypatch.setattr(action, 'check', check)
+
+    stats = action.RunStats()
+    for _ in range(3):
+        action.run_check({'key': 'health'}, None, zbxsend.logger,
+                         stats=stats)
+    counters = stats.take()
+    assert counters['checks_attempted'] == 3
+    assert counters['checks_failed'] == 2
+
+
+def test_run_metrics():
+    metrics = action.run_metrics(CONFIG, {'duration': 1.23456789,
+                                          'checks_attempted': 4})
+    assert [metric.key for metric in metrics] == [
+        'run[{0}]'.format(name) for name in action.RUN_METRICS]
+    values = dict((metric.key, metric.value) for metric in metrics)
+    assert values['run[duration]'] == 1.234568
+    assert values['run[checks_attempted]'] == 4
+    assert values['run[lock_wait]'] == 0
+
+
+def test_run_metrics_disabled():
+    config = {'config': {'zabbix': {'host': 'zabbix.localdomain'}}}
+    assert action.run_metrics(config, {'duration': 1}) == []
+
+
+def test_lock_wait():
+    lock = commons.RegistryLock()
+    stats = action.RunStats(locks=[lock])
+    held = threading.Event()
+
+    def hold():
+        with lock:
+            held.set()
+            time.sleep(0.2)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait(5)
+    with lock:
+        pass
+    holder.join()
+    assert stats.take()['lock_wait'] >= 0.1
+    assert stats.take()['lock_wait'] == 0
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from url_monitor.scheduler import Scheduler
+
+
+def make_testset(key, uri='http://api.example.com/status'):
+    return {'key': key, 'data': {'uri': uri}}
+
+
+def scheduler(checks, interval=60, jitter=0, now=0):
+    return Scheduler(
+        checks,
+        dict((testSet['key'], interval) for testSet in checks),
+        dict((testSet['key'], jitter) for testSet in checks),
+        now=now
+    )
+
+
+class TestScheduler(object):
+    def test_everything_due_at_start_without_jitter(self):
+        checks = [make_testset('a'), make_testset('b')]
+        schedule = scheduler(checks)
+        assert len(schedule.pop_due(0)) == 2
+        assert schedule.pop_due(59) == []
+        assert schedule.next_due() == 60
+
+    def test_mixed_intervals(self):
+        checks = [make_testset('fast'), make_testset('slow')]
+        schedule = Scheduler(checks, {'fast': 10, 'slow': 60},
+                             {'fast': 0, 'slow': 0}, now=0)
+        runs = []
+        for now in range(0, 61, 10):
+            runs.extend(testSet['key'] for testSet in schedule.pop_due(now))
+        assert runs.count('fast') == 7
+        assert runs.count('slow') == 2
+
+    def test_jitter_spreads_same_host(self):
+        checks = [make_testset(str(i)) for i in range(4)]
+        schedule = scheduler(checks, jitter=40)
+        due_times = sorted(entry[0] for entry in schedule.heap)
+        # one check per 10 second slice of the jitter window
+        for slot, due in enumerate(due_times):
+            assert slot * 10 <= due < (slot + 1) * 10
+
+    def test_missed_runs_are_skipped(self):
+        schedule = scheduler([make_testset('a')], interval=10)
+        assert len(schedule.pop_due(0)) == 1
+        assert len(schedule.pop_due(95)) == 1
+        assert schedule.next_due() == 100
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+import pytest
+
+from url_monitor import action
+from url_monitor import service
+from url_monitor.scheduler import Scheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_testset(key, uri='http://api.example.com/status'):
+    return {'key': key, 'data': {'uri': uri}}
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module of service, sleep() moves the clock on
+    and stops the service once it reaches stop_at.
+    """
+
+    def __init__(self, stop_at):
+        self.now = 0.0
+        self.stop_at = stop_at
+        self.service = None
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if self.now >= self.stop_at:
+            self.service.stop()
+
+
+class FakePool(object):
+    """
+    Stands in for action.CheckPool, every check submitted completes
+    right away.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.submitted = []  # (time, key)
+        self.completed = []
+        self.joined = False
+
+    def submit(self, testSet):
+        self.submitted.append((self.clock.now, testSet['key']))
+        self.completed.append((0, testSet['key'], None))
+        return True
+
+    def results(self):
+        completed, self.completed = self.completed, []
+        return completed
+
+    def join(self):
+        self.joined = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock(stop_at=65)
+    monkeypatch.setattr(service, 'time', clock)
+    # run() installs handlers for SIGTERM and SIGINT
+    monkeypatch.setattr(service.signal, 'signal', lambda *args: None)
+    return clock
+
+
+def make_service(clock, pool, skip=None):
+    checks = [make_testset('fast'), make_testset('slow')]
+    scheduler = Scheduler(checks, {'fast': 10, 'slow': 30},
+                          {'fast': 0, 'slow': 0}, now=0)
+    summaries = []
+
+    def summarize(results):
+        summaries.append((clock.now, sorted(key for rc, key, _ in results)))
+        return len(summaries)
+    checkservice = service.CheckService(logger, scheduler, pool, summarize,
+                                        interval=30, skip=skip)
+    clock.service = checkservice
+    return checkservice, summaries
+
+
+class TestCheckService(object):
+    def test_ticks(self, clock):
+        pool = FakePool(clock)
+        checkservice, summaries = make_service(clock, pool)
+        assert checkservice.run() == 3
+        assert [now for now, key in pool.submitted if key == 'fast'] == [
+            0, 10, 20, 30, 40, 50, 60]
+        assert [now for now, key in pool.submitted if key == 'slow'] == [
+            0, 30, 60]
+        assert summaries == [
+            (30, ['fast', 'fast', 'fast', 'slow']),
+            (60, ['fast', 'fast', 'fast', 'slow']),
+            (65, ['fast', 'slow']),  # the last one, once stopped
+        ]
+        assert pool.joined
+
+    def test_standby(self, clock):
+        pool = FakePool(clock)
+        checkservice, summaries = make_service(clock, pool,
+                                               skip=lambda: True)
+        checkservice.run()
+        assert pool.submitted == []
+        assert [results for now, results in summaries] == [[], [], []]
+
+
+class TestCheckPool(object):
+    @pytest.fixture
+    def running(self, monkeypatch):
+        """
+        Replaces run_check with one that waits for release to be set,
+        started is set once a check is running.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def run_check(testSet, *args, **kwargs):
+            started.set()
+            release.wait(10)
+            return (0, testSet['key'], None)
+        monkeypatch.setattr(action, 'run_check', run_check)
+        return started, release
+
+    def test_running_check_not_submitted_twice(self, running):
+        started, release = running
+        pool = action.CheckPool(None, logger, workers=2)
+        assert pool.submit(make_testset('a'))
+        assert started.wait(5)
+        assert not pool.submit(make_testset('a'))
+        release.set()
+        pool.join()
+        assert pool.results() == [(0, 'a', None)]
+
+    def test_stop_drains_in_flight_checks(self, running, monkeypatch):
+        monkeypatch.setattr(service.signal, 'signal', lambda *args: None)
+        started, release = running
+        pool = action.CheckPool(None, logger, workers=2)
+        checks = [make_testset('a'), make_testset('b')]
+        scheduler = Scheduler(checks, {'a': 60, 'b': 60}, {'a': 0, 'b': 0})
+        summaries = []
+        checkservice = service.CheckService(
+            logger, scheduler, pool, lambda results: summaries.append(
+                sorted(key for rc, key, _ in results)))
+
+        def stop():
+            started.wait(5)
+            checkservice.stop()
+            time.sleep(0.2)  # run() is waiting on the checks by now
+            release.set()
+        stopper = threading.Thread(target=stop)
+        stopper.daemon = True
+        stopper.start()
+        checkservice.run()
+        assert release.is_set()  # run() didn't return before the checks
+        assert summaries == [['a', 'b']]
+        assert pool.running == set()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from pytest import raises
+
+import pytest
+
+parametrize = pytest.mark.parametrize
+
+from url_monitor import sharding
+
+
+KEYS = ['testSet{0}'.format(i) for i in range(2000)]
+
+
+def owners(count):
+    ring = sharding.HashRing(count)
+    return dict((key, ring.owner(key)) for key in KEYS)
+
+
+class TestHashRing(object):
+    def test_balanced(self):
+        counts = {}
+        for owner in owners(4).values():
+            counts[owner] = counts.get(owner, 0) + 1
+        assert sorted(counts) == [1, 2, 3, 4]
+        assert min(counts.values()) > len(KEYS) / 4 * 0.7
+
+    def test_adding_a_shard_moves_few_keys(self):
+        before, after = owners(3), owners(4)
+        moved = [key for key in KEYS if before[key] != after[key]]
+        assert len(moved) < len(KEYS) / 4 * 1.3
+        assert set(after[key] for key in moved) == set([4])
+
+    def test_shards_cover_every_key_once(self):
+        shards = [sharding.Shard(index, 3) for index in (1, 2, 3)]
+        for key in KEYS[:100]:
+            assert len([shard for shard in shards if shard.owns(key)]) == 1
+
+
+class TestParseShard(object):
+    def test_parse(self):
+        shard = sharding.parse_shard('2/3')
+        assert (shard.index, shard.count) == (2, 3)
+        assert str(shard) == '2/3'
+
+    @parametrize('text', ['2', '0/2', '3/2', 'a/b', '1/2/3', ''])
+    def test_invalid(self, text):
+        with raises(ValueError):
+            sharding.parse_shard(text)
+
+
+class TestShardKey(object):
+    @parametrize('key_format, shard, key', [
+        ('url_monitor[EXECUTION_STATUS]', None,
+         'url_monitor[EXECUTION_STATUS]'),
+        ('url_monitor[EXECUTION_STATUS]', '1/2',
+         'url_monitor[EXECUTION_STATUS,1/2]'),
+        ('url_monitor.status', '1/2', 'url_monitor.status[1/2]'),
+        ('url_monitor[EXECUTION_STATUS, {shard}]', '1/2',
+         'url_monitor[EXECUTION_STATUS, 1/2]'),
+        ('url_monitor[EXECUTION_STATUS, {shard}]', None,
+         'url_monitor[EXECUTION_STATUS, all]'),
+    ])
+    def test_key(self, key_format, shard, key):
+        if shard is not None:
+            shard = sharding.parse_shard(shard)
+        assert sharding.shard_key(key_format, shard) == key
+
+    def test_fields(self):
+        assert sharding.shard_key('run[{metric}]', sharding.Shard(1, 2),
+                                  metric='duration') == 'run[duration,1/2]'
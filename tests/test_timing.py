@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import logging
+import socket
+
+import pytest
+
+from url_monitor import action
+from url_monitor import commons
+
+
+@pytest.fixture
+def get(server, make_config):
+    config = make_config().load()
+    return lambda webcaller: webcaller.run(
+        config, server.url(), True, '200', 'basic', 5)
+
+
+def test_phases_recorded(get):
+    webcaller = commons.WebCaller(logging.getLogger(__name__))
+    assert get(webcaller).status_code == 200
+    assert sorted(webcaller.timings) == sorted(commons.HTTP_PHASES)
+    assert webcaller.timings['connect'] > 0
+    assert webcaller.timings['ttfb'] > 0
+    assert webcaller.timings['tls'] == 0
+
+
+def test_next_address_tried(server, make_config, monkeypatch):
+    # Nothing listens on the first address monitor.test resolves to
+    unused = socket.socket()
+    unused.bind(('127.0.0.1', 0))
+    refused = unused.getsockname()[1]
+    unused.close()
+    getaddrinfo = socket.getaddrinfo
+    lookups = []
+
+    def resolve(host, port, *args, **kwargs):
+        if host != 'monitor.test':
+            return getaddrinfo(host, port, *args, **kwargs)
+        lookups.append(args[0])
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 ('127.0.0.1', address_port))
+                for address_port in (refused, server.server_address[1])]
+    monkeypatch.setattr(socket, 'getaddrinfo', resolve)
+
+    webcaller = commons.WebCaller(logging.getLogger(__name__))
+    response = webcaller.run(make_config().load(), server.url().replace(
+        '127.0.0.1', 'monitor.test'), True, '200', 'basic', 5)
+    assert response.status_code == 200
+    # Timed, then resolved again by urllib3, for the same families
+    assert len(lookups) == 2 and lookups[0] == lookups[1]
+    assert webcaller.timings['dns'] > 0
+    assert webcaller.timings['connect'] > 0
+
+
+def test_reused_connection_not_timed(get):
+    sessions = commons.SessionRegistry(logging.getLogger(__name__))
+    webcaller = commons.WebCaller(logging.getLogger(__name__), sessions)
+    get(webcaller)
+    get(webcaller)
+    assert webcaller.timings['dns'] == webcaller.timings['connect'] == 0
+    assert webcaller.timings['ttfb'] > 0
+    sessions.close()
+
+
+def test_timing_metrics():
+    config = {'config': {'zabbix': {
+        'host': 'zabbix.localdomain',
+        'timing_key_format': 'timing[{checkname}, {phase}, {originhost}]'}}}
+    testSet = {'key': 'health', 'data': {'uri': 'http://api:8080/health'}}
+    metrics = action.timing_metrics(config, testSet, {'ttfb': 0.1234567})
+    assert [metric.key for metric in metrics] == [
+        'timing[health, {0}, api]'.format(phase)
+        for phase in action.TIMING_PHASES]
+    assert metrics[3].value == 0.123457
+    assert metrics[0].value == 0
+
+
+def test_timing_metrics_disabled():
+    config = {'config': {'zabbix': {'host': 'zabbix.localdomain'}}}
+    testSet = {'key': 'health', 'data': {'uri': 'http://api/health'}}
+    assert action.timing_metrics(config, testSet, {}) == []
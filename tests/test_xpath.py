@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+
+from pytest import raises
+
+import pytest
+
+parametrize = pytest.mark.parametrize
+
+from url_monitor import xpath
+
+
+DOCUMENT = b'''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Jobs</title>
+  <entry id="1">
+    <title>backup</title>
+    <status>ok</status>
+  </entry>
+  <entry id="2">
+    <title>reindex</title>
+    <status> failed </status>
+    <link href="http://example.com/2"/>
+  </entry>
+</feed>
+'''
+
+
+class TestCompilePath(object):
+    @parametrize('path, compiled', [
+        ('/feed/title', ((('feed', None), ('title', None)), None)),
+        ('./entry[2]/@id', ((('*', None), ('entry', 2)), 'id')),
+        ('./title/text()', ((('*', None), ('title', None)), None)),
+    ])
+    def test_compiled(self, path, compiled):
+        assert xpath.compile_path(path) == compiled
+
+    @parametrize('path', [
+        'feed/title', './', '/feed//title', './entry[0]', './entry[x]',
+        './entry/@', './*[1]', '/feed/../title',
+    ])
+    def test_invalid(self, path):
+        with raises(ValueError):
+            xpath.compile_path(path)
+
+
+class TestXpathStream(object):
+    @parametrize('path, value', [
+        ('/feed/title', 'Jobs'),
+        ('./title', 'Jobs'),
+        ('./entry/title', 'backup'),
+        ('./entry[2]/title', 'reindex'),
+        ('./entry[2]/status', 'failed'),
+        ('./entry[2]/@id', '2'),
+        ('./entry[2]/link/@href', 'http://example.com/2'),
+        ('./entry/link/@href', 'http://example.com/2'),
+        ('./{http://www.w3.org/2005/Atom}entry[1]/status', 'ok'),
+        ('./{urn:other}entry/status', None),
+        ('./entry[3]/title', None),
+        ('/other/title', None),
+    ])
+    def test_values(self, path, value):
+        assert xpath.xpath_stream(BytesIO(DOCUMENT), [path]) == {path: value}
+
+    def test_single_pass(self):
+        paths = ['./entry[2]/title', './title', './entry[1]/@id']
+        values = xpath.xpath_stream(BytesIO(DOCUMENT), paths)
+        assert values == {'./entry[2]/title': 'reindex', './title': 'Jobs',
+                          './entry[1]/@id': '1'}
+
+    def test_stops_reading(self):
+        body = (b'<root><status>ok</status>' +
+                b'<item>1</item>' * 100000 + b'</root>')
+        stream = BytesIO(body)
+        assert xpath.xpath_stream(stream, ['./status']) == {'./status': 'ok'}
+        assert stream.tell() < len(body)
+
+    def test_malformed(self):
+        with raises(ValueError):
+            xpath.xpath_stream(BytesIO(b'<root><status>'), ['./status'])
+
+    def test_xpath(self):
+        assert xpath.xpath(DOCUMENT, './entry[1]/status') == 'ok'
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+parametrize = pytest.mark.parametrize
+
+from url_monitor import zbxsend
+from url_monitor.zbxsend import Metric
+
+
+def metrics(count, value='x'):
+    return [Metric('host', 'key{0}'.format(i), value, clock=1)
+            for i in range(count)]
+
+
+class TestChunkMetrics(object):
+    @parametrize('count, max_values, sizes', [
+        (0, 250, []),
+        (3, 250, [3]),
+        (10, 4, [4, 4, 2]),
+        (8, 4, [4, 4]),
+    ])
+    def test_max_values(self, count, max_values, sizes):
+        chunks = list(zbxsend.chunk_metrics(metrics(count), max_values))
+        assert [len(chunk) for chunk in chunks] == sizes
+
+    def test_max_bytes(self):
+        batch = metrics(20, value='y' * 100)
+        max_bytes = 600
+        chunks = list(zbxsend.chunk_metrics(batch, 250, max_bytes))
+        assert sum(chunks, []) == batch
+        assert len(chunks) > 1
+        for chunk in chunks:
+            packet = zbxsend.PACKET_FORMAT % ',\n'.join(
+                zbxsend._metric_data(m) for m in chunk)
+            assert zbxsend.HEADER_LENGTH + len(packet) <= max_bytes
+
+    def test_oversized_metric_gets_own_packet(self):
+        batch = metrics(3, value='z' * 1000)
+        chunks = list(zbxsend.chunk_metrics(batch, 250, 100))
+        assert [len(chunk) for chunk in chunks] == [1, 1, 1]
+
+
+class TestBackgroundSender(object):
+    @pytest.fixture
+    def sent(self, monkeypatch):
+        packets = []
+
+        def fake_send(logger, metrics, zabbix_host, zabbix_port, timeout):
+            packets.append(list(metrics))
+            return not any(m.value == 'reject' for m in metrics)
+        monkeypatch.setattr(zbxsend, 'send_to_zabbix', fake_send)
+        return packets
+
+    def test_batches_and_flushes_on_close(self, sent):
+        sender = zbxsend.BackgroundSender(
+            zbxsend.logger, max_values=4, flush_interval=60)
+        sender.put(metrics(10), tag='a')
+        assert sender.close() == []
+        assert len(sum(sent, [])) == 10
+        assert max(len(packet) for packet in sent) <= 4
+
+    def test_failures_are_attributed(self, sent):
+        sender = zbxsend.BackgroundSender(zbxsend.logger, max_values=1)
+        sender.add('good', metrics(1))
+        sender.add('bad', metrics(1, value='reject'))
+        assert sender.close() == ['bad']
+
+    def test_stamps_clock_when_queued(self, sent):
+        sender = zbxsend.BackgroundSender(zbxsend.logger)
+        metric = Metric('host', 'key', 1)
+        sender.put([metric])
+        sender.close()
+        assert metric.clock is not None
+
+    def test_spill_is_replayed(self, sent, tmpdir):
+        spill = str(tmpdir.join('spill'))
+        sender = zbxsend.BackgroundSender(
+            zbxsend.logger, overflow='spill', spill_path=spill)
+        sender.put([Metric('host', 'key', 'reject')], tag='bad')
+        assert sender.close() == ['bad']
+        assert tmpdir.join('spill').check()
+
+        # The next sender picks the spilled metric up again
+        with open(spill) as spilled:
+            replay = spilled.read().replace('reject', 'accept')
+        tmpdir.join('spill').write(replay)
+        sent[:] = []
+        sender = zbxsend.BackgroundSender(
+            zbxsend.logger, overflow='spill', spill_path=spill)
+        assert sender.close() == []
+        assert [m.value for m in sum(sent, [])] == ['accept']
+        assert not tmpdir.join('spill').check()
+
+    def test_flush_resets_failures(self, sent):
+        sender = zbxsend.BackgroundSender(zbxsend.logger, flush_interval=60)
+        sender.add('bad', metrics(1, value='reject'))
+        assert sender.flush() == ['bad']
+        assert len(sent) == 1
+        sender.add('good', metrics(1))
+        assert sender.close() == []
+
+    def test_counts_sends(self, sent):
+        sender = zbxsend.BackgroundSender(zbxsend.logger, max_values=2)
+        sender.add('good', metrics(3))
+        sender.add('bad', metrics(1, value='reject'))
+        sender.close()
+        assert sender.sent == 2
+        assert sender.failures == 1
+        assert sender.send_seconds >= 0
+
+    def test_spill_retries_back_off(self, sent, tmpdir, monkeypatch):
+        monkeypatch.setattr(zbxsend, 'send_to_zabbix',
+                            lambda *args: sent.append(args) and False)
+        sender = zbxsend.BackgroundSender(
+            zbxsend.logger, overflow='spill', flush_interval=0.05,
+            spill_path=str(tmpdir.join('spill')))
+        sender.put(metrics(1))
+        time.sleep(0.5)
+        # 0.05, 0.1, 0.2 seconds between retries, not a tight loop
+        assert len(sent) <= 5
+        assert sender.retry_delay > sender.flush_interval
+        sender.close()
+
+    def test_close_with_full_queue(self, sent, monkeypatch):
+        sending = threading.Event()
+        release = threading.Event()
+
+        def blocked_send(*args):
+            sending.set()
+            release.wait()
+            return True
+        monkeypatch.setattr(zbxsend, 'send_to_zabbix', blocked_send)
+        sender = zbxsend.BackgroundSender(
+            zbxsend.logger, queue_size=3, max_values=1,
+            overflow='drop-oldest')
+        sender.put(metrics(1), tag='first')
+        assert sending.wait(5)
+
+        closing = threading.Thread(target=sender.close)
+        closing.daemon = True
+        closing.start()
+        while sender.queue.empty():
+            time.sleep(0.01)
+        sender.put(metrics(5), tag='late')  # drops metrics, keeps the stop
+        release.set()
+        closing.join(5)
+        assert not closing.is_alive(), "close() hung on a dropped stop"
+        assert sender.failed == set(['late'])
+        assert sender.dropped == 3
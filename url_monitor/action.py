@@ -1,25 +1,36 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import logging
+import resource
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import commons
 import sys
 import json
 import requests
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
 from urlparse import urlparse
 
+import httpcache
+import sharding
 import zbxsend
 
 __doc__ = """Action on backends after entry points are handled in main"""
 
 
-def webfacade(testSet, configinstance, webcaller, config):
+def webfacade(testSet, configinstance, webcaller, config, headers=None,
+              any_status=False):
     """
     Perform the web request for a check.
     (Called upon by check())
 
     :param testSet: Name of testset to pull values
     :param configinstance: config class object
+    :param headers: extra request headers, e.g. conditional GET validators
+    :param any_status: return the response whatever its status, for
+                       testSets sharing it to check their ok_http_code
     :return requests output:
     """
 
@@ -32,11 +43,14 @@ def webfacade(testSet, configinstance, webcaller, config):
     out = webcaller.run(config,
                         testset['data']['uri'],
                         verify=vfyssl,
-                        expected_http_status=str(
+                        expected_http_status=None if any_status else str(
                             testset['data']['ok_http_code']),
                         identity_provider=testset[
                             'data']['identity_provider'],
-                        timeout=tmout)
+                        timeout=tmout,
+                        # check() reads the body, timed apart from ttfb
+                        stream=True,
+                        headers=headers)
 
     if out == False:  # webcaller.run has requests.exceptions
         logging.error("Spawn request failed, skipping."
@@ -47,13 +61,16 @@ def webfacade(testSet, configinstance, webcaller, config):
         return out
 
 
-def transmitfacade(configinstance, metrics, logger):
+def transmitfacade(configinstance, metrics, logger, failed=None):
     """
-    Send a list of Metric objects to zabbix.
+    Send a list of Metric objects to zabbix, split into as few packets as
+    `zabbix: max_values_per_packet` and `max_bytes_per_packet` allow.
     Called by check()
 
     param configinstance: The current configinstance object
     param metrics: list of Metrics for zbxsend
+    param failed: optional list, Metrics from packets that were not
+                  accepted by zabbix are appended to it
     Returns True if succcess.
     """
     constant_zabbix_port = 10051
@@ -70,6 +87,11 @@ def transmitfacade(configinstance, metrics, logger):
         # Assume 30.0 if key is empty
         timeout = float(configinstance['config'][
             'zabbix'].get('send_timeout', 30.0))
+        # Assume zabbix_sender's 250 values and 1MiB if keys are empty
+        max_values = int(configinstance['config'][
+            'zabbix'].get('max_values_per_packet', 250))
+        max_bytes = int(configinstance['config'][
+            'zabbix'].get('max_bytes_per_packet', 1048576))
     except:
         logging.error("Could not reference config: zabbix entry in conf")
         return False
@@ -87,39 +109,314 @@ def transmitfacade(configinstance, metrics, logger):
     )
 
     # Send metrics to zabbix
+    success = True
+    for packet in zbxsend.chunk_metrics(metrics, max_values, max_bytes):
+        try:
+            sent = zbxsend.send_to_zabbix(
+                metrics=packet,
+                zabbix_host=z_host,
+                zabbix_port=z_port,
+                timeout=timeout,
+                logger=logger
+            )
+        except:
+            sent = False
+        if not sent:
+            logging.debug("event.send_to_zabbix({0},{1},{2},{3}) failed in"
+                          " transmitfacade()".format(packet, z_host, z_port, timeout))
+            success = False
+            if failed is not None:
+                failed.extend(packet)
+    return success
+
+
+def senderfacade(configinstance, logger):
+    """
+    Start a background zbxsend.BackgroundSender for a run, configured from
+    the `zabbix:` section (queue_size, queue_overflow, flush_interval and
+    spill_file are optional).
+    Called by main()
+
+    param configinstance: The current configinstance object
+    Returns the sender, or None if the config can't be used.
+    """
+    constant_zabbix_port = 10051
+    zabbix = configinstance['config']['zabbix']
     try:
-        zbxsend.send_to_zabbix(
-            metrics=metrics,
+        z_host, z_port = commons.get_hostport_tuple(
+            constant_zabbix_port, zabbix['server'])
+    except:
+        logging.error('Could not reference config: zabbix: server in conf')
+        return None
+
+    try:
+        return zbxsend.BackgroundSender(
+            logger,
             zabbix_host=z_host,
             zabbix_port=z_port,
-            timeout=timeout,
-            logger=logger
+            timeout=float(zabbix.get('send_timeout', 30.0)),
+            queue_size=int(zabbix.get('queue_size', 10000)),
+            max_values=int(zabbix.get('max_values_per_packet', 250)),
+            max_bytes=int(zabbix.get('max_bytes_per_packet', 1048576)),
+            flush_interval=float(zabbix.get('flush_interval', 1.0)),
+            overflow=str(zabbix.get('queue_overflow', 'block')).lower(),
+            spill_path=zabbix.get(
+                'spill_file', configinstance['config']['pidfile'] + '.spill')
         )
-    except:
-        logging.debug("event.send_to_zabbix({0},{1},{2},{3}) failed in"
-                      " transmitfacade()".format(metrics, z_host, z_port, timeout))
-        return False
-    # success
-    return True
+    except (TypeError, ValueError) as err:
+        logging.error("Could not reference config: zabbix entry in conf "
+                      "{0}".format(err))
+        return None
+
+
+def cachefacade(configinstance, logger):
+    """
+    Open the conditional GET response cache for a run, from the optional
+    `config: response_cache_file` (pidfile + '.cache' by default) and
+    `config: response_cache_size` (1000 testSets, 0 disables the cache).
+    Called by main()
+
+    param configinstance: The current configinstance object
+    Returns a httpcache.ResponseCache, or None if disabled.
+    """
+    config = configinstance['config']
+    try:
+        max_entries = int(config.get('response_cache_size', 1000))
+    except (TypeError, ValueError) as err:
+        logging.error("Error: `response_cache_size` must be a whole number, "
+                      "{0}. Response cache disabled.".format(err))
+        return None
+    if max_entries <= 0:
+        return None
+    return httpcache.ResponseCache(
+        config.get('response_cache_file', config['pidfile'] + '.cache'),
+        max_entries=max_entries,
+        logger=logger
+    )
+
 
+def conditionfacade(configinstance, logger):
+    """
+    Open the cache of skip_run_when results, `config: skip_cache_file`
+    (pidfile + '.skip' by default). Only conditions with a cache_ttl use it.
+    Called by main()
 
-def check(testSet, configinstance, logger):
+    param configinstance: The current configinstance object
+    Returns a commons.ConditionCache.
+    """
+    config = configinstance['config']
+    return commons.ConditionCache(
+        config.get('skip_cache_file', config['pidfile'] + '.skip'),
+        logging=logger
+    )
+
+
+def parserfacade(configinstance, logger):
+    """
+    Start the worker processes decoding large response bodies for a run,
+    `config: parse_processes` of them (0, the default, decodes every body
+    in the check itself) for bodies of `config: parse_offload_bytes` or
+    more (1 MiB by default).
+    Called by main(), before any thread is started
+
+    param configinstance: The current configinstance object
+    Returns a commons.ParsePool, or None if disabled.
+    """
+    config = configinstance['config']
+    try:
+        processes = int(config.get('parse_processes', 0))
+        threshold = int(config.get('parse_offload_bytes', 1048576))
+    except (TypeError, ValueError) as err:
+        logging.error("Error: `parse_processes` and `parse_offload_bytes` "
+                      "must be whole numbers, {0}. Parsing every response "
+                      "in process.".format(err))
+        return None
+    if processes <= 0:
+        return None
+    return commons.ParsePool(logger, processes, threshold)
+
+
+def fetch_group(testSet, configinstance):
+    """
+    :return tuple: (uri, identity_provider, verify) of a testSet, testSets
+                   with the same group can share one request
+    """
+    testset = configinstance.get_test_set(testSet)
+    return (testset['data']['uri'], testset['data']['identity_provider'],
+            configinstance.get_verify_ssl(testSet))
+
+
+def coalescefacade(configinstance, checks, logger):
+    """
+    Group the testSets of a run which request the same uri with the same
+    identity_provider and verify setting, so each group is fetched once.
+    `config: coalesce_requests: false` fetches every testSet on its own.
+    Called by main()
+
+    param configinstance: The current configinstance object
+    param checks: the testSets of the run
+    Returns a commons.FetchGroups, or None if disabled.
+    """
+    if configinstance.load()['config'].get('coalesce_requests') is False:
+        return None
+    groups = {}
+    for testSet in checks:
+        group = fetch_group(testSet, configinstance)
+        groups[group] = groups.get(group, 0) + 1
+    return commons.FetchGroups(groups, logger)
+
+
+def content_length(response):
+    """
+    :return integer: the Content-Length of response, None if not given
+    """
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+# Most bytes left of a body worth reading to keep its connection pooled,
+# past that closing it and connecting again next time is cheaper
+DRAIN_LIMIT = 8192
+
+
+def release_response(response, drain_limit=DRAIN_LIMIT):
+    """
+    Hand the connection of response back to its session's pool when what
+    is left of the body, if anything, is at most drain_limit bytes. A
+    streamed body whose reading stopped early with more left, or of
+    unknown length, is closed along with its connection instead.
+    """
+    length = content_length(response)
+    if response.status_code == 304 or response.raw.closed:
+        left = 0
+    elif length is not None:
+        left = length - response.raw.tell()
+    else:
+        left = None  # chunked, could be anything
+    if left is None or left > drain_limit:
+        response.close()
+        return
+    try:
+        for chunk in response.raw.stream(65536, decode_content=False):
+            pass
+    except urllib3_exceptions.HTTPError:
+        response.close()  # broken, not worth pooling
+    else:
+        response.raw.release_conn()
+
+
+# Phases reported by timing_metrics, the HTTP ones come from
+# commons.WebCaller.run
+TIMING_PHASES = commons.HTTP_PHASES + ('download', 'parse', 'total')
+
+
+def timing_metrics(config, testset, timings):
+    """
+    Zabbix items for the seconds a testSet spent in each phase, keyed
+    with `config: zabbix: timing_key_format`.
+
+    :param config: the loaded config
+    :param testset: the testSet the timings were taken for
+    :param timings: dict of phase to seconds
+    :return list: zbxsend.Metric per phase, empty when no format is set
+    """
+    key_format = config['config']['zabbix'].get('timing_key_format')
+    if not key_format:
+        return []
+    uri = testset['data']['uri']
+    fields = {
+        'checkname': testset['key'],
+        'uri': uri,
+        'originhost': urlparse(uri).netloc.split(':')[0],
+    }
+    metrics = []
+    for phase in TIMING_PHASES:
+        metrics.append(zbxsend.Metric(
+            config['config']['zabbix']['host'],
+            key_format.format(phase=phase, **fields),
+            round(timings.get(phase, 0.0), 6)))
+    return metrics
+
+
+def fetch_shared(testSet, configinstance, webcaller, config, stats=None):
+    """
+    Make the request of a group of testSets and read the whole body, the
+    response is shared by all of them.
+    (Called by check() for the first testSet of a commons.FetchGroups group)
+
+    :param stats: optional RunStats counting the bytes downloaded
+    :return: (response, timings) tuple, None if the request failed
+    """
+    response = webfacade(testSet, configinstance, webcaller, config,
+                         any_status=True)
+    if response is False:
+        return None
+    try:
+        read = time.time()
+        response.content
+        timings = dict(webcaller.timings, download=time.time() - read)
+    finally:
+        if stats is not None:
+            stats.add('bytes_downloaded', response.raw.tell())
+        response.close()
+    return (response, timings)
+
+
+def check(testSet, configinstance, logger, sessions=None, telemetry=None,
+          responses=None, stats=None, parsers=None, fetches=None):
     """
     Perform the checks when called upon by argparse in main()
 
     :param testSet:
     :param configinstance:
     :param logger:
+    :param sessions: optional commons.SessionRegistry shared between checks
+    :param telemetry: optional zbxsend.BackgroundSender, Metrics are queued
+                      on it instead of being sent right away
+    :param responses: optional httpcache.ResponseCache, requests are made
+                      conditional and a 304 reuses the cached values
+    :param stats: optional RunStats counting the bytes downloaded
+    :param parsers: optional commons.ParsePool, large bodies are decoded
+                    by its worker processes
+    :param fetches: optional commons.FetchGroups, testSets sharing a
+                    request reuse one response
     :return: tuple (statcode, check)
     """
 
     testset = configinstance.get_test_set(testSet)
 
     config = configinstance.load()
-    webinstance = commons.WebCaller(logger)
+    webinstance = commons.WebCaller(logger, sessions=sessions)
+
+    paths = [commons.element_path(element, testSet['data']['response_type'])
+             for element in testSet['data']['testElements']]
+    group = None
+    if fetches is not None:
+        group = fetch_group(testSet, configinstance)
+        if not fetches.shared(group):
+            group = None
+    conditional = None
+    if responses is not None and group is None:
+        conditional = responses.headers(
+            testSet['key'], testset['data']['uri'], paths)
 
     # Make a request and check a resource
-    response = webfacade(testSet, configinstance, webinstance, config)
+    started = time.time()
+    fetched = None
+    if group is None:
+        response = webfacade(testSet, configinstance, webinstance, config,
+                             headers=conditional)
+    else:
+        # Fetched once for the group, each testSet checks the status
+        # against its own ok_http_code.
+        fetched = fetches.fetch(group, lambda: fetch_shared(
+            testSet, configinstance, webinstance, config, stats))
+        response = None
+        if fetched is not None and webinstance.expected_status(
+                fetched[0], str(testset['data']['ok_http_code'])):
+            response = fetched[0]
     if not response:
         return (1, None)  # caught request exception!
 
@@ -130,98 +427,554 @@ def check(testSet, configinstance, logger):
     zabbix_telemetry = []
     report_bad_health = False
 
+    # Decode the response body once, every testElement is pulled out of
+    # the same parsed document.
+    response_type = testSet['data']['response_type']
+    if fetched is None:
+        timings = dict(webinstance.timings or {}, download=0.0, parse=0.0)
+    else:
+        timings = dict(fetched[1], parse=0.0)
+    cached = None
+    extracted = None  # values decoded by a parsers worker
+    if response.status_code == 304 and fetched is None:
+        release_response(response)  # no body to read
+        document = None  # every testElement reports None without a cache
+        if responses is not None:
+            cached = responses.values(
+                testSet['key'], testset['data']['uri'], paths)
+            if cached is None:  # evicted since the request was made
+                logging.error("Got 304 Not Modified for {0} without cached "
+                              "values".format(testset['data']['uri']))
+                return (1, None)
+            logger.debug("{0} not modified, reusing cached values".format(
+                testset['data']['uri']))
+    else:
+        elements = testSet['data']['testElements']
+        try:
+            if response_type in commons.STREAMED_TYPES and fetched is None \
+                    and not (parsers is not None and
+                             parsers.offload(content_length(response))):
+                # Only the testElement values are decoded, and unless
+                # little is left the connection is dropped once they've
+                # all been read.
+                # Reading and parsing interleave, both count as download.
+                response.raw.decode_content = True
+                read = time.time()
+                document = commons.load_document(
+                    response.raw, response_type, elements)
+                timings['download'] = time.time() - read
+            else:
+                read = time.time()
+                content = response.content  # already read when shared
+                parse = time.time()
+                if fetched is None:
+                    timings['download'] = parse - read
+                document = None
+                if parsers is not None and (
+                        response_type in commons.STREAMED_TYPES and
+                        fetched is None or parsers.offload(len(content))):
+                    extracted = parsers.extract(
+                        content, response_type, elements)
+                elif response_type in commons.STREAMED_TYPES:
+                    extracted = commons.extract_values(
+                        content, response_type, elements)
+                else:
+                    document = commons.load_document(content, response_type)
+                timings['parse'] = time.time() - parse
+        except ValueError as err:
+            logging.error("Could not decode {0} response from {1}: {2}".format(
+                response_type, testset['data']['uri'], err))
+            document = None  # every testElement will report None
+            if responses is not None:
+                responses.forget(testSet['key'])
+                responses = None  # nothing worth caching
+        finally:
+            release_response(response)
+            if stats is not None and fetched is None:
+                stats.add('bytes_downloaded', response.raw.tell())
+    timings['total'] = time.time() - started
+
     # For each testElement do our path check and capture results
 
+    values = {}
+    item = None
+    # testSets were validated when the config was loaded
     for check in testSet['data']['testElements']:
-        if not configinstance.datatypes_valid(check):
-            return (1, check)
-
-        try:
-            datatypes = check['datatype'].split(',')
-        except KeyError as err:
-            logging.error("Uncaught unknown error")
-            return (1, check)
-        # We need to make a metric for each explicit data type
-        # (string,int,count)
-        for datatype in datatypes:
+        datatypes = str(check['datatype']).split(',')
+
+        if cached is not None:
+            api_res_value = cached[
+                commons.element_path(check, response_type)]
+        elif extracted is not None:
+            api_res_value = extracted[
+                commons.element_path(check, response_type)]
+            values[commons.element_path(check, response_type)] = api_res_value
+        else:
             try:
-                api_res_value = commons.omnipath(response.content, testSet[
-                    'data']['response_type'], check)
+                api_res_value = commons.omnipath(
+                    document, response_type, check, parsed=True)
             except KeyError as err:
                 logging.error("Uncaught unknown error")
                 return (1, check)
+            values[commons.element_path(check, response_type)] = api_res_value
+
+        # We need to make a metric for each explicit data type
+        # (string,int,count)
+        for datatype in datatypes:
+            # Work on a copy, the testElement in the config is reused by
+            # the next cycle of a daemon.
+            item = dict(check)
 
             # Append to the check things like response, statuscode, and
             # the request url, I'd like to monitor status codes but don't
             # know what that'll take.
 
-            check['datatype'] = datatype
-            check['api_response'] = api_res_value
-            check['request_statuscode'] = response.status_code
-            check['uri'] = testset['data']['uri']
+            item['datatype'] = datatype
+            item['api_response'] = api_res_value
+            item['request_statuscode'] = response.status_code
+            item['uri'] = testset['data']['uri']
 
             # Determines the host of the uri
 
             try:
-                check['originhost'] = urlparse(
-                    check['uri']).netloc.split(':')[0]
+                item['originhost'] = urlparse(
+                    item['uri']).netloc.split(':')[0]
             except:
                 logging.error(
-                    "Could not use urlparse on '{0}'".format(check['uri']))
-                return (1, check)
-
-            try:
-                check['key']
-            except KeyError as err:
-                logging.error("Uncaught unknown error")
-                return (1, check)
+                    "Could not use urlparse on '{0}'".format(item['uri']))
+                return (1, item)
 
             # There was no value associated for the desired key.
             # This is considered a failing check, as datatype is unsupported
             if api_res_value == None:
                 logging.warning("{0} check failed check="
-                                "{1}".format(check['originhost'], check))
+                                "{1}".format(item['originhost'], item))
                 report_bad_health = True
 
             # Print out each k,v
             logging.debug(" Found resource {uri}||{k} value ({v})".format(
-                uri=check['uri'], k=check['key'], v=check['api_response']))
+                uri=item['uri'], k=item['key'], v=item['api_response']))
 
             # Applies a key format from the configuration file, allowing
             # custom zabbix keys for your items reporting to zabbix. Any
             # check in testSet can be substituted, the {uri} and
             # Pdatatype} are also made available.
             metrickey = config['config']['zabbix'][
-                'item_key_format'].format(**check)
+                'item_key_format'].format(**item)
 
             zabbix_telemetry.append(
-                zbxsend.Metric(zabbix_metric_host, metrickey, check['api_response'])
+                zbxsend.Metric(zabbix_metric_host, metrickey, item['api_response'])
             )
 
-    logger.info("Sending telemetry to zabbix server as Metrics objects")
-    logger.debug("Telemetry: {0}".format(zabbix_telemetry))
-    if not transmitfacade(configinstance=config, metrics=zabbix_telemetry, logger=logger):
-        logger.critical("Sending telemetry to zabbix failed!")
+    zabbix_telemetry.extend(timing_metrics(config, testSet, timings))
+
+    # Coalesced requests aren't conditional, nothing to revalidate with
+    if responses is not None and cached is None and group is None:
+        responses.store(testSet['key'], testset['data']['uri'], response,
+                        values)
+
+    if telemetry is not None:
+        logger.debug("Queued telemetry: {0}".format(zabbix_telemetry))
+        telemetry.add(testSet['key'], zabbix_telemetry)
+    else:
+        logger.info("Sending telemetry to zabbix server as Metrics objects")
+        logger.debug("Telemetry: {0}".format(zabbix_telemetry))
+        if not transmitfacade(configinstance=config, metrics=zabbix_telemetry, logger=logger):
+            logger.critical("Sending telemetry to zabbix failed!")
 
     if report_bad_health:
-        return (1, check)
+        return (1, item)
+    else:
+        return (0, item)
+
+
+def run_check(testSet, configinstance, logger, sessions=None, telemetry=None,
+              responses=None, stats=None, profiler=None, parsers=None,
+              fetches=None):
+    """
+    Run one testSet, logging instead of raising if the check blows up.
+
+    :param stats: optional RunStats counting attempted and failed checks
+    :param profiler: optional profiling.Profiler of the run
+    :param parsers: optional commons.ParsePool for large bodies
+    :param fetches: optional commons.FetchGroups of the run
+    :return: (rc, key, checkobj) tuple, None if the check raised
+    """
+    if stats is not None:
+        stats.add('checks_attempted')
+    try:
+        if profiler is None:
+            rc, checkobj = check(testSet, configinstance, logger,
+                                 sessions=sessions, telemetry=telemetry,
+                                 responses=responses, stats=stats,
+                                 parsers=parsers, fetches=fetches)
+        else:
+            with profiler.check(testSet['key']):
+                rc, checkobj = check(testSet, configinstance, logger,
+                                     sessions=sessions, telemetry=telemetry,
+                                     responses=responses, stats=stats,
+                                     parsers=parsers, fetches=fetches)
+    except Exception as e:
+        logger.exception(e)
+        rc = None
+    except BaseException as e:
+        # A pool worker thread dies on anything but an Exception, leaving
+        # run_checks waiting for its result forever. Killed greenlets
+        # must still exit though.
+        if commons.gevent is not None and isinstance(
+                e, commons.gevent.GreenletExit):
+            raise
+        logger.exception("Check {0} stopped: {1!r}".format(
+            testSet['key'], e))
+        rc = None
+    if rc != 0 and stats is not None:
+        stats.add('checks_failed')
+    if rc is None:
+        return None
+    return (rc, testSet['key'], checkobj)
+
+
+def run_checks(checks, configinstance, logger, workers=1, engine='thread',
+               sessions=None, telemetry=None, responses=None, stats=None,
+               profiler=None, parsers=None, fetches=None):
+    """
+    Run a list of testSets, fanning them out across a pool of worker
+    threads when workers is greater than one. The async engine runs them
+    as greenlets on a single gevent event loop instead.
+    (Called upon by main())
+
+    :param checks: list of testSets to run
+    :param configinstance: config class object
+    :param logger:
+    :param workers: size of the thread or greenlet pool
+    :param engine: `thread` or `async`
+    :param sessions: optional commons.SessionRegistry shared between checks
+    :param telemetry: optional zbxsend.BackgroundSender for every check's Metrics
+    :param responses: optional httpcache.ResponseCache shared between checks
+    :param stats: optional RunStats shared between checks
+    :param profiler: optional profiling.Profiler of the run
+    :param parsers: optional commons.ParsePool shared between checks
+    :param fetches: optional commons.FetchGroups coalescing the requests
+                    of checks
+    :return: list of (rc, key, checkobj) tuples in testSet order
+    """
+    def run_one(testSet):
+        return run_check(testSet, configinstance, logger,
+                         sessions=sessions, telemetry=telemetry,
+                         responses=responses, stats=stats,
+                         profiler=profiler, parsers=parsers,
+                         fetches=fetches)
+
+    workers = min(workers, len(checks))
+    if engine == 'async' and checks:
+        logger.info("Running {0} checks on the async engine with {1} "
+                    "concurrent requests".format(len(checks), workers))
+        results = commons.async_pool(workers).map(run_one, checks)
+    elif workers > 1:
+        logger.info("Running {0} checks across {1} workers".format(
+            len(checks), workers))
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(run_one, checks)
+        finally:
+            pool.close()
+            pool.join()
     else:
-        return (0, check)
+        results = map(run_one, checks)
+
+    # Checks which raised were logged above and are left out
+    return [result for result in results if result is not None]
+
 
+class CheckPool(object):
+    """
+    Long lived pool of workers for daemon mode. submit() returns right away
+    and results are collected until taken with results(), so checks due at
+    different times don't wait on each other.
+    """
+
+    def __init__(self, configinstance, logger, workers=1, engine='thread',
+                 sessions=None, telemetry=None, responses=None, stats=None,
+                 profiler=None, parsers=None):
+        self.configinstance = configinstance
+        self.logger = logger
+        self.sessions = sessions
+        self.telemetry = telemetry
+        self.responses = responses
+        self.stats = stats
+        self.profiler = profiler
+        self.parsers = parsers
+
+        self.engine = engine
+        if engine == 'async':
+            self.pool = commons.async_pool(workers)
+        else:
+            self.pool = ThreadPool(workers)
+
+        self.running = set()  # keys of testSets in flight
+        self.completed = []  # (rc, key, checkobj) tuples
+        self.lock = threading.Lock()
+
+    def submit(self, testSet):
+        """
+        Queue a testSet to run. A testSet still running from its last
+        interval is skipped rather than run twice at once.
+
+        :return: False if skipped
+        """
+        with self.lock:
+            if testSet['key'] in self.running:
+                self.logger.warning("Check {0} is still running from its "
+                                    "last interval, skipping".format(
+                                        testSet['key']))
+                return False
+            self.running.add(testSet['key'])
+        if self.engine == 'async':
+            self.pool.spawn(self._run, testSet)
+        else:
+            self.pool.apply_async(self._run, (testSet,))
+        return True
+
+    def _run(self, testSet):
+        result = None
+        try:
+            result = run_check(testSet, self.configinstance, self.logger,
+                               sessions=self.sessions,
+                               telemetry=self.telemetry,
+                               responses=self.responses,
+                               stats=self.stats,
+                               profiler=self.profiler,
+                               parsers=self.parsers)
+        finally:
+            with self.lock:
+                self.running.discard(testSet['key'])
+                if result is not None:
+                    self.completed.append(result)
+
+    def results(self):
+        """
+        Take the results of every check completed since the last call.
+
+        :return: list of (rc, key, checkobj) tuples
+        """
+        with self.lock:
+            completed, self.completed = self.completed, []
+        return completed
+
+    def join(self):
+        """
+        Wait for the checks in flight, no more can be submitted after.
+        """
+        if self.engine != 'async':
+            self.pool.close()
+        self.pool.join()
+
+
+class RunStats(object):
+    """
+    Counts what a run, or a cycle of the daemon, did for run_metrics().
+    Checks add to it from every worker, take() reads the counts and
+    starts over.
+    """
 
-def discover(args, configinstance, logger):
+    # zbxsend.BackgroundSender counters, reported as the change per run
+    SENDER_COUNTERS = (('metrics_sent', 'sent'),
+                       ('sender_seconds', 'send_seconds'),
+                       ('sender_failures', 'failures'))
+
+    def __init__(self, telemetry=None, started=None, locks=()):
+        """
+        :param telemetry: optional zbxsend.BackgroundSender to report on
+        :param started: time the run started, default now
+        :param locks: commons.RegistryLocks checks wait on, the change of
+                      their waited seconds is reported as lock_wait
+        """
+        self.telemetry = telemetry
+        self.locks = locks
+        self.lock = threading.Lock()
+        self.started = started if started is not None else time.time()
+        self.counters = {}
+        self.sender = self._sender_counters()
+        self.waited = self._waited()
+
+    def _sender_counters(self):
+        if self.telemetry is None:
+            return {}
+        return dict((name, getattr(self.telemetry, attribute))
+                    for name, attribute in self.SENDER_COUNTERS)
+
+    def _waited(self):
+        return sum(lock.waited for lock in self.locks)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def take(self):
+        """
+        :return dict: counters since the last take(), with the duration,
+                      the sender activity, the lock wait and the peak RSS
+                      of the process
+        """
+        now = time.time()
+        sender = self._sender_counters()
+        waited = self._waited()
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            started, self.started = self.started, now
+            previous, self.sender = self.sender, sender
+            previous_waited, self.waited = self.waited, waited
+        counters['duration'] = now - started
+        for name, value in sender.iteritems():
+            counters[name] = value - previous[name]
+        counters['lock_wait'] = waited - previous_waited
+        counters['peak_rss_kb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+        return counters
+
+
+# Reported by run_metrics, missing counters are sent as 0
+RUN_METRICS = ('duration', 'checks_attempted', 'checks_failed',
+               'checks_skipped', 'metrics_sent', 'sender_seconds',
+               'sender_failures', 'bytes_downloaded', 'peak_rss_kb',
+               'lock_wait', 'fetches_saved')
+
+
+def run_metrics(config, counters, shard=None):
+    """
+    Zabbix items describing the run itself, keyed with
+    `config: zabbix: run_metrics_key_format`.
+
+    :param config: the loaded config
+    :param counters: dict from RunStats.take()
+    :param shard: sharding.Shard of the run, None if not sharded
+    :return list: zbxsend.Metric per RUN_METRICS, empty when no format is set
+    """
+    key_format = config['config']['zabbix'].get('run_metrics_key_format')
+    if not key_format:
+        return []
+    metrics = []
+    for name in RUN_METRICS:
+        value = counters.get(name, 0)
+        if isinstance(value, float):
+            value = round(value, 6)
+        metrics.append(zbxsend.Metric(
+            config['config']['zabbix']['host'],
+            sharding.shard_key(key_format, shard, metric=name), value))
+    return metrics
+
+
+def discovery_items(configinstance, datatype, shard=None):
+    """
+    Low level discovery items for every testElement reporting datatype,
+    each a copy of the testElement plus its checkname and resource_uri
+    with the keys in Zabbix {#MACRO} form.
+
+    :param configinstance:
+    :param datatype:
+    :param shard: optional sharding.Shard, only its testSets are listed
+    :return list:
+    """
+    items = []
+    for testSet, element in configinstance.get_elements_by_datatype(datatype):
+        if shard is not None and not shard.owns(testSet['key']):
+            continue
+        item = dict(element)  # the testElement itself is shared, leave it be
+        item.update({'checkname': testSet['key'],
+                     'resource_uri': testSet['data']['uri']})
+        # Apply Zabbix low level discovery formating to key names
+        #  (shift to uppercase)
+        items.append(dict(("{#" + key.upper() + "}", value)
+                          for key, value in item.iteritems()))
+    return items
+
+
+def discovery_cache_path(configinstance):
+    """
+    `config: discovery_cache_file` or the pidfile path plus .discovery,
+    None if neither is defined.
+    """
+    config = configinstance.config.get('config') or {}
+    if config.get('discovery_cache_file'):
+        return config['discovery_cache_file']
+    if config.get('pidfile'):
+        return config['pidfile'] + '.discovery'
+    return None
+
+
+def discovery_cache_key(datatype, shard=None):
+    """
+    Entry of the discovery cache holding the output for datatype.
+    """
+    if shard is None:
+        return datatype
+    return '{0}@{1}'.format(datatype, shard)
+
+
+def cached_discovery(configinstance, datatype, shard=None):
+    """
+    The discovery output rendered for datatype by an earlier run against
+    the same config version.
+
+    :param shard: optional sharding.Shard the output was rendered for
+    :return str: None if not cached
+    """
+    path = discovery_cache_path(configinstance)
+    if path is None or configinstance.version is None:
+        return None
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+        if cache['version'] != configinstance.version:
+            return None
+        return cache['datatypes'].get(discovery_cache_key(datatype, shard))
+    except (IOError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def cache_discovery(configinstance, datatype, rendered, logger, shard=None):
+    """
+    Save the discovery output for datatype, next to the output of other
+    datatypes for the same config version. A failure to write is only
+    logged, the next discover renders it again.
+
+    :param shard: optional sharding.Shard the output was rendered for
+    """
+    path = discovery_cache_path(configinstance)
+    if path is None or configinstance.version is None:
+        return False
+    cache = {'version': configinstance.version, 'datatypes': {}}
+    try:
+        with open(path) as cache_file:
+            saved = json.load(cache_file)
+        if saved['version'] == configinstance.version:
+            cache['datatypes'] = dict(saved['datatypes'])
+    except (IOError, ValueError, KeyError, TypeError, AttributeError):
+        pass  # missing, unreadable or another config version
+    cache['datatypes'][discovery_cache_key(datatype, shard)] = rendered
+
+    try:
+        commons.atomic_write(path, json.dumps(cache))
+    except (IOError, OSError) as err:
+        logger.debug("Could not write discovery cache {0}: {1}".format(
+            path, err))
+        return False
+    return True
+
+
+def discover(args, configinstance, logger, shard=None):
     """
     Perform the discovery when called upon by argparse in main()
 
+    The output for each datatype is cached on disk until the config
+    changes, see cached_discovery().
+
     :param args:
     :param configinstance:
     :param logger:
+    :param shard: optional sharding.Shard, only its testSets are listed
     :return:
     """
-    configinstance.load_yaml_file(args.config)
-    config = configinstance.load()
-
-    discover = True
     if not args.datatype:
         logging.error(
             "\nError: Invalid options\n"
@@ -235,34 +988,14 @@ def discover(args, configinstance, logger):
                 configinstance.get_datatypes_list()
             )
         )
-        discover = False
-
-    discovery_dict = {'data': []}
-
-    for testSet in config['checks']:
-        checkname = testSet['key']
-
-        uri = testSet['data']['uri']
-
-        for discoveryitem in testSet['data']['testElements']:  # For every item
-            datatypes = discoveryitem['datatype'].split(',')
-            for datatype in datatypes:  # For each datatype in testElements
-                if datatype == args.datatype:  # Only add if datatype relevant
-                    # Add more useful properties to the discovery discoveryitem
-                    discoveryitem.update(
-                        {'checkname': checkname,
-                         'resource_uri': uri}
-                    )
-
-                    # Apply Zabbix low level discovery formating to key names
-                    #  (shift to uppercase)
-                    for old_key in discoveryitem.keys():
-                        new_key = "{#" + old_key.upper() + "}"
-                        discoveryitem[new_key] = discoveryitem.pop(old_key)
-
-                    # Add this test discoveryitem to the discovery dict.
-                    logger.debug('Item discovered ' + str(discoveryitem))
-                    discovery_dict['data'].append(discoveryitem)
+        return
+
+    discovery_dict = {'data': discovery_items(configinstance, args.datatype,
+                                              shard)}
+    for discoveryitem in discovery_dict['data']:
+        logger.debug('Item discovered ' + str(discoveryitem))
+
     # Print discovery dict.
-    if discover:
-        print(json.dumps(discovery_dict, indent=3))
+    rendered = json.dumps(discovery_dict, indent=3)
+    cache_discovery(configinstance, args.datatype, rendered, logger, shard)
+    print(rendered)
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+
+__doc__ = """Replaces the cache and snapshot files url_monitor keeps in one step"""
+
+
+def atomic_write(path, data, mode=0o600):
+    """
+    Replace the file at path with data, readers see either the old or the
+    new content, never part of it. data goes to a temporary file next to
+    path which is synced and renamed over it, and removed again when
+    anything fails. Available as commons.atomic_write, configuration
+    imports it from here before commons can be.
+
+    :param path:
+    :param data: str to write
+    :param mode: permissions of the new file, only its owner can read it
+                 by default
+    :raise EnvironmentError: if it could not be written
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.url_monitor')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, mode)
+        os.rename(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
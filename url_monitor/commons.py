@@ -6,11 +6,37 @@ import requests
 from requests.auth import HTTPBasicAuth
 from requests.auth import HTTPDigestAuth
 from requests_oauthlib import OAuth1
+from requests.packages.urllib3 import connection as urllib3_connection
+from requests.packages.urllib3 import connectionpool
+from requests.packages.urllib3.util import connection as urllib3_util_connection
+import hashlib
+import io
+import multiprocessing
 import os.path
 from os import environ
+import signal
+import socket
 import subprocess
+import threading
+import time
 
+import json
+
+from atomicfile import atomic_write
 from jpath import jpath
+from jpath import jpath_document
+from jpath import jpath_stream
+from xpath import xpath
+from xpath import xpath_stream
+
+try:  # Optional, only needed by the async engine
+    import gevent.event
+    import gevent.local
+    import gevent.lock
+    import gevent.monkey
+    import gevent.pool
+except ImportError:
+    gevent = None
 
 
 def run_command(command):
@@ -26,19 +52,191 @@ def run_command(command):
     return (rc, streamdata)
 
 
-def skip_on_external_condition(logging, condition, argv):
+class ConditionCache(object):
+    """
+    Remembers what a skip_run_when condition observed, a fact's value or
+    a script's exit code and output, for its cache_ttl seconds. Entries
+    live in memory for a daemon and in an optional json file for the
+    runs that follow.
+    """
+
+    def __init__(self, path=None, logging=None):
+        """
+        :param path: json file shared between runs, None keeps entries in
+                     memory only
+        :param logging:
+        """
+        self.path = path
+        self.logging = logging
+        self.entries = None  # key -> [expires, value], read on first use
+        self.dirty = False
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = {}
+            if self.path is not None:
+                try:
+                    with open(self.path) as cache_file:
+                        self.entries = dict(json.load(cache_file))
+                except (IOError, ValueError, TypeError):
+                    pass  # missing or unreadable, observe again
+        return self.entries
+
+    def observe(self, key, ttl, observe):
+        """
+        What observe() returned for key less than ttl seconds ago, else
+        its value now.
+
+        :param key: identifies the condition, e.g. its script and fact
+        :param ttl: seconds a value stays good, 0 always calls observe()
+        :param observe: callable, returns something json can store
+        """
+        if not ttl:
+            return observe()
+        now = time.time()
+        entries = self._load()
+        entry = entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = observe()
+        entries[key] = [now + ttl, value]
+        self.dirty = True
+        return value
+
+    def save(self):
+        """
+        Write the unexpired entries to the json file if they changed.
+        """
+        if not self.dirty or self.path is None:
+            return
+        now = time.time()
+        entries = dict((key, entry) for key, entry in self.entries.items()
+                       if entry[0] > now)
+        try:
+            atomic_write(self.path, json.dumps(entries))
+            self.dirty = False
+        except (IOError, OSError) as err:
+            if self.logging is not None:
+                self.logging.debug("Could not write skip_run_when cache "
+                                   "{0}: {1}".format(self.path, err))
+
+
+class TokenCache(ConditionCache):
+    """
+    Tokens of identity providers, kept until they expire so a run doesn't
+    log in again while the last token is still good. The json file is
+    only readable by its owner (atomic_write makes it 0600), one that others
+    can read is ignored and replaced.
+    """
+
+    def __init__(self, path=None, logging=None):
+        super(TokenCache, self).__init__(path, logging)
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if self.entries is None and self.path is not None:
+            try:
+                mode = os.stat(self.path).st_mode
+            except OSError:
+                mode = 0
+            if mode & 0o077:
+                if self.logging is not None:
+                    self.logging.warning(
+                        "Ignoring token cache {0}, it is readable by other "
+                        "users".format(self.path))
+                self.entries = {}
+                self.dirty = True  # replaced by a private file on save
+        return super(TokenCache, self)._load()
+
+    def get(self, key):
+        """
+        :param key: identifies the provider and its credentials
+        :return: the token stored for key, None if missing or expired
+        """
+        with self.lock:
+            entry = self._load().get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+            return None
+
+    def put(self, key, token, expires_in):
+        """
+        Store a token and write the cache file right away.
+
+        :param key: identifies the provider and its credentials
+        :param token: anything json can store
+        :param expires_in: seconds the token stays valid
+        """
+        with self.lock:
+            self._load()[key] = [time.time() + expires_in, token]
+            self.dirty = True
+            self.save()
+
+    def discard(self, key):
+        """
+        Forget the token of key, e.g. when the API rejected it.
+        """
+        with self.lock:
+            if self._load().pop(key, None) is not None:
+                self.dirty = True
+                self.save()
+
+
+class ProviderTokens(object):
+    """
+    The token_cache given to an auth handler which declares a
+    `token_cache` attribute, its slice of a TokenCache.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def get(self):
+        """
+        :return: the cached token, None when the handler must log in
+        """
+        return self.cache.get(self.key)
+
+    def set(self, token, expires_in):
+        """
+        :param token: anything json can store
+        :param expires_in: seconds the token stays valid
+        """
+        self.cache.put(self.key, token, expires_in)
+
+    def clear(self):
+        self.cache.discard(self.key)
+
+
+def facter_fact(facter_binpath, fact):
+    """
+    Runs facter for a single fact, None if it isn't set.
+    """
+    # Without its cache the Facter client asks for this fact alone
+    # instead of collecting every fact on the host.
+    return Facter(facter_path=facter_binpath, cache_enabled=False).get(fact)
+
+
+def skip_on_external_condition(logging, condition, argv, cache=None):
     """
     Checks and skips execution if a shell command, env var, or puppet fact
     returns true if we should skip
+
+    :param cache: optional ConditionCache, facter and shell results are
+                  reused from it for the cache_ttl given as their last argv
     """
+    if cache is None:
+        cache = ConditionCache()  # in memory, and only used with a ttl
     skip_summary = ", skipping execution due to config option."
     if condition == "facter":
         facter_binpath = argv[0]
         fact_condition = argv[1]
         value_condition = argv[2]
 
-        facter = Facter(facter_path=facter_binpath)
-        real_value = facter.get(fact_condition)
+        real_value = cache.observe(
+            'facter {0} {1}'.format(facter_binpath, fact_condition), argv[3],
+            lambda: facter_fact(facter_binpath, fact_condition))
         if value_condition == real_value:
             logging.warn("Warning: {bin} value {{:{fact} => \"{val}\"}},"
                          " skipping execution due to config option.".format(
@@ -54,7 +252,8 @@ def skip_on_external_condition(logging, condition, argv):
         stdout = argv[1]
         expect_code = argv[2]
 
-        rc, data = run_command(script)
+        rc, data = cache.observe('shell {0}'.format(script), argv[3],
+                                 lambda: run_command(script))
 
         if data.strip() == stdout:
             logging.warn("Warning: shell `{sh}` stdout was"
@@ -89,6 +288,117 @@ def skip_on_external_condition(logging, condition, argv):
             return True
     return False
 
+def async_pool(size):
+    """
+    Returns a gevent pool used by the async engine to run many checks from
+    a single event loop. main() monkey patches sockets at startup (see
+    engine.patch), so the requests made by WebCaller yield to the event
+    loop while waiting on the network instead of holding a thread each.
+    """
+    if gevent is None:
+        raise ImportError("The async engine requires gevent, try "
+                          "`pip install gevent`")
+    if not gevent.monkey.is_module_patched('socket'):
+        # Not started by main(), patching this late leaves ssl and the
+        # sockets made so far blocking. Threading is left alone, the
+        # thread engine and logging rely on it.
+        gevent.monkey.patch_all(thread=False)
+    return gevent.pool.Pool(size)
+
+
+# HTTP phases timed by WebCaller.run, in the order they happen
+HTTP_PHASES = ('dns', 'connect', 'tls', 'ttfb')
+
+# Collect the phases of the request in flight on this thread, or this
+# greenlet on the async engine where checks share a thread, see
+# WebCaller.run. Connections are opened by urllib3 deep inside
+# session.get, which has no other way to hand its timings back.
+_thread_timings = threading.local()
+_greenlet_timings = gevent.local.local() if gevent is not None else None
+
+
+def _phase_timings():
+    if gevent is not None and gevent.monkey.is_module_patched('socket'):
+        return _greenlet_timings
+    return _thread_timings
+
+
+def _record_phase(phase, seconds):
+    timings = getattr(_phase_timings(), 'current', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+# The address families urllib3 connects with, IPv4 only when the host
+# has no IPv6
+_gai_family = getattr(urllib3_util_connection, 'allowed_gai_family',
+                      lambda: socket.AF_UNSPEC)
+
+
+class TimedHTTPConnection(urllib3_connection.HTTPConnection):
+    """
+    urllib3 connection which times name resolution and the TCP connect
+    separately for WebCaller.run.
+    """
+
+    def _new_conn(self):
+        # Resolve the name as create_connection will, which the stock
+        # _new_conn below then connects with, trying every address. Its
+        # own lookup is normally answered from the resolver's cache.
+        host = getattr(self, '_dns_host', self.host)  # urllib3 >= 1.22
+        started = time.time()
+        try:
+            socket.getaddrinfo(host, self.port, _gai_family(),
+                               socket.SOCK_STREAM)
+        except socket.error:
+            pass  # urllib3 raises its usual error below
+        resolved = time.time()
+        _record_phase('dns', resolved - started)
+        try:
+            return super(TimedHTTPConnection, self)._new_conn()
+        finally:
+            _record_phase('connect', time.time() - resolved)
+
+
+class TimedHTTPSConnection(urllib3_connection.HTTPSConnection,
+                           TimedHTTPConnection):
+    """
+    TimedHTTPConnection which also times the TLS handshake.
+    """
+
+    def connect(self):
+        timings = getattr(_phase_timings(), 'current', None)
+        before = 0.0
+        if timings is not None:
+            before = timings.get('dns', 0.0) + timings.get('connect', 0.0)
+        started = time.time()
+        super(TimedHTTPSConnection, self).connect()
+        if timings is not None:
+            spent = timings.get('dns', 0.0) + timings.get('connect', 0.0)
+            _record_phase('tls', time.time() - started - (spent - before))
+
+
+class TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter whose connections report their phase timings.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
 def get_hostport_tuple(dport, dhost):
     """
     Tool to take a hostport combination 'localhost:22' string
@@ -104,6 +414,18 @@ def get_hostport_tuple(dport, dhost):
         return dhost, dport
 
 
+def duration2seconds(allegedduration):
+    """
+    Turns a duration like 90, "10s", "15m" or "1h" into seconds,
+    raises ValueError if it can't.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    duration = str(allegedduration).strip().lower()
+    if duration and duration[-1] in units:
+        return float(duration[:-1]) * units[duration[-1]]
+    return float(duration)
+
+
 def string2bool(allegedstring):
     """
     Tries to return a boolean from a string input if possible,
@@ -121,19 +443,75 @@ def string2bool(allegedstring):
         return allegedstring
 
 
-def omnipath(data_object, type, element, throw_error_or_mark_none='none'):
+# response_types parsed from response.raw as they are downloaded
+STREAMED_TYPES = ('json-stream', 'xml')
+
+
+def element_path(element, type):
     """
-    Used to pull path expressions out of json or java path.
-    :param data_object:
+    The path expression of a testElement, its `xpath` for xml responses
+    else its `jsonvalue`, None if undefined.
+    :param element:
+    :param type:
+    :return:
+    """
+    if type == 'xml':
+        return element.get('xpath')
+    return element.get('jsonvalue')
+
+
+def load_document(data_object, type, elements=()):
+    """
+    Decodes a response body so omnipath can query it with parsed=True,
+    raises ValueError if the body can't be decoded.
+    :param data_object: response body, a file like object for the
+                        STREAMED_TYPES
+    :param type:
+    :param elements: testElements, STREAMED_TYPES only decode their values
+    :return:
+    """
+    if type == 'json':
+        return json.loads(data_object.strip())
+    if type in STREAMED_TYPES:
+        paths = [element_path(element, type) for element in elements]
+        paths = [path for path in paths if path is not None]
+        if type == 'xml':
+            return xpath_stream(data_object, paths)
+        return jpath_stream(data_object, paths)
+    return None
+
+
+def omnipath(data_object, type, element, throw_error_or_mark_none='none',
+             parsed=False):
+    """
+    Used to pull path expressions out of json or xml.
+    :param data_object: response body, or a document from load_document()
+                        when parsed is True
     :param type:
     :param element:
     :param throw_error_or_mark_none:
+    :param parsed:
     :return:
     """
     value = None
     if type == 'json':
         try:
-            value = jpath(data_object, element['jsonvalue'])
+            if parsed:
+                value = jpath_document(data_object, element['jsonvalue'])
+            else:
+                value = jpath(data_object, element['jsonvalue'])
+
+        except:
+            if throw_error_or_mark_none == 'none':
+                value = None
+            else:
+                raise KeyError
+    if type == 'json-stream':
+        try:
+            if parsed:  # already resolved by load_document
+                value = data_object[element['jsonvalue']]
+            else:
+                value = jpath(data_object, element['jsonvalue'])
 
         except:
             if throw_error_or_mark_none == 'none':
@@ -141,36 +519,353 @@ def omnipath(data_object, type, element, throw_error_or_mark_none='none'):
             else:
                 raise KeyError
     if type == 'xml':
-        raise NotImplementedError('Be the first to implement xpath.')
+        try:
+            if parsed:  # already resolved by load_document
+                value = data_object[element['xpath']]
+            else:
+                value = xpath(data_object, element['xpath'])
+
+        except:
+            if throw_error_or_mark_none == 'none':
+                value = None
+            else:
+                raise KeyError
 
     metric = value
     return metric
 
 
+def extract_values(data, type, elements):
+    """
+    Decodes a response body and pulls out the value of every testElement,
+    the work a ParsePool worker does. Raises ValueError like
+    load_document() if the body can't be decoded.
+    :param data: the whole response body
+    :param type:
+    :param elements: testElements
+    :return dict: element_path() -> value
+    """
+    if type in STREAMED_TYPES:
+        data = io.BytesIO(data)
+    document = load_document(data, type, elements)
+    return dict((element_path(element, type),
+                 omnipath(document, type, element, parsed=True))
+                for element in elements)
+
+
+def _ignore_interrupts():
+    # The parent stops the pool, a ^C shouldn't dump a traceback per worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ParsePool(object):
+    """
+    Worker processes decoding response bodies of at least threshold bytes,
+    so large documents are parsed on every core instead of one thread at
+    a time under the GIL. Only the extracted values are sent back.
+
+    Create it before any other thread is started, the workers are forked
+    right away and must not inherit locks held by other threads.
+    """
+
+    def __init__(self, logging, processes, threshold=1048576):
+        """
+        :param logging:
+        :param processes: number of worker processes
+        :param threshold: smallest body in bytes worth sending to a worker
+        """
+        self.logging = logging
+        self.threshold = threshold
+        self.pool = multiprocessing.Pool(processes, _ignore_interrupts)
+        self.logging.debug("Started {0} parse processes for bodies of {1} "
+                           "bytes or more".format(processes, threshold))
+
+    def offload(self, size):
+        """
+        :param size: body size in bytes, None if unknown
+        :return bool: True if a body of size should go to extract()
+        """
+        return size is not None and size >= self.threshold
+
+    def extract(self, data, type, elements):
+        """
+        extract_values() in a worker process.
+        """
+        result = self.pool.apply_async(extract_values, (data, type, elements))
+        if gevent is not None and gevent.monkey.is_module_patched('socket'):
+            # Wait from a native thread, the event loop keeps running the
+            # other checks meanwhile
+            return gevent.get_hub().threadpool.apply(result.get)
+        return result.get()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+class RegistryLock(object):
+    """
+    Reentrant lock of the session and auth registries. Checks on the async
+    engine are greenlets sharing one thread, which a threading.RLock lets
+    in together, so a gevent RLock is taken instead once the async engine
+    patched socket. Registries outlive the patching, hence the choice on
+    every acquire.
+
+    waited adds up the seconds spent waiting to acquire it, checks queue
+    up on it while another builds their session or logs in.
+    """
+
+    def __init__(self):
+        self.thread_lock = threading.RLock()
+        self.greenlet_lock = gevent.lock.RLock() if gevent is not None \
+            else None
+        self.waited = 0.0
+
+    def _lock(self):
+        if gevent is not None and gevent.monkey.is_module_patched('socket'):
+            return self.greenlet_lock
+        return self.thread_lock
+
+    def __enter__(self):
+        started = time.time()
+        self._lock().acquire()
+        self.waited += time.time() - started  # held, so no lost updates
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock().release()
+
+
+class SessionRegistry(object):
+    """
+    Keeps one requests session per (identity_provider, verify) pair for the
+    life of a run, so checks sharing credentials reuse pooled connections
+    instead of paying a new TCP and TLS handshake each.
+    """
+
+    def __init__(self, logging, pool_maxsize=10):
+        """
+        Initialize the registry.
+        pool_maxsize is the number of connections kept open per origin host.
+        """
+        self.logging = logging
+        self.pool_maxsize = pool_maxsize
+
+        self.sessions = {}
+        # One session per key, also when greenlets of the async engine
+        # ask for it together
+        self.lock = RegistryLock()
+
+    def get(self, key, spawn):
+        """
+        Returns the session registered under key, calling spawn() to create
+        and register it on first use.
+        :param key: (identity_provider, verify) tuple
+        :param spawn: callable returning a new requests.Session
+        :return requests.Session:
+        """
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = spawn()
+                adapter = TimedHTTPAdapter(pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[key] = session
+                self.logging.debug("Registered session for identity_provider"
+                                   " {0} verify={1}".format(*key))
+            return session
+
+    def close(self):
+        """
+        Close every registered session and its pooled connections.
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+class FetchGroups(object):
+    """
+    Coalesces the requests of testSets sharing a (uri, identity_provider,
+    verify) group during a run. The first testSet of a group fetches the
+    body, the others wait for it and reuse the response. A response is
+    let go once every testSet of its group took it.
+    """
+
+    def __init__(self, groups, logging=None):
+        """
+        :param groups: dict of group -> number of testSets in it, groups
+                       of one testSet are fetched as usual
+        :param logging:
+        """
+        self.groups = dict((group, count) for group, count
+                           in groups.iteritems() if count > 1)
+        self.logging = logging
+        self.lock = threading.Lock()
+        self.fetches = {}  # group -> [done event, result, testSets left]
+        self.saved = 0
+
+    def shared(self, group):
+        """
+        :return bool: True if other testSets of the run share group
+        """
+        return group in self.groups
+
+    def fetch(self, group, fetch):
+        """
+        The result of fetch() for group, called by its first testSet only.
+        A fetch() that raises is None for the rest of the group.
+
+        :param group: (uri, identity_provider, verify) tuple
+        :param fetch: callable making the request
+        """
+        with self.lock:
+            entry = self.fetches.get(group)
+            first = entry is None
+            if first:
+                entry = self.fetches[group] = [
+                    self._event(), None, self.groups[group]]
+            else:
+                self.saved += 1
+        try:
+            if first:
+                try:
+                    entry[1] = fetch()
+                finally:
+                    entry[0].set()
+            else:
+                entry[0].wait()
+                if self.logging is not None:
+                    self.logging.debug("Reused the response of {0} for "
+                                       "identity_provider {1}".format(*group))
+        finally:
+            with self.lock:
+                entry[2] -= 1
+                if entry[2] <= 0:
+                    del self.fetches[group]
+        return entry[1]
+
+    def _event(self):
+        # The async engine leaves threading unpatched, a greenlet waiting
+        # on a thread event would block the loop the fetch runs on.
+        if gevent is not None and gevent.monkey.is_module_patched('socket'):
+            return gevent.event.Event()
+        return threading.Event()
+
+
+class AuthRegistry(object):
+    """
+    Builds the auth handler of each identity provider once per process,
+    instead of importing its module and logging in again for every
+    session. A handler is rebuilt when its provider's config changes.
+
+    Handlers declaring a `token_cache` attribute get a ProviderTokens to
+    keep their token in, shared with later runs through
+    `config: token_cache_file`.
+    """
+
+    def __init__(self):
+        self.handlers = {}  # alias -> (provider config, handler)
+        self.token_caches = {}  # token_cache_file -> TokenCache
+        self.lock = RegistryLock()
+
+    def get(self, config, identity_provider, build, logging=None):
+        """
+        Returns the auth handler of identity_provider, calling build() to
+        create it on first use.
+        :param config: the loaded config
+        :param identity_provider: alias in `config: identity_providers`
+        :param build: callable returning a new requests auth handler
+        :param logging:
+        """
+        provider = config['identity_providers'].get(identity_provider)
+        with self.lock:
+            entry = self.handlers.get(identity_provider)
+            if entry is not None and entry[0] == provider:
+                return entry[1]
+            handler = build()
+            if handler is not None and hasattr(handler, 'token_cache'):
+                handler.token_cache = ProviderTokens(
+                    self._token_cache(config, logging),
+                    self._token_key(identity_provider, provider))
+            self.handlers[identity_provider] = (provider, handler)
+            return handler
+
+    def _token_cache(self, config, logging):
+        path = config.get('config', {}).get('token_cache_file')
+        cache = self.token_caches.get(path)
+        if cache is None:
+            cache = self.token_caches[path] = TokenCache(path, logging)
+        return cache
+
+    def _token_key(self, identity_provider, provider):
+        # The credentials are hashed, changing them drops the token
+        # and keeps them out of the cache file.
+        digest = hashlib.sha256(
+            json.dumps(provider, sort_keys=True, default=repr)).hexdigest()
+        return '{0} {1}'.format(identity_provider, digest[:16])
+
+    def clear(self):
+        with self.lock:
+            self.handlers = {}
+
+
+# Shared by every WebCaller of the process
+auth_handlers = AuthRegistry()
+
+
 class WebCaller(object):
     """
     Performs web functions for API's we're running check"s on
     """
 
-    def __init__(self, logging):
+    def __init__(self, logging, sessions=None):
         """
         Initialize web instance.
         Bring logging instance in.
-        Set session.auth and session_headers to none by default
+        Set session.auth to none by default, sessions is an optional
+        SessionRegistry to share sessions between checks.
         """
         self.logging = logging
+        self.sessions = sessions
 
         self.session = None
-        self.session_headers = None
+        self.timings = None
+        self.session_headers = {
+            'content-type': 'application/json',
+            'accept': 'application/json',
+            'user-agent': 'python/url_monitor (A zabbix monitoring plugin)'
+        }
 
     def auth(self, config, identity_provider):
         """
         Start a requests session with this instance.
-        This is also where we apply authentication schemes.
+        This is also where we apply authentication schemes, the handler
+        of each identity provider is built once per process.
         :param config:
         :param identity_provider:
         :return:
         """
+        self.session = requests.Session()
+        self.session.mount('http://', TimedHTTPAdapter())
+        self.session.mount('https://', TimedHTTPAdapter())
+        self.session.auth = auth_handlers.get(
+            config, identity_provider,
+            lambda: self.auth_handler(config, identity_provider),
+            self.logging)
+
+    def auth_handler(self, config, identity_provider):
+        """
+        Build the requests auth handler of an identity provider.
+        :param config:
+        :param identity_provider:
+        :return: the handler, None for the `none` provider
+        """
+        if str(identity_provider).lower() == "none":
+            return None  # declared or not, no authentication
+
         identity_providers = config['identity_providers']
         try:
             identity_provider = identity_providers[identity_provider]
@@ -186,23 +881,17 @@ class WebCaller(object):
         except TypeError:
             provider_name = "none"
 
-        self.session = requests.Session()
-        self.session_headers = {
-            'content-type': 'application/json',
-            'accept': 'application/json',
-            'user-agent': 'python/url_monitor (A zabbix monitoring plugin)'
-        }
         if provider_name == "none":
-            self.session.auth = None
+            return None
 
         elif provider_name == "httpbasicauth":
-            self.session.auth = HTTPBasicAuth(**auth_kwargs)
+            return HTTPBasicAuth(**auth_kwargs)
 
         elif provider_name == "httpdigestauth":
-            self.session.auth = HTTPDigestAuth(**auth_kwargs)
+            return HTTPDigestAuth(**auth_kwargs)
 
         elif provider_name == "oauth1":
-            self.session.auth = OAuth1(**auth_kwargs)
+            return OAuth1(**auth_kwargs)
 
         else:
             # We must assume we want to load in the format of
@@ -249,8 +938,8 @@ class WebCaller(object):
                 self.logging.exception(
                     "AttributeError: " + str(err) + str(error))
 
-            # Set the external auth handler.
-            self.session.auth = external_requests_auth_class(**auth_kwargs)
+            # Build the external auth handler.
+            handler = external_requests_auth_class(**auth_kwargs)
 
             # Filters possibly exposing kwargs from debug logs
             LOGGING_BLACKLIST = [
@@ -269,38 +958,63 @@ class WebCaller(object):
             # Debug message
             self.logging.debug("Spawn session.auth {pyobject}"
                                " with kwargs {arglst} ".format(
-                                   pyobject=self.session.auth,
+                                   pyobject=handler,
                                    arglst=filtered_kwargs
                                )
                                )
+            return handler
 
     def run(self, config, url, verify, expected_http_status, identity_provider,
-            timeout):
+            timeout, stream=False, headers=None):
         """
         Executes a http request to gather the data.
         expected_http_status can be a list of expected codes.
         :param config:
         :param url:
         :param verify:
-        :param expected_http_status:
+        :param expected_http_status: None accepts any status, for callers
+                                     checking it with expected_status()
         :param identity_provider:
         :param timeout:
+        :param stream: leave the body unread, for response.raw
+        :param headers: extra request headers, a 304 response is accepted
+                        when they make the request conditional
         :return:
+        Seconds spent in each of HTTP_PHASES are left in self.timings,
+        dns, connect and tls are 0 when a pooled connection was reused.
         """
+        request_headers = dict(self.session_headers)
+        if headers:
+            request_headers.update(headers)
 
-        self.auth(config, identity_provider)
+        if self.sessions is None:
+            self.auth(config, identity_provider)
+        else:
+            def spawn():
+                self.auth(config, identity_provider)
+                return self.session
+            self.session = self.sessions.get(
+                (identity_provider, verify), spawn)
 
+        timings = self.timings = dict.fromkeys(HTTP_PHASES, 0.0)
+        _phase_timings().current = timings
         try:
             request = self.session.get(
                 url,
-                headers=self.session_headers,
+                headers=request_headers,
                 verify=verify,
-                timeout=timeout
+                timeout=timeout,
+                stream=stream
             )
+            # elapsed runs from sending the request to parsing the headers
+            # and includes opening the connection
+            timings['ttfb'] = max(
+                request.elapsed.total_seconds() - timings['dns'] -
+                timings['connect'] - timings['tls'], 0.0)
             self.logging.debug("Spawn request {pyobject} url={url}"
                                " headers={head}".format(
                                    pyobject=request,
-                                   head=self.session_headers,
+                                   head=request_headers,
                                    url=url
                                )
                                )
@@ -316,7 +1030,28 @@ class WebCaller(object):
             err = "Unhandled requests exception occured during web_request()"
             self.logging.exception(err)
             return False
+        finally:
+            _phase_timings().current = None
+
+        if request.status_code == 304 and (
+                'If-None-Match' in request_headers or
+                'If-Modified-Since' in request_headers):
+            return request  # Not Modified, the caller has the body cached
+
+        if expected_http_status is not None and not self.expected_status(
+                request, expected_http_status):
+            request.close()
+            return False
+        return request
 
+    def expected_status(self, request, expected_http_status):
+        """
+        Checks the status of a response against ok_http_code.
+        :param request: the response
+        :param expected_http_status: comma separated codes, `any` for every
+                                     RFC 2616 code
+        :return bool:
+        """
         # Turns comma seperated string from config to a list, then lower it
         expected_codes = [c.lower() for c in expected_http_status.split(',')]
 
@@ -351,4 +1086,4 @@ class WebCaller(object):
             )
             self.logging.error(error)
             return False
-        return request
+        return True
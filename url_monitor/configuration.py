@@ -1,18 +1,47 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import cPickle as pickle
+import hashlib
 import logging
 import logging.handlers
+import os
 import socket
+import tempfile
 
 import yaml
 import sys
 import logging.handlers
-import commons
+import jpath
+import xpath
 
 import exception
+from atomicfile import atomic_write
+import sharding
 from url_monitor import package as packagemacro
 
 
+# libyaml's parser when PyYAML was built with it, it's many times faster
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Bump when the snapshot layout changes, older snapshots are then ignored
+SNAPSHOT_VERSION = 1
+
+# `config: zabbix:` key formats with a fixed set of fields, and the fields
+KEY_FORMATS = (
+    ('checksummary_key_format', ('shard',)),
+    ('timing_key_format', ('phase', 'checkname', 'uri', 'originhost')),
+    ('run_metrics_key_format', ('metric', 'shard')),
+)
+
+# response_type -> the testElement field holding its path and the compiler
+# validating it
+PATH_FIELDS = {
+    'json': ('jsonvalue', jpath.compiled_path),
+    'json-stream': ('jsonvalue', jpath.compiled_path),
+    'xml': ('xpath', xpath.compiled_path),
+}
+
+
 class baseConfig():
     """
     Base class for ConfigObject
@@ -22,31 +51,166 @@ class baseConfig():
         self.config = None
         self.checks = None
         self.constant_syslog_port = 514
+        self._model = None
+        self._skip_conditions = None
+        self.version = None  # identifies the loaded yaml file's content
 
-    def load_yaml_file(self, config=None):
+    def load_yaml_file(self, config=None, exit_on_error=True):
         """
-        Loads a yaml file as a dict
+        Loads a yaml file as a dict.
+
+        The parsed config is snapshotted with pickle (next to the yaml
+        file, or in the temp directory if that isn't writable) and later
+        runs load the snapshot instead of parsing the yaml again, for as
+        long as the file's path, mtime, size and content are unchanged.
         :param config: yaml file
+        :param exit_on_error: exit on a yaml parse error, else raise it
         :return: dict
         """
         if config == None:
             config = "/etc/url_monitor.yaml"
 
-        with open(config, 'r') as stream:
+        with open(config, 'rb') as stream:
+            source = stream.read()
+            stat = os.fstat(stream.fileno())
+        key = (SNAPSHOT_VERSION, os.path.abspath(config), stat.st_mtime,
+               stat.st_size, hashlib.sha1(source).hexdigest())
+
+        self._model = None  # re-indexed from the new config on next use
+        self._skip_conditions = None
+        self.version = hashlib.sha1(repr(key)).hexdigest()
+        self.config = self._read_snapshot(key)
+        if self.config is not None:
+            return self.config
+
+        try:
+            self.config = yaml.load(source, Loader=YAML_LOADER)
+        except yaml.YAMLError as exc:
+            if not exit_on_error:
+                raise
+            print("Exception: YAML Parse Error!\n{exc}".format(exc=exc))
+            sys.exit(1)
+        self._write_snapshot(key, self.config)
+        return self.config
+
+    def _snapshot_paths(self, key):
+        """
+        Candidate snapshot files for a config file, in order of preference.
+        """
+        path = key[1]
+        return [
+            os.path.join(os.path.dirname(path),
+                         '.' + os.path.basename(path) + '.snapshot'),
+            os.path.join(tempfile.gettempdir(), 'url_monitor-{0}-{1}'
+                         '.snapshot'.format(
+                             os.geteuid(),
+                             hashlib.sha1(path).hexdigest()[:16])),
+        ]
+
+    def _read_snapshot(self, key):
+        """
+        :return: the config saved under key, None if there is none
+        """
+        for path in self._snapshot_paths(key):
             try:
-                self.config = (yaml.load(stream))
-                return self.config
-            except yaml.YAMLError as exc:
-                print("Exception: YAML Parse Error!\n{exc}".format(exc=exc))
-                sys.exit(1)
+                with open(path, 'rb') as snapshot:
+                    stat = os.fstat(snapshot.fileno())
+                    # Unpickling runs code, only trust our own snapshots
+                    if stat.st_uid != os.geteuid() or stat.st_mode & 0o022:
+                        continue
+                    saved_key, config = pickle.load(snapshot)
+            except IOError:
+                continue
+            except Exception as err:
+                logging.debug("Ignoring config snapshot {0}: {1}".format(
+                    path, err))
+                continue
+            if saved_key == key:
+                return config
+        return None
+
+    def _write_snapshot(self, key, config):
+        """
+        Save config under key to the first writable snapshot path, a
+        failure only costs the next run a yaml parse.
+        """
+        try:
+            snapshot = pickle.dumps((key, config), pickle.HIGHEST_PROTOCOL)
+        except pickle.PicklingError as err:
+            logging.debug("Could not snapshot the config: {0}".format(err))
+            return False
+        for path in self._snapshot_paths(key):
+            try:
+                atomic_write(path, snapshot)
+                return True
+            except (IOError, OSError) as err:
+                logging.debug("Could not write config snapshot {0}: "
+                              "{1}".format(path, err))
+        return False
 
     def load(self):
         """ This is the main config load function to pull in
             configurations to convienent and common namespace.
+
+            Built once per yaml file and shared by every caller, treat
+            it as read only.
         """
-        return {'checks': self._load_checks(),
-                'config': self.raw,
-                'identity_providers': self.identity_providers}
+        return self._indexed()['loaded']
+
+    def _indexed(self):
+        """
+        The config compiled into lookup tables on first use, so getters
+        called for every check don't rebuild anything from the raw yaml.
+
+            loaded:      what load() returns
+            by_key:      testSet key -> testSet
+            by_provider: lowercased identity_provider -> tuple of testSets
+            by_datatype: datatype -> tuple of (testSet, testElement)
+            settings:    testSet key -> resolved request settings
+            invalid:     testSet key -> errors, for testSets left out of
+                         everything above
+        """
+        if self._model is not None:
+            return self._model
+
+        checks = []
+        invalid = {}
+        for testSet in self.test_sets:
+            errors = self._validate_test_set(testSet)
+            if errors:
+                invalid[testSet['key']] = errors
+            else:
+                checks.append(testSet)
+        checks = tuple(checks)
+        model = {
+            'loaded': {'checks': checks,
+                       'config': self.raw,
+                       'identity_providers': self.identity_providers},
+            'by_key': {},
+            'by_provider': {},
+            'by_datatype': {},
+            'settings': {},
+            'invalid': invalid,
+        }
+        for testSet in checks:
+            model['by_key'][testSet['key']] = testSet
+            provider = str(testSet['data']['identity_provider']).lower()
+            model['by_provider'].setdefault(provider, []).append(testSet)
+            for element in testSet['data']['testElements']:
+                datatypes = str(element['datatype']).split(',')
+                for datatype in sorted(set(datatypes), key=datatypes.index):
+                    model['by_datatype'].setdefault(datatype, []).append(
+                        (testSet, element))
+            model['settings'][testSet['key']] = {
+                'request_timeout': self._resolve_request_timeout(testSet),
+                'request_verify_ssl': self._resolve_verify_ssl(testSet),
+            }
+        for index in ('by_provider', 'by_datatype'):
+            for name, entries in model[index].items():
+                model[index][name] = tuple(entries)
+
+        self._model = model
+        return model
 
     def _load_checks(self, withIdentityProvider=None):
         """ Loads the checks for work to be run.
@@ -54,21 +218,25 @@ class baseConfig():
             checks returned by identity provider (useful for smart async
             request grouping)
         """
-        loaded_checks = []
-
         if withIdentityProvider:
-            # Useful if doing grouping async requests with a identityprovider
-            #  and then spawning async call
-            for checkdata in self.test_sets:
-                if checkdata['data'][
-                        'identity_provider'].lower() == withIdentityProvider.lower():
-                    # loaded_checks.append({'data': checkdata['data']})
-                    loaded_checks.append(checkdata)
+            return self._indexed()['by_provider'].get(
+                withIdentityProvider.lower(), ())
+        return self._indexed()['loaded']['checks']
 
-        else:
-            loaded_checks = self.test_sets
+    def get_test_set_by_key(self, key):
+        """
+        :param key: testSet name
+        :return: the testSet, None if there is no testSet by that name
+        """
+        return self._indexed()['by_key'].get(key)
 
-        return loaded_checks
+    def get_elements_by_datatype(self, datatype):
+        """
+        :param datatype:
+        :return tuple: of (testSet, testElement) for every testElement
+                       reporting datatype, in config order
+        """
+        return self._indexed()['by_datatype'].get(datatype, ())
 
     def _uniq(self, seq):
         """
@@ -162,15 +330,21 @@ class configProperties():
     def skip_conditions(self):
         """
         Returns a parsed list of skippable conditions from the configuration
-        file. This is used with the skip_run_when feature.
+        file. This is used with the skip_run_when feature. Parsed once per
+        loaded config.
 
         returns a list.
         """
+        if self._skip_conditions is None:
+            self._skip_conditions = self._parse_skip_conditions()
+        return self._skip_conditions
+
+    def _parse_skip_conditions(self):
         config = self.load()
         config = config['config']
 
         skip_conditions = []  # dict of skip conditions
-        config = config.get('skip_run_when')
+        config = config.get('skip_run_when') or {}
 
         # Skip if puppet fact exists
         facter = config.get('puppet_facter', False)
@@ -201,7 +375,8 @@ class configProperties():
                 )
 
             skip_conditions.append(
-                {"facter": (script, fact, value)}
+                {"facter": (script, fact, value,
+                            self._get_cache_ttl(facter, 'puppet_facter'))}
             )
 
         # Skip if shell output result exists
@@ -233,7 +408,8 @@ class configProperties():
                 code = int(code)
 
             skip_conditions.append(
-                {"shell": (script, stdout, code)}
+                {"shell": (script, stdout, code,
+                           self._get_cache_ttl(shell, 'shell'))}
             )
 
         # Skip if shell output result exists
@@ -274,215 +450,333 @@ class ConfigObject(baseConfig, configProperties):
 
         :return dict:
         """
-        ts = {'data': {}}
-        # get uri
-        try:
-            ts['data']['uri'] = testSet['data']['uri']
-        except KeyError as err:
-            # We're missing the uri aren't we?
-            error = ("Error: Missing {err} under testSet item {item}, "
-                     "check cannot run.").format(err=err, item=testSet['key'])
-            raise Exception("KeyError: " + str(err) + str(error))
-
-        # get ok_http_code
-        try:
-            ts['data']['ok_http_code'] = testSet['data']['ok_http_code']
-        except KeyError as err:
-            # We're missing the uri aren't we?
-            error = ("Error: Missing {err} under testSet item {item}, "
-                     "check cannot run.").format(err=err, item=testSet['key'])
-            raise Exception("KeyError: " + str(err) + str(error))
-
-        # get identity_provider
-        try:
-            ts['data']['identity_provider'] = testSet['data'][
-                'identity_provider']
-        except KeyError as err:
-            # We're missing the uri aren't we?
-            error = ("Error: Missing {err} under testSet item {item}, "
-                     "check cannot run.").format(err=err, item=testSet['key'])
-            raise Exception("KeyError: " + str(err) + str(error))
-
-        return ts
+        return {'data': {
+            'uri': testSet['data']['uri'],
+            'ok_http_code': testSet['data']['ok_http_code'],
+            'identity_provider': testSet['data']['identity_provider'],
+        }}
 
     def get_request_timeout(self, testSet):
         """
         Getter to return a requests.timeout setting.
 
+        :param testSet:   the current testset
+        :return integer:  for requests.timeout
+        :raise exception.RequiredConfigMissing: if neither the testSet nor
+                                                the config set one
+        """
+        timeout = self._indexed()['settings'][testSet['key']][
+            'request_timeout']
+        if timeout is None:
+            # Raised rather than exiting, checks run on pool workers
+            raise exception.RequiredConfigMissing(
+                "configs missing `config: request_timeout:` structure. "
+                "(Default timeout missing)")
+        return timeout
+
+    def _resolve_request_timeout(self, testSet):
+        """
         Grab local the testSet request timeout else
         defer to global setting.
 
-        :param testSet:   name of the current testset
-        :return integer:  for requests.timeout
+        :param testSet:   the current testset
+        :return float:    for requests.timeout, None if undefined
         """
-        config = self.load()
-        defined = False
-        try:
-            timeout = int(testSet['data']['request_timeout'])
-            defined = True
-        except KeyError, err:
-            err = err
-
-        try:
-            timeout = int(config['config']['request_timeout'])
-            defined = True
-        except KeyError, err:
-            err = err
+        timeout = self._request_timeout(testSet['data'])
+        if timeout is None:
+            return None
+        return float(timeout)
 
-        if not defined:
-            error = "KeyError configs missing `config: config: {err}:` "
-            "structure. (Default timeout missing) Can't continue.".format(
-                err=err
-            )
-            logging.exception(error)
-            exit(1)
-        else:
-            return timeout
+    def _request_timeout(self, data):
+        """
+        :param data: testSet settings
+        :return: the testSet's request_timeout as configured, else the
+                 global one, None if neither is set
+        """
+        timeout = data.get('request_timeout')
+        if timeout is None:
+            timeout = self.config['config'].get('request_timeout')
+        return timeout
 
     def get_verify_ssl(self, testSet):
         """
         Getter bool around require SSL within requests lib.
 
-        :param testSet:   name of the current testset
-        :return bool:
+        :param testSet:   the current testset
+        :return bool:     or path of a cert trust file
         """
-        config = self.load()
-        # SSL validation
-        defined = False
-        try:  # Use SSL local security (if available)
-            require_ssl = commons.string2bool(testSet['data'][
-                'request_verify_ssl'])
-            defined = True
-        except:
-            pass
+        return self._indexed()['settings'][testSet['key']][
+            'request_verify_ssl']
 
-        try:  # Try global setting, else require_ssl=True
-            if not defined:
-                require_ssl = commons.string2bool(
-                    config['config']['request_verify_ssl'])
-        except:
-            require_ssl = True  # No setting, secure by default.
+    def _resolve_verify_ssl(self, testSet):
+        """
+        Local testSet `request_verify_ssl`, else the global setting, else
+        True (secure by default).
 
-        return require_ssl
+        :param testSet:   the current testset
+        :return bool:     or path of a cert trust file
+        """
+        for section in (testSet['data'], self.config['config']):
+            try:
+                require_ssl = section['request_verify_ssl']
+            except (KeyError, TypeError):
+                continue
+            if isinstance(require_ssl, bool):  # yaml true/false
+                return require_ssl
+            import commons  # see get_logger
+            return commons.string2bool(str(require_ssl))
+        return True  # No setting, secure by default.
+
+    def get_concurrency(self, workers=None):
+        """
+        Getter for the number of testSets to run at once.
 
-    def datatypes_valid(self, check):
+        The --workers flag wins over `config: concurrency:`, if neither
+        is defined checks run one at a time.
+
+        :param workers:   command line override
+        :return integer:  size of the worker pool
+        """
+        try:
+            if workers is None:
+                workers = self.config['config']['concurrency']
+            workers = int(workers)
+        except KeyError:
+            workers = 1
+        except ValueError as err:
+            logging.error("Error: `concurrency` must be a whole number, "
+                          "{err}. Running checks one at a time.".format(
+                              err=err))
+            workers = 1
+        return max(workers, 1)
+
+    def get_daemon_interval(self):
         """
-        Lints datatypes out of the config file.
+        Getter for the seconds between execution summaries in daemon mode,
+        also the default testSet interval. `config: daemon: interval:` or
+        60 if undefined.
 
-        Return true if datatypes ok,
-        false if warnings occured.
+        :return float:
+        """
+        return self._get_duration(
+            self.config['config'].get('daemon'), 'interval', 60.0,
+            "daemon: interval")
 
-        :return str:
+    def get_interval(self, testSet):
         """
+        Getter for the seconds between two runs of a testSet in daemon mode.
+        Local testSet `interval:` else the daemon interval.
 
-        exception_string = (
-            "Error: Missing {error} under testSet item {test_set}, "
-            "check has been skipped."
-        )
-        for testSet in self._load_checks():
-            checkname = testSet['key']
-            if checkname == check:
-                try:
-                    uri = testSet['data']['uri']
-                except KeyError as err:
-                    error = exception_string.format(
-                        error=err,
-                        test_set=testSet['key']
-                    )
-                    logging.error("KeyError: " + str(err) + str(error))
-                    return False
+        :param testSet:
+        :return float:
+        """
+        return self._get_duration(
+            testSet['data'], 'interval', self.get_daemon_interval(),
+            "testSet: {0}: interval".format(testSet['key']))
 
-                try:
-                    testSet['data']['testElements']
-                except KeyError as err:
-                    error = exception_string.format(
-                        error=err,
-                        test_set=testSet['key']
-                    )
-                    logging.error("KeyError: " + str(err) + str(error))
-                    return False
-
-                for element in testSet['data']['testElements']:  # for every element
-                    try:
-                        datatypes = element['datatype'].split(',')
-                    except KeyError as err:
-                        error = exception_string.format(
-                            error=err,
-                            test_set=testSet['key']
-                        )
-                        logging.error("KeyError: " + str(err) + str(error))
-                        return False
-
-                    try:
-                        datatypes = element['response_type']
-                    except KeyError as err:
-                        error = exception_string.format(
-                            error=err,
-                            test_set=testSet['key']
-                        )
-                        logging.error("KeyError: " + str(err) + str(error))
-                        return False
-
-                    try:
-                        datatypes = element['key']
-                    except KeyError as err:
-                        error = exception_string.format(
-                            error=err,
-                            test_set=testSet['key']
-                        )
-                        logging.error("KeyError: " + str(err) + str(error))
-                        return False
-
-        return True
+    def get_jitter(self, testSet):
+        """
+        Getter for the most seconds a testSet run may be delayed by in
+        daemon mode, to spread checks on the same host. Local testSet
+        `jitter:` else `config: daemon: jitter:` else 0.
 
-    def get_datatypes_list(self):
+        :param testSet:
+        :return float:
         """
-        Used by the discover command to identify a list of valid datatypes
+        default = self._get_duration(
+            self.config['config'].get('daemon'), 'jitter', 0.0,
+            "daemon: jitter")
+        return self._get_duration(
+            testSet['data'], 'jitter', default,
+            "testSet: {0}: jitter".format(testSet['key']))
+
+    def _get_cache_ttl(self, condition, name):
+        """
+        Seconds the result of a skip_run_when condition is reused for, its
+        `cache_ttl:` or 0 to evaluate it every time.
+        """
+        return self._get_duration(condition, 'cache_ttl', 0.0,
+                                  "skip_run_when: {0}: cache_ttl".format(name))
 
-        :return str:
+    def _get_duration(self, section, key, default, name):
+        """
+        Reads a duration like 90, "10s", "15m" or "1h" from section[key] as
+        seconds, default if undefined or invalid.
         """
-        exception_string = (
-            "Error: Missing {error} under testSet item {test_set}, "
-            "discover cannot run."
-        )
+        try:
+            import commons  # see get_logger
+            seconds = commons.duration2seconds(section[key])
+        except (KeyError, TypeError):
+            return default
+        except ValueError as err:
+            logging.error("Error: `{name}` must be a duration like 30, 10s, "
+                          "15m or 1h, {err}. Using {default}.".format(
+                              name=name, err=err, default=default))
+            return default
+        if seconds <= 0 and key == 'interval':
+            logging.error("Error: `{name}` must be positive. Using "
+                          "{default}.".format(name=name, default=default))
+            return default
+        return max(seconds, 0.0)
+
+    def get_pool_maxsize(self, workers=1):
+        """
+        Getter for the number of connections pooled per origin host.
 
-        possible_datatypes = []
-        for testSet in self._load_checks():
-            checkname = testSet['key']
-            try:
-                uri = testSet['data']['uri']
-            except KeyError as err:
-                error = exception_string.format(
-                    error=err,
-                    test_set=testSet['key']
-                )
-                raise Exception("KeyError: " + str(err) + str(error))
-                return 1
+        Uses `config: pool_maxsize:` if defined, else enough connections
+        for every worker to hit the same host at once (at least 10).
+
+        :param workers:   number of checks running at once
+        :return integer:  for requests.adapters.HTTPAdapter pool_maxsize
+        """
+        try:
+            return max(int(self.config['config']['pool_maxsize']), 1)
+        except KeyError:
+            return max(workers, 10)
+        except ValueError as err:
+            logging.error("Error: `pool_maxsize` must be a whole number, "
+                          "{err}.".format(err=err))
+            return max(workers, 10)
+
+    def get_engine(self, engine=None):
+        """
+        Getter for the HTTP engine used to run checks.
+
+        The --engine flag wins over `config: engine:`, `thread` is the
+        default. `async` runs every check from one gevent event loop.
+
+        :param engine:   command line override
+        :return str:     `thread` or `async`
+        """
+        if engine is None:
+            engine = self.config['config'].get('engine', 'thread')
+        engine = str(engine).lower()
+        if engine not in ('thread', 'async'):
+            logging.error("Error: unknown `engine` {engine}, expected thread"
+                          " or async. Using thread.".format(engine=engine))
+            engine = 'thread'
+        return engine
+
+    def get_shard(self, shard=None):
+        """
+        Getter for the share of the testSets this node runs.
+
+        The --shard flag wins over `config: shard:`, both INDEX/COUNT.
+        Every testSet runs when neither is defined.
+
+        :param shard:   command line override
+        :return sharding.Shard: None if not sharded
+        """
+        if shard is None:
+            shard = self.config['config'].get('shard')
+        if shard is None:
+            return None
+        try:
+            return sharding.parse_shard(shard)
+        except ValueError as err:
+            logging.error("Error: {err}. EXECUTION STOP.".format(err=err))
+            exit(1)
 
+    def get_invalid_test_sets(self):
+        """
+        testSets which failed validation at load, they are left out of
+        load() and every index, so they never run.
+
+        :return dict: testSet key -> list of error strings
+        """
+        return self._indexed()['invalid']
+
+    def _validate_test_set(self, testSet):
+        """
+        Checks everything a check needs from a testSet up front, so the
+        check itself does no validation.
+
+        :param testSet:
+        :return list: error strings, empty if the testSet is valid
+        """
+        data = testSet['data']
+        if not isinstance(data, dict):
+            return ["must be a mapping of settings"]
+
+        errors = []
+        for name in ('uri', 'ok_http_code', 'identity_provider',
+                     'response_type', 'testElements'):
+            if data.get(name) is None:
+                errors.append("missing `{0}`".format(name))
+
+        provider = data.get('identity_provider')
+        if provider is not None and str(provider).lower() != 'none' and \
+                provider not in (self.config['config'].get(
+                    'identity_providers') or {}):
+            errors.append("identity_provider `{0}` is not declared in "
+                          "`config: identity_providers`".format(provider))
+
+        response_type = data.get('response_type')
+        if response_type is not None and response_type not in PATH_FIELDS:
+            errors.append("unsupported response_type `{0}`, use one of "
+                          "{1}".format(response_type,
+                                       ', '.join(sorted(PATH_FIELDS))))
+
+        timeout = self._request_timeout(data)
+        if timeout is None:
+            errors.append("missing `request_timeout`, set it on the testSet "
+                          "or in `config:`")
+        else:
+            try:
+                positive = not isinstance(timeout, bool) and float(timeout) > 0
+            except (TypeError, ValueError):
+                positive = False
+            if not positive:
+                errors.append("`request_timeout` must be a positive number "
+                              "of seconds, not {0!r}".format(timeout))
+
+        elements = data.get('testElements')
+        if elements is None:
+            return errors
+        if not isinstance(elements, list) or not elements:
+            return errors + ["`testElements` must be a list of testElements"]
+
+        key_format = (self.config['config'].get('zabbix') or {}).get(
+            'item_key_format')
+        path_field, compiler = PATH_FIELDS.get(response_type, (None, None))
+        for position, element in enumerate(elements):
+            where = "testElements[{0}]".format(position)
+            if not isinstance(element, dict):
+                errors.append("{0} must be a mapping".format(where))
+                continue
+            for name in ('key', 'datatype'):
+                if element.get(name) is None:
+                    errors.append("{0} missing `{1}`".format(where, name))
+            if compiler is not None:
+                try:
+                    compiler(element[path_field])
+                except KeyError:
+                    errors.append("{0} missing `{1}`".format(
+                        where, path_field))
+                except (ValueError, AttributeError) as err:
+                    errors.append("{0} invalid {1}: {2}".format(
+                        where, path_field, err))
+            # Fields check() adds before formatting the zabbix key
+            fields = dict(element, datatype='', api_response='',
+                          request_statuscode='', uri='', originhost='')
             try:
-                testSet['data']['testElements']
+                if key_format is not None:
+                    key_format.format(**fields)
             except KeyError as err:
-                error = exception_string.format(
-                    error=err,
-                    test_set=testSet['key']
-                )
-                logging.error("KeyError: " + str(err) + str(error))
-                return 1
+                errors.append("{0} has no {1} for `item_key_format`".format(
+                    where, err))
+            except (IndexError, ValueError) as err:
+                errors.append("{0} can't be formatted with "
+                              "`item_key_format`: {1}".format(where, err))
+        return errors
 
-            for element in testSet['data']['testElements']:  # for every element
-                try:
-                    datatypes = element['datatype'].split(',')
-                except KeyError as err:
-                    error = exception_string.format(
-                        error=err,
-                        test_set=testSet['key']
-                    )
-                    raise Exception("KeyError: " + str(err) + str(error))
-                    return 1
-                for datatype in datatypes:
-                    possible_datatypes.append(datatype)
-
-        return str(self._uniq(possible_datatypes))
+    def get_datatypes_list(self):
+        """
+        Used by the discover command to identify a list of valid datatypes
+
+        :return str:
+        """
+        return str(sorted(self._indexed()['by_datatype']))
 
     def get_log_level(self, debug_level=None):
         """
@@ -589,6 +883,9 @@ class ConfigObject(baseConfig, configProperties):
                 )
                 logging.exception(error)
                 exit(1)
+            # Imported here rather than with the module, engine.py loads
+            # the config before gevent may patch what commons imports
+            import commons
             sysloghost = commons.get_hostport_tuple(
                 dport=self.constant_syslog_port,
                 dhost=self.config['config']['logging']['syslog']['server']
@@ -628,86 +925,85 @@ class ConfigObject(baseConfig, configProperties):
         self.logger.info("Logger initialized.")
         return self.logger
 
-    def pre_flight_check(self):
-        """ 
-        Trys loading all the config objects for zabbix conf. This can be
-        expanded to do all syntax checking in this config class, instead of 
-        in the program logic as it is mostly right now.
-
-        It is a check class. This should NOT be used for program references.
-        (Doesnt use logger for exceptions as it pre-dates logger
-        instanciation.)
+    def _validate_config(self):
         """
-        # Ensure pidfile defined
-        try:
-            self.config['config']['pidfile']
-        except KeyError:
-            logging.error("Error: `pidfile` not defined in yaml config")
-            exit(1)
+        Checks the settings every run needs, outside of the testSets.
 
-        # Ensure base config elements exist.
-        try:
-            self.config['config']
-        except KeyError, err:
-            error = "KeyError configs missing `zabbix: {key}` structure."
-            " Can't continue.".format(
-                key=err
-            )
-            logging.exception(error)
-            exit(1)
+        :return list: error strings, empty if the config is usable
+        """
+        config = self.config.get('config') if isinstance(
+            self.config, dict) else None
+        if not isinstance(config, dict):
+            return ["missing `config:` structure"]
+
+        errors = []
+        if not config.get('pidfile'):
+            errors.append("`pidfile` not defined in yaml config")
+
+        zabbix = config.get('zabbix')
+        if not isinstance(zabbix, dict):
+            errors.append("missing `config: zabbix:` structure")
+        else:
+            for name in ('server', 'host', 'item_key_format',
+                         'checksummary_key_format'):
+                if zabbix.get(name) is None:
+                    errors.append("missing `config: zabbix: {0}:`".format(
+                        name))
+            for name, fields in KEY_FORMATS:
+                if zabbix.get(name) is None:
+                    continue
+                try:
+                    str(zabbix[name]).format(**dict.fromkeys(fields, ''))
+                except (KeyError, IndexError, ValueError) as err:
+                    errors.append(
+                        "`config: zabbix: {0}:` can only use {1}: "
+                        "{2!r}".format(name, ', '.join(
+                            '{%s}' % field for field in fields), err))
+
+        if config.get('shard') is not None:
+            try:
+                sharding.parse_shard(config['shard'])
+            except ValueError as err:
+                errors.append("`config: shard:` {0}".format(err))
 
-        try:
-            self.config['config']['zabbix']
-        except KeyError, err:
-            error = "KeyError configs missing `zabbix: {key}` structure."
-            " Can't continue.".format(
-                key=err
-            )
-            logging.exception(error)
-            exit(1)
+        providers = config.get('identity_providers')
+        if not isinstance(providers, dict):
+            errors.append("missing `config: identity_providers:` structure")
+        else:
+            for alias, provider in providers.iteritems():
+                if not isinstance(provider, dict) or len(provider) != 1 or \
+                        not isinstance(provider.values()[0], dict):
+                    errors.append(
+                        "`config: identity_providers: {0}:` must map one "
+                        "auth module to its kwargs".format(alias))
 
-        try:
-            self.config['config']['zabbix']['server']
-            self.config['config']['zabbix']['host']
-            self.config['config']['zabbix']['item_key_format']
-            self.config['config']['zabbix']['checksummary_key_format']
-        except KeyError, err:
-            error = "KeyError configs missing `config: zabbix: {key}:`"
-            " structure. Can't continue.".format(
-                key=err
-            )
-            logging.exception(error)
-            exit(1)
+        if not isinstance(self.config.get('testSet'), dict):
+            errors.append("missing `testSet:` structure")
+        return errors
 
-        # Ensure identity items exist
-        try:
-            self.config['config']['identity_providers']
-        except KeyError, err:
-            error = "KeyError configs missing `config: config: {key}:`"
-            " structure. (Identity Providers) Can't continue.".format(
-                key=err)
-            logging.exception(error)
-            exit(1)
+    def pre_flight_check(self):
+        """
+        Validates the whole config once. Errors outside of the testSets
+        stop the run, each broken testSet is reported and skipped.
 
-        try:
-            for provider in self.identity_providers:
-                provider
-        except AttributeError, err:
-            error = "KeyError configs missing {key} structure in `config: "
-            "identity_providers`. Can't continue.".format(
-                key=err)
-            logging.exception(error)
+        It is a check class. This should NOT be used for program references.
+        """
+        errors = self._validate_config()
+        for error in errors:
+            self.logger.error("Error: {0}. Can't continue.".format(error))
+        if errors:
             exit(1)
 
-        for provider in self.identity_providers:
-            provider
-            for module, kwargs in self.config['config'][
-                    'identity_providers'][provider].iteritems():
-                module.split('/')
-                for kwarg in kwargs:
-                    kwarg
-
-        self.logger.info("Pre-flight config test OK")
+        invalid = self.get_invalid_test_sets()
+        for key, errors in sorted(invalid.items()):
+            for error in errors:
+                self.logger.error("Error: testSet {0}: {1}, check has been "
+                                  "skipped.".format(key, error))
+        if invalid:
+            self.logger.warning("Pre-flight config test skipped {0} "
+                                "testSets".format(len(invalid)))
+        else:
+            self.logger.info("Pre-flight config test OK")
 
 
 if __name__ == "__main__":
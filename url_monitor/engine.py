@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+
+import yaml
+
+__doc__ = """Sets up the HTTP engine before the rest of url_monitor is imported"""
+
+
+class _ArgumentParser(argparse.ArgumentParser):
+    # main() reports bad arguments, don't exit before it gets to
+    def error(self, message):
+        raise ValueError(message)
+
+
+def requested_engine(arguments):
+    """
+    The engine a command line asks for, with --engine or else with
+    `config: engine:` in the config file it names. Only the config module
+    is imported to read it, and the config is snapshotted as usual.
+
+    :param arguments: command line arguments, without the program name
+    :return str: the engine, None if not set or it can't tell
+    """
+    parser = _ArgumentParser(add_help=False)
+    parser.add_argument('-e', '--engine')
+    parser.add_argument('-c', '--config')
+    try:
+        flags = parser.parse_known_args(arguments)[0]
+    except ValueError:
+        return None
+    if flags.engine is not None:
+        return flags.engine
+
+    import configuration
+    configinstance = configuration.ConfigObject()
+    try:
+        config = configinstance.load_yaml_file(flags.config,
+                                               exit_on_error=False)
+        return config['config'].get('engine')
+    except (EnvironmentError, yaml.YAMLError, KeyError, TypeError,
+            AttributeError):
+        return None  # main() reports what is wrong with the config
+
+
+def patch(engine):
+    """
+    Monkey patch the standard library for gevent when engine is `async`.
+    This has to happen before ssl, socket users such as requests, and any
+    thread are started, main() calls it before importing anything else.
+    threading is left alone, logging and the thread pools rely on it.
+
+    :param engine: `thread` or `async`
+    :return bool: True if patched
+    """
+    if str(engine).lower() != 'async':
+        return False
+    try:
+        import gevent.monkey
+    except ImportError:
+        return False  # commons.async_pool explains when a check runs
+    if not gevent.monkey.is_module_patched('socket'):
+        gevent.monkey.patch_all(thread=False)
+    return True
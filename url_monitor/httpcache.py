@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+
+from atomicfile import atomic_write
+
+__doc__ = """File backed cache of conditional GET validators and the values
+extracted from the response they validate"""
+
+
+class ResponseCache(object):
+    """
+    Remembers the ETag / Last-Modified validators of each testSet's last
+    response together with the testElement values pulled out of it, so a
+    `304 Not Modified` can reuse those values without downloading or
+    parsing the body again.
+
+    Entries are keyed by testSet key and are only used while the uri and
+    the testElement paths are unchanged. The cache is read once when
+    created and written back by save(), keeping the max_entries most
+    recently used entries.
+    """
+
+    def __init__(self, path, max_entries=1000, logger=None):
+        """
+        :param path: file the cache is persisted to
+        :param max_entries: entries kept by save(), least recently used
+                            entries are evicted first
+        :param logger:
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        self.hits = 0
+        self.load()
+
+    def load(self):
+        """
+        Read the cache file, a missing or unreadable file is an empty cache.
+        """
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+            if not isinstance(entries, dict):
+                raise ValueError("not a json object")
+        except IOError:
+            entries = {}
+        except ValueError as err:
+            self.logger.warning("Ignoring unreadable response cache {0}: "
+                                "{1}".format(self.path, err))
+            entries = {}
+        with self.lock:
+            self.entries = entries
+
+    def _entry(self, key, uri, paths):
+        """
+        :return: the entry for key if it still matches uri and paths
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.get('uri') != uri or not all(
+                path in entry.get('values', {}) for path in paths):
+            return None
+        return entry
+
+    def headers(self, key, uri, paths):
+        """
+        Conditional request headers for the next request of a testSet.
+
+        :param key: testSet key
+        :param uri:
+        :param paths: jsonvalue paths of the testSet's testElements
+        :return dict: empty when there is nothing usable cached
+        """
+        headers = {}
+        with self.lock:
+            entry = self._entry(key, uri, paths)
+            if entry is not None:
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def values(self, key, uri, paths):
+        """
+        The values cached for a testSet, after its request returned 304.
+
+        :return dict: path -> value, None if nothing usable is cached
+        """
+        with self.lock:
+            entry = self._entry(key, uri, paths)
+            if entry is None:
+                return None
+            entry['used'] = time.time()
+            self.changed = True
+            self.hits += 1
+            return dict(entry['values'])
+
+    def store(self, key, uri, response, values):
+        """
+        Remember the values extracted from a 200 response, if the response
+        carries any validator. Anything cached for key is dropped otherwise.
+
+        :param key: testSet key
+        :param uri:
+        :param response: requests.Response
+        :param values: dict of path -> value, must be json serializable
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with self.lock:
+            if not (etag or last_modified):
+                if self.entries.pop(key, None) is not None:
+                    self.changed = True
+                return
+            self.entries[key] = {
+                'uri': uri,
+                'etag': etag,
+                'last_modified': last_modified,
+                'values': values,
+                'used': time.time(),
+            }
+            self.changed = True
+
+    def forget(self, key):
+        """
+        Drop anything cached for a testSet.
+        """
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.changed = True
+
+    def save(self):
+        """
+        Evict least recently used entries beyond max_entries and write the
+        cache file, atomically so an interrupted run can't corrupt it.
+
+        :return bool: False if the file could not be written
+        """
+        with self.lock:
+            if not self.changed:
+                return True
+            if len(self.entries) > self.max_entries:
+                keep = sorted(self.entries,
+                              key=lambda key: self.entries[key].get('used', 0),
+                              reverse=True)[:self.max_entries]
+                self.entries = dict(
+                    (key, self.entries[key]) for key in keep)
+            try:
+                atomic_write(self.path, json.dumps(self.entries))
+            except (IOError, OSError, TypeError, ValueError) as err:
+                self.logger.error("Could not write response cache {0}: "
+                                  "{1}".format(self.path, err))
+                return False
+            self.changed = False
+            return True
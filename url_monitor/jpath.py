@@ -1,11 +1,21 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import decimal
 import json
 
+try:  # Optional, only needed for response_type json-stream
+    import ijson
+    from ijson.common import JSONError, ObjectBuilder
+except ImportError:
+    ijson = None
+
 PATH_SEPARATOR = '/'
 CURRENT_NODE = '.'
 LIST_INDEX_INDICATORS = ('[', ']')
 
+# path string -> compiled steps, filled by compiled_path()
+_compiled_paths = {}
+
 
 def jpath(json_str, path, throw_error_or_mark_none='none'):
     """
@@ -16,19 +26,82 @@ def jpath(json_str, path, throw_error_or_mark_none='none'):
     :return:
     """
     value = json.loads(json_str.strip())
+    return jpath_document(value, path, throw_error_or_mark_none)
+
+
+def jpath_document(document, path, throw_error_or_mark_none='none'):
+    """
+    Same as jpath() but walks an already decoded json document, so a
+    response can be parsed once and queried many times.
+
+    :param document:
+    :param path:
+    :param throw_error_or_mark_none:
+    :return:
+    """
+    return jpath_compiled(document, compiled_path(path),
+                          throw_error_or_mark_none)
+
+
+def compile_path(path):
+    """
+    Turns a path like ./key/list[0]/key into a tuple of (key, index) steps
+    which jpath_compiled() walks without any string work.
+    Raises ValueError if the path can't be compiled.
 
+    :param path:
+    :return tuple:
+    """
     path_list = path.split(PATH_SEPARATOR)
     if path_list and path_list[0] == CURRENT_NODE:
         path_list = path_list[1:]
 
+    steps = []
     for key in path_list:
+        if not key:
+            raise ValueError("Empty element in path {0!r}".format(path))
+
         index = None
         if key[-1] == LIST_INDEX_INDICATORS[1]:
             left_indicator = key.rfind(LIST_INDEX_INDICATORS[0])
             if left_indicator > -1:
-                index = int(key[left_indicator + 1:-1])
+                try:
+                    index = int(key[left_indicator + 1:-1])
+                except ValueError:
+                    raise ValueError("Invalid list index {0!r} in path "
+                                     "{1!r}".format(key, path))
                 key = key[:left_indicator]
+        steps.append((key, index))
+
+    return tuple(steps)
+
+
+def compiled_path(path):
+    """
+    Returns the compiled steps for path, compiling it on first use.
+
+    :param path:
+    :return tuple:
+    """
+    try:
+        return _compiled_paths[path]
+    except KeyError:
+        steps = _compiled_paths[path] = compile_path(path)
+        return steps
+
 
+def jpath_compiled(document, steps, throw_error_or_mark_none='none'):
+    """
+    Walks a decoded json document with steps from compile_path().
+
+    :param document:
+    :param steps:
+    :param throw_error_or_mark_none:
+    :return:
+    """
+    value = document
+
+    for key, index in steps:
         if key not in value:
             if throw_error_or_mark_none == 'none':
                 value = None
@@ -50,3 +123,111 @@ def jpath(json_str, path, throw_error_or_mark_none='none'):
             break
 
     return value
+
+
+def jpath_stream(stream, paths):
+    """
+    Resolves paths from a json document read incrementally from stream, a
+    file like object. Only the values at paths are ever built in memory,
+    and reading stops as soon as every path has been resolved.
+    Raises ValueError if the document is malformed before that point.
+
+    :param stream:
+    :param paths: list of path strings
+    :return dict: path -> value, None for paths not in the document
+    """
+    if ijson is None:
+        raise ImportError("response_type json-stream requires ijson, try "
+                          "`pip install ijson`")
+
+    values = dict.fromkeys(paths)
+    wanted = {}  # flattened steps -> paths resolving to them
+    for path in paths:
+        location = []
+        for key, index in compiled_path(path):
+            location.append(key)
+            if index is not None:
+                location.append(index)
+        wanted.setdefault(tuple(location), []).append(path)
+    if not wanted:
+        return values
+
+    stack = []  # [key in map or index in array, is_array] per open container
+    builder = None  # collects a wanted map or array
+    try:
+        for event, value in ijson.basic_parse(stream):
+            if builder is not None:
+                builder.event(event, value)
+                if event in ('start_map', 'start_array'):
+                    depth += 1
+                elif event in ('end_map', 'end_array'):
+                    depth -= 1
+                if depth == 0:
+                    if _resolve(values, wanted, location, builder.value):
+                        break
+                    builder = None
+                continue
+
+            if event == 'map_key':
+                stack[-1][0] = value
+                continue
+            if event in ('end_map', 'end_array'):
+                stack.pop()
+                continue
+
+            # Anything else starts a value, in an array that's the next index
+            if stack and stack[-1][1]:
+                stack[-1][0] += 1
+            location = tuple(frame[0] for frame in stack)
+            if location in wanted:
+                if event in ('start_map', 'start_array'):
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                    depth = 1
+                    continue
+                if _resolve(values, wanted, location, value):
+                    break
+            if event == 'start_map':
+                stack.append([None, False])
+            elif event == 'start_array':
+                stack.append([-1, True])
+    except JSONError as err:
+        raise ValueError(str(err))
+    return values
+
+
+def _resolve(values, wanted, location, value):
+    """
+    Record value for every path at location, and for paths below it when
+    value is a map or array.
+    :return: True once every wanted location has been resolved
+    """
+    value = _undecimal(value)
+    for path in wanted.pop(location):
+        values[path] = value
+    if isinstance(value, (dict, list)):
+        for below in [other for other in wanted
+                      if other[:len(location)] == location]:
+            found = value
+            for step in below[len(location):]:
+                try:
+                    found = found[step]
+                except (KeyError, IndexError, TypeError):
+                    found = None
+                    break
+            for path in wanted.pop(below):
+                values[path] = found
+    return not wanted
+
+
+def _undecimal(value):
+    """
+    ijson reads non integer numbers as Decimal, json.loads as float.
+    """
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, list):
+        return [_undecimal(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _undecimal(item)) for key, item in value.items())
+    return value
@@ -8,11 +8,21 @@ import logging
 import os
 import sys
 import textwrap
+import time
 from exception import PidlockConflict
 
+# gevent has to patch the standard library before requests, ssl and the
+# url_monitor modules using them are imported, and before any thread
+import engine
+engine.patch(engine.requested_engine(sys.argv[1:]))
+
 import action
 import commons
 import configuration
+import profiling
+import scheduler
+import service
+import sharding
 
 import zbxsend as event
 from zbxsend import Metric
@@ -49,6 +59,7 @@ def main(arguments=None):
     :param arguments:
     :return:
     """
+    started = time.time()
     try:
         if arguments is None:  # __name__=__main__
             arguments = sys.argv[1:]
@@ -91,6 +102,22 @@ def main(arguments=None):
         " the config that have a particular datatype. This data is used by"
         " low level discovery in Zabbix."
     )
+    arg_parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="Optional with `check` command. Number of testSets to run "
+        "concurrently, overrides `config: concurrency:` (default 1)."
+    )
+    arg_parser.add_argument(
+        "--engine",
+        "-e",
+        choices=['thread', 'async'],
+        default=None,
+        help="Optional with `check` command. HTTP engine to run checks with,"
+        " overrides `config: engine:` (default thread). async needs gevent."
+    )
     arg_parser.add_argument(
         "-c",
         "--config",
@@ -104,12 +131,88 @@ def main(arguments=None):
         help="Specify custom loglevel override. Available options [debug,"
         " info, wrna, critical, error, exceptions]"
     )
+    arg_parser.add_argument(
+        "--shard",
+        metavar="INDEX/COUNT",
+        default=None,
+        help="Optional with `check`, `daemon` and `discover` commands. Only "
+        "run the testSets of shard INDEX out of COUNT nodes, e.g. 2/3, "
+        "overrides `config: shard:`."
+    )
+    arg_parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        default=None,
+        help="Optional with `check`, `discover` and `daemon` commands. "
+        "Writes a cProfile pstats file of the run to DIR (of every summary "
+        "interval with `daemon`). With `profile-report`, the directory to "
+        "summarize."
+    )
+    arg_parser.add_argument(
+        "--profile-checks",
+        action='store_true',
+        help="Optional with --profile. Also write a pstats file per testSet."
+    )
+    arg_parser.add_argument(
+        "--last",
+        type=int,
+        default=10,
+        help="Optional with `profile-report` command. Number of the most "
+        "recent profiles to add up (default 10)."
+    )
+    arg_parser.add_argument(
+        "--top",
+        type=int,
+        default=25,
+        help="Optional with `profile-report` command. Number of functions "
+        "to list (default 25). Use --key to report on a testSet's profiles."
+    )
 
     inputflag = arg_parser.parse_args(args=arguments)
 
+    if inputflag.COMMAND == "profile-report":
+        if not inputflag.profile:
+            logging.error("profile-report needs --profile DIR.")
+            sys.exit(1)
+        sys.exit(profiling.report(inputflag.profile, inputflag.last,
+                                  inputflag.top, inputflag.key))
+
+    profiler = None
+    if inputflag.profile:
+        profiler = profiling.Profiler(inputflag.profile,
+                                      checks=inputflag.profile_checks)
+        profiler.start()
+    try:
+        run_command(inputflag, started, profiler)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+
+def run_command(inputflag, started, profiler=None):
+    """
+    Runs the check, daemon or discover command.
+
+    :param inputflag: parsed arguments
+    :param started: time the program started
+    :param profiler: optional profiling.Profiler of the run
+    :return:
+    """
     configinstance = configuration.ConfigObject()
     configinstance.load_yaml_file(inputflag.config)
     logger = configinstance.get_logger(inputflag.loglevel)
+    if profiler is not None:
+        profiler.logger = logger
+    shard = configinstance.get_shard(inputflag.shard)
+
+    if inputflag.COMMAND == "discover" and inputflag.datatype:
+        # Rendered by an earlier discover of this same config, which
+        # passed the pre-flight check then
+        discovery = action.cached_discovery(configinstance, inputflag.datatype,
+                                            shard)
+        if discovery is not None:
+            print(discovery)
+            return
 
     configinstance.pre_flight_check()
     config = configinstance.load()
@@ -119,18 +222,13 @@ def main(arguments=None):
 
     # skip if skip conditions exist (for standby nodes)
     conditional_skip_queue = configinstance.skip_conditions
-    if inputflag.COMMAND == "discover":
-        conditional_skip_queue = []  # no need to disable this
-    if len(conditional_skip_queue) > 0:
-        logger.info("Checking {0} standby conditions to see if test execution"
-                    " should skip.".format(len(conditional_skip_queue)))
-    for test in conditional_skip_queue:
-        for condition, condition_args in test.items():
-            if commons.skip_on_external_condition(
-                    logger, condition, condition_args):
-                exit(0)
+    if inputflag.COMMAND in ("discover", "daemon"):
+        conditional_skip_queue = []  # daemon checks them every cycle
+    skip_cache = action.conditionfacade(config, logger)
+    if skip_requested(conditional_skip_queue, logger, skip_cache):
+        exit(0)
 
-    if inputflag.COMMAND == "check":
+    if inputflag.COMMAND in ("check", "daemon"):
         try:
             lock = lockfile.FileLock(config['config']['pidfile'])
         except lockfile.NotMyLock as e:
@@ -150,84 +248,292 @@ def main(arguments=None):
             logger.info(
                 "PID lock acquired {0} {1}".format(lock.path, lock.pid))
 
-            # run check
-            completed_runs = []  # check results
-            for checkitem in config['checks']:
-                try:
-                    if (inputflag.key is not None and
-                            checkitem['key'] == inputflag.key):
-                        # --key defined and name matched! only run 1 check
-                        rc, checkobj = action.check(
-                            checkitem, configinstance, logger
-                        )
-                        completed_runs.append(
-                            (
-                                rc,
-                                checkitem['key'],
-                                checkobj
-                            )
-                        )
-                    elif not inputflag.key:
-                        # run all checks
-                        rc, checkobj = action.check(
-                            checkitem, configinstance, logger
-                        )
-                        completed_runs.append(
-                            (
-                                rc,
-                                checkitem['key'],
-                                checkobj
-                            )
-                        )
-                except Exception as e:
-                    logger.exception(e)
-
-            # set run status overall
-            for check in completed_runs:
-                rc, name, values = check
-                if rc == 0 and set_rc == 0:
-                    set_rc = 0
-                else:
-                    set_rc = 1
-
-            # report errors
-            badmsg = "with errors    [FAIL]"
-            if set_rc == 0:
-                badmsg = "without errors    [ OK ]"
-            logger.info("Checks have completed {0}".format(badmsg))
-
-            # Report final conditions to zabbix (so informational alerting can
-            # be built around failed script runs, exceptions, network errors,
-            # timeouts, etc)
-            logger.info(
-                "Sending execution summary to zabbix server as Metrics objects"
-            )
-
-            if not values:  # Do you see uncaught requests.exceptions?
-                values = {'EXECUTION_STATUS': 1}  # trigger an alert
-
-            metrickey = config['config'][
-                'zabbix']['checksummary_key_format']
+            # Sessions and the sender stay warm for every cycle of a daemon
+            workers = configinstance.get_concurrency(inputflag.workers)
+            engine = configinstance.get_engine(inputflag.engine)
+            # Forks its workers, so before any thread is started
+            parsers = action.parserfacade(config, logger)
+            sessions = commons.SessionRegistry(
+                logger, configinstance.get_pool_maxsize(workers))
+            telemetry = action.senderfacade(config, logger)
+            if telemetry is None:
+                logger.critical("Could not start the zabbix sender. "
+                                "EXECUTION STOP.")
+                exit(1)
+            responses = action.cachefacade(config, logger)
+            stats = None
+            if config['config']['zabbix'].get('run_metrics_key_format'):
+                stats = action.RunStats(
+                    telemetry, started,
+                    locks=(sessions.lock, commons.auth_handlers.lock))
+            if profiler is not None and profiler.checks and engine == 'async':
+                logger.warning("--profile-checks needs the thread engine, "
+                               "only the run is profiled")
 
-            check_completion_status = [Metric(
-                config['config']['zabbix']['host'], metrickey, set_rc
-            )]
+            try:
+                if inputflag.COMMAND == "daemon":
+                    checks = select_checks(inputflag.key, configinstance,
+                                           shard)
+                    skipped = select_skipped(inputflag.key, configinstance,
+                                             shard)
+                    skip_queue = configinstance.skip_conditions
 
-            logger.debug("Summary: {0}".format(check_completion_status))
-            if not action.transmitfacade(config, check_completion_status, logger=logger):
-                logger.critical(
-                    "Sending execution summary to zabbix server failed!")
-                set_rc = 1
+                    def summarize(completed_runs):
+                        rc = report_summary(
+                            completed_runs, configinstance, logger,
+                            telemetry, responses, skipped, stats, shard)
+                        if profiler is not None:
+                            profiler.dump()  # a profile per interval
+                        return rc
+                    set_rc = service.CheckService(
+                        logger,
+                        scheduler.Scheduler(
+                            checks,
+                            dict((testSet['key'],
+                                  configinstance.get_interval(testSet))
+                                 for testSet in checks),
+                            dict((testSet['key'],
+                                  configinstance.get_jitter(testSet))
+                                 for testSet in checks)
+                        ),
+                        action.CheckPool(
+                            configinstance, logger,
+                            workers=workers,
+                            engine=engine,
+                            sessions=sessions,
+                            telemetry=telemetry,
+                            responses=responses,
+                            stats=stats,
+                            profiler=profiler,
+                            parsers=parsers
+                        ),
+                        summarize,
+                        interval=configinstance.get_daemon_interval(),
+                        skip=lambda: skip_requested(skip_queue, logger,
+                                                    skip_cache)
+                    ).run()
+                else:
+                    set_rc = check_cycle(inputflag.key, configinstance,
+                                         logger, workers, engine, sessions,
+                                         telemetry, responses, stats,
+                                         profiler, shard, parsers)
+            finally:
+                sessions.close()
+                if parsers is not None:
+                    parsers.close()
+                for name in telemetry.close():
+                    logger.critical("Sending telemetry for testSet {0} to "
+                                    "zabbix failed!".format(name))
     if inputflag.COMMAND == "discover":
-        action.discover(inputflag, configinstance, logger)
+        action.discover(inputflag, configinstance, logger, shard)
         set_rc = 0
 
     # drop lockfile, then exit (if check mode is active)
-    if inputflag.COMMAND == "check":
+    if inputflag.COMMAND in ("check", "daemon"):
         print(set_rc)  # don't need print retcode in discover
         exit(set_rc)
 
 
+def skip_requested(conditional_skip_queue, logger, cache=None):
+    """
+    Evaluates the skip_run_when conditions (for standby nodes).
+
+    :param conditional_skip_queue: list from ConfigObject.skip_conditions
+    :param logger:
+    :param cache: optional commons.ConditionCache of recent results
+    :return: True if any condition says checks should be skipped
+    """
+    if len(conditional_skip_queue) > 0:
+        logger.info("Checking {0} standby conditions to see if test execution"
+                    " should skip.".format(len(conditional_skip_queue)))
+    try:
+        for test in conditional_skip_queue:
+            for condition, condition_args in test.items():
+                if commons.skip_on_external_condition(
+                        logger, condition, condition_args, cache):
+                    return True
+        return False
+    finally:
+        if cache is not None:
+            cache.save()
+
+
+def select_checks(key, configinstance, shard=None):
+    """
+    The testSets to run, only the one named key if --key is defined and
+    only those of shard if sharded.
+    """
+    if key:
+        # --key defined, only run the check whose name matched
+        testSet = configinstance.get_test_set_by_key(key)
+        checks = [testSet] if testSet is not None else []
+    else:
+        # run all checks
+        checks = configinstance.load()['checks']
+    if shard is not None:
+        checks = [testSet for testSet in checks if shard.owns(testSet['key'])]
+    return checks
+
+
+def select_skipped(key, configinstance, shard=None):
+    """
+    Keys of the testSets select_checks() left out because they failed
+    validation, only key itself if --key is defined and only those of
+    shard if sharded.
+    """
+    invalid = configinstance.get_invalid_test_sets()
+    if key:
+        invalid = [key] if key in invalid else []
+    if shard is not None:
+        invalid = [name for name in invalid if shard.owns(name)]
+    return sorted(invalid)
+
+
+def check_cycle(key, configinstance, logger, workers, engine, sessions,
+                telemetry, responses=None, stats=None, profiler=None,
+                shard=None, parsers=None):
+    """
+    Runs one round of checks and reports the execution summary to zabbix.
+    (Called by the check command)
+
+    :param key: --key, only run the testSet with this name
+    :param configinstance:
+    :param logger:
+    :param workers: number of checks to run at once
+    :param engine: `thread` or `async`
+    :param sessions: commons.SessionRegistry
+    :param telemetry: zbxsend.BackgroundSender
+    :param responses: httpcache.ResponseCache, None if disabled
+    :param stats: action.RunStats, None if run metrics are disabled
+    :param profiler: profiling.Profiler, None unless --profile
+    :param shard: sharding.Shard, None if not sharded
+    :param parsers: commons.ParsePool, None if disabled
+    :return: rc for the round
+    """
+    checks = select_checks(key, configinstance, shard)
+    fetches = action.coalescefacade(configinstance, checks, logger)
+
+    # run check
+    completed_runs = action.run_checks(
+        checks, configinstance, logger,
+        workers=workers,
+        engine=engine,
+        sessions=sessions,
+        telemetry=telemetry,
+        responses=responses,
+        stats=stats,
+        profiler=profiler,
+        parsers=parsers,
+        fetches=fetches
+    )  # check results
+
+    return report_summary(completed_runs, configinstance, logger, telemetry,
+                          responses, select_skipped(key, configinstance,
+                                                    shard),
+                          stats, shard, fetches)
+
+
+def report_summary(completed_runs, configinstance, logger, telemetry,
+                   responses=None, skipped=(), stats=None, shard=None,
+                   fetches=None):
+    """
+    Sends the execution summary for a list of completed checks to zabbix
+    and waits for their telemetry to be sent.
+    (Called after each check cycle, and every interval by the daemon)
+
+    :param completed_runs: list of (rc, key, checkobj) tuples
+    :param configinstance:
+    :param logger:
+    :param telemetry: zbxsend.BackgroundSender
+    :param responses: httpcache.ResponseCache to persist, None if disabled
+    :param skipped: keys of testSets not run for config errors, they fail
+                    the summary
+    :param stats: action.RunStats, its run metrics are sent along with the
+                  summary
+    :param shard: sharding.Shard, the summary is reported for it alone
+    :param fetches: commons.FetchGroups of the round, None if requests
+                    were not coalesced
+    :return: rc for the checks
+    """
+    config = configinstance.load()
+    set_rc = 0
+
+    # set run status overall
+    values = None
+    for check in completed_runs:
+        rc, name, values = check
+        if rc == 0 and set_rc == 0:
+            set_rc = 0
+        else:
+            set_rc = 1
+
+    if skipped:
+        logger.error("{0} checks were skipped for config errors: {1}".format(
+            len(skipped), ', '.join(skipped)))
+        set_rc = 1
+
+    # report errors
+    badmsg = "with errors    [FAIL]"
+    if set_rc == 0:
+        badmsg = "without errors    [ OK ]"
+    where = ""
+    if shard is not None:
+        where = " on shard {0}".format(shard)
+    logger.info("{0} checks{1} have completed {2}".format(
+        len(completed_runs), where, badmsg))
+    if fetches is not None:
+        logger.info("{0} fetches saved by testSets sharing a uri".format(
+            fetches.saved))
+        if stats is not None:
+            stats.add('fetches_saved', fetches.saved)
+
+    # Report final conditions to zabbix (so informational alerting can
+    # be built around failed script runs, exceptions, network errors,
+    # timeouts, etc)
+    logger.info(
+        "Sending telemetry and execution summary to zabbix server as "
+        "Metrics objects"
+    )
+
+    if not values:  # Do you see uncaught requests.exceptions?
+        values = {'EXECUTION_STATUS': 1}  # trigger an alert
+
+    metrickey = sharding.shard_key(config['config'][
+        'zabbix']['checksummary_key_format'], shard)
+
+    check_completion_status = [Metric(
+        config['config']['zabbix']['host'], metrickey, set_rc
+    )]
+
+    if responses is not None:
+        logger.debug("Cached values reused for {0} not modified "
+                     "responses".format(responses.hits))
+        responses.hits = 0
+        responses.save()  # an unwritable cache is logged, not fatal
+
+    failed_sends = []
+    if stats is not None:
+        stats.add('checks_skipped', len(skipped))
+        # Wait for the checks' telemetry, so the sender counters cover it
+        failed_sends += telemetry.flush()
+        check_completion_status += action.run_metrics(config, stats.take(),
+                                                      shard)
+
+    logger.debug("Summary: {0}".format(check_completion_status))
+    telemetry.add(None, check_completion_status)
+    failed_sends += telemetry.flush()  # sent before the final rc
+    for name in failed_sends:
+        if name is None:
+            logger.critical(
+                "Sending execution summary to zabbix server failed!")
+        else:
+            logger.critical("Sending telemetry for testSet {0} to "
+                            "zabbix failed!".format(name))
+    if failed_sends:
+        set_rc = 1
+    return set_rc
+
+
 def entry_point():
     """Zero-argument entry point for use with setuptools/distribute."""
     raise SystemExit(main(sys.argv))
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import cProfile
+import contextlib
+import datetime
+import glob
+import os
+import pstats
+import re
+import sys
+import threading
+
+__doc__ = """cProfile profiles of runs and testSets, written by --profile"""
+
+
+def _stamp():
+    return datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f')
+
+
+class Profiler(object):
+    """
+    Profiles a run into `run-<time>-<pid>.pstats` files under directory,
+    and with checks=True every testSet into `check-<key>-<time>-<pid>.pstats`.
+
+    cProfile only sees the thread that enabled it, so checks running on
+    worker threads are profiled on their own and added to the run profile.
+    Checks on the thread that started the profiler (a single worker, or
+    the async engine) are already part of the run profile. Per testSet
+    profiles of those are only taken with a single worker, greenlets
+    interleave too much to tell their checks apart.
+    """
+
+    def __init__(self, directory, checks=False, logger=None):
+        """
+        :param directory: where the pstats files are written, created if
+                          missing
+        :param checks: also write a profile per testSet
+        :param logger:
+        """
+        self.directory = directory
+        self.checks = checks
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.profile = None
+        self.check_profiles = []  # since the last dump
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.thread = threading.current_thread()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def dump(self):
+        """
+        Write the run profile so far and start a new one.
+        (Called at the end of a run, and after every daemon summary)
+
+        :return: path of the profile written
+        """
+        self.profile.disable()
+        with self.lock:
+            check_profiles, self.check_profiles = self.check_profiles, []
+        stats = pstats.Stats(self.profile)
+        for profile in check_profiles:
+            stats.add(profile)
+        path = os.path.join(self.directory, 'run-{0}-{1}.pstats'.format(
+            _stamp(), os.getpid()))
+        stats.dump_stats(path)
+        if self.logger is not None:
+            self.logger.info("Wrote profile {0}".format(path))
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return path
+
+    def stop(self):
+        """
+        Write the last run profile, nothing is profiled after.
+        """
+        path = self.dump()
+        self.profile.disable()
+        return path
+
+    @contextlib.contextmanager
+    def check(self, key):
+        """
+        Profile the testSet named key run inside the block.
+        """
+        on_run_thread = threading.current_thread() is self.thread
+        if on_run_thread and (not self.checks or self.concurrent()):
+            yield  # the run profile sees it already
+            return
+
+        profile = cProfile.Profile()
+        if on_run_thread:
+            self.profile.disable()  # one profiler per thread at a time
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if on_run_thread:
+                self.profile.enable()
+            with self.lock:
+                self.check_profiles.append(profile)
+            if self.checks:
+                path = os.path.join(
+                    self.directory, 'check-{0}-{1}-{2}.pstats'.format(
+                        re.sub(r'[^\w.-]', '_', key), _stamp(), os.getpid()))
+                pstats.Stats(profile).dump_stats(path)
+
+    def concurrent(self):
+        """
+        True when checks may be greenlets on the thread of the run.
+        """
+        try:
+            import gevent.monkey
+        except ImportError:
+            return False
+        return gevent.monkey.is_module_patched('socket')
+
+
+def report(directory, last=10, top=25, key=None, stream=None):
+    """
+    Print the functions which took the most time across the last
+    profiles written to directory.
+    (Called by the profile-report command)
+
+    :param directory: the --profile directory
+    :param last: number of the most recent profiles to add up
+    :param top: number of functions to list
+    :param key: summarize the profiles of this testSet instead of the runs
+    :param stream: where to print, default stdout
+    :return: rc, 1 if there were no profiles
+    """
+    stream = stream or sys.stdout
+    if key is None:
+        pattern = 'run-*.pstats'
+    else:
+        pattern = 'check-{0}-*.pstats'.format(re.sub(r'[^\w.-]', '_', key))
+    paths = sorted(glob.glob(os.path.join(directory, pattern)),
+                   key=os.path.getmtime)[-last:]
+    if not paths:
+        stream.write("No {0} profiles in {1}\n".format(pattern, directory))
+        return 1
+
+    stream.write("Top {0} functions by own time across {1} profiles "
+                 "({2} .. {3})\n".format(top, len(paths),
+                                         os.path.basename(paths[0]),
+                                         os.path.basename(paths[-1])))
+    stats = pstats.Stats(*paths, stream=stream)
+    stats.strip_dirs().sort_stats('tottime').print_stats(top)
+    return 0
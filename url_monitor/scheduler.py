@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import heapq
+import random
+import time
+from urlparse import urlparse
+
+__doc__ = """Priority queue scheduler for per testSet poll intervals"""
+
+
+class Scheduler(object):
+    """
+    Keeps every testSet in a heap ordered by the time it is next due, so
+    finding due checks costs O(log n) per check instead of a scan of the
+    whole config each tick.
+
+    A testSet runs every `interval` seconds, delayed by up to `jitter`
+    seconds. Checks against the same origin host are spread evenly over
+    the jitter window (each gets its own slice of it, at a random point
+    within the slice) so they don't all hit the host at once.
+    """
+
+    def __init__(self, checks, intervals, jitters, now=None):
+        """
+        :param checks: list of testSets
+        :param intervals: dict of testSet key -> interval in seconds
+        :param jitters: dict of testSet key -> jitter in seconds
+        :param now: start time, defaults to time.time()
+        """
+        if now is None:
+            now = time.time()
+
+        self.heap = []
+        self.sequence = 0  # tie breaker, keeps equal due times in order
+
+        hosts = {}
+        for testSet in checks:
+            try:
+                host = urlparse(testSet['data']['uri']).netloc
+            except (KeyError, TypeError, AttributeError):
+                host = None
+            hosts.setdefault(host, []).append(testSet)
+
+        for host_checks in hosts.values():
+            host_checks.sort(key=lambda testSet: testSet['key'])
+            for slot, testSet in enumerate(host_checks):
+                entry = {
+                    'testSet': testSet,
+                    'interval': intervals[testSet['key']],
+                    'jitter': jitters[testSet['key']],
+                    'slot': slot,
+                    'slots': len(host_checks),
+                    'nominal': now,
+                }
+                self._push(entry)
+
+    def _push(self, entry):
+        """
+        Add entry to the heap at its nominal time plus jitter.
+        """
+        offset = entry['jitter'] * (
+            entry['slot'] + random.random()) / entry['slots']
+        heapq.heappush(
+            self.heap, (entry['nominal'] + offset, self.sequence, entry))
+        self.sequence += 1
+
+    def pop_due(self, now=None):
+        """
+        Remove and return every testSet due at or before now, each one is
+        rescheduled for its next interval. Runs missed while the process
+        was busy are skipped rather than run back to back.
+
+        :param now: defaults to time.time()
+        :return list: of testSets
+        """
+        if now is None:
+            now = time.time()
+
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)[2]
+            due.append(entry['testSet'])
+            entry['nominal'] += entry['interval']
+            if entry['nominal'] <= now:
+                missed = int((now - entry['nominal']) // entry['interval']) + 1
+                entry['nominal'] += missed * entry['interval']
+            self._push(entry)
+        return due
+
+    def next_due(self):
+        """
+        :return: time the next testSet is due, None if nothing is scheduled
+        """
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def __len__(self):
+        return len(self.heap)
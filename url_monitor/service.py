@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import signal
+import threading
+import time
+
+__doc__ = """Long running daemon mode, dispatches checks on an internal scheduler"""
+
+
+class CheckService(object):
+    """
+    Dispatches testSets to a CheckPool as the scheduler says they are due,
+    and reports a summary of the checks completed every interval seconds,
+    until SIGTERM or SIGINT.
+
+    The config, HTTP sessions and zabbix sender are owned by the caller
+    and stay warm for the life of the service. On a signal no new checks
+    are dispatched, the checks in flight finish and a last summary is
+    reported before run() returns.
+    """
+    # Longest sleep between scheduler polls, bounds how long a signal
+    # can go unnoticed.
+    max_sleep = 1.0
+
+    def __init__(self, logger, scheduler, pool, summarize, interval=60,
+                 skip=None):
+        """
+        :param logger:
+        :param scheduler: scheduler.Scheduler of the testSets to run
+        :param pool: action.CheckPool the testSets are submitted to
+        :param summarize: callable taking a list of (rc, key, checkobj)
+                          tuples, reports them and returns an rc
+        :param interval: seconds between two summaries
+        :param skip: optional callable, checked before every summary
+                     interval, no checks are dispatched for the interval
+                     when it returns True (standby nodes)
+        """
+        self.logger = logger
+        self.scheduler = scheduler
+        self.pool = pool
+        self.summarize = summarize
+        self.interval = interval
+        self.skip = skip
+
+        self.stopping = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Signal handler, finish the checks in flight then return from run().
+        """
+        if not self.stopping.is_set():
+            self.logger.info("Received signal {0}, stopping after in-flight"
+                             " checks complete".format(signum))
+        self.stopping.set()
+
+    def standby(self):
+        if self.skip is not None and self.skip():
+            self.logger.info("Standby condition matched, no checks will run"
+                             " for the next {0} seconds".format(self.interval))
+            return True
+        return False
+
+    def run(self):
+        """
+        Dispatch checks until stopped.
+
+        :return: rc of the last summary
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.logger.info("Daemon started with {0} scheduled checks, summary "
+                         "every {1} seconds".format(len(self.scheduler),
+                                                    self.interval))
+
+        next_summary = time.time() + self.interval
+        standby = self.standby()
+        rc = 0
+        while not self.stopping.is_set():
+            now = time.time()
+            if now >= next_summary:
+                rc = self.summarize(self.pool.results())
+                next_summary = max(next_summary + self.interval, now)
+                standby = self.standby()
+
+            # Due checks are rescheduled even in standby, so they resume
+            # on their usual cadence.
+            for testSet in self.scheduler.pop_due(now):
+                if not standby:
+                    self.pool.submit(testSet)
+
+            wake = min(next_summary, self.scheduler.next_due() or next_summary)
+            # time.sleep, unlike Event.wait, also yields on the async engine
+            time.sleep(min(max(wake - time.time(), 0), self.max_sleep))
+
+        self.pool.join()
+        rc = self.summarize(self.pool.results())
+        self.logger.info("Daemon stopped")
+        return rc
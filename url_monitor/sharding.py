@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+
+__doc__ = """Splits testSets between monitoring nodes, see --shard"""
+
+
+def _hash(value):
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of count shards. Each shard is placed on the ring
+    replicas times, a key belongs to the shard at the first point after
+    its hash. Going from N to N+1 shards moves about 1/(N+1) of the keys,
+    all of them to the new shard.
+    """
+
+    def __init__(self, count, replicas=160):
+        """
+        :param count: number of shards, numbered 1 to count
+        :param replicas: points per shard, more spreads keys more evenly
+        """
+        points = []
+        for index in range(1, count + 1):
+            for replica in range(replicas):
+                points.append((_hash('{0}-{1}'.format(index, replica)),
+                               index))
+        points.sort()
+        self.hashes = [point for point, index in points]
+        self.shards = [index for point, index in points]
+
+    def owner(self, key):
+        """
+        :param key: testSet key
+        :return integer: index of the shard key belongs to
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        position = bisect.bisect(self.hashes, _hash(key))
+        return self.shards[position % len(self.shards)]
+
+
+class Shard(object):
+    """
+    The part of the testSets this node runs, shard index of count.
+    """
+
+    def __init__(self, index, count):
+        if not 1 <= index <= count:
+            raise ValueError("shard {0}/{1} is out of range, use 1/{1} to "
+                             "{1}/{1}".format(index, count))
+        self.index = index
+        self.count = count
+        self.ring = HashRing(count)
+
+    def __str__(self):
+        return '{0}/{1}'.format(self.index, self.count)
+
+    def owns(self, key):
+        """
+        :param key: testSet key
+        :return bool: True if this shard runs the testSet
+        """
+        return self.ring.owner(key) == self.index
+
+
+def parse_shard(text):
+    """
+    :param text: "INDEX/COUNT", e.g. "2/3" for the second of three nodes
+    :return Shard:
+    :raise ValueError: if text is not a valid shard
+    """
+    try:
+        index, count = [int(part) for part in str(text).split('/')]
+    except ValueError:
+        raise ValueError("shard `{0}` must look like INDEX/COUNT, e.g. "
+                         "1/2".format(text))
+    return Shard(index, count)
+
+
+def shard_key(key_format, shard, **fields):
+    """
+    Formats a zabbix item key with fields and {shard}. A sharded key
+    without {shard} gets the shard as its last parameter, so every shard
+    still reports an item of its own.
+
+    :param key_format: e.g. `config: zabbix: checksummary_key_format`
+    :param shard: Shard of the run, None if not sharded ({shard} is `all`)
+    :return str:
+    """
+    key = key_format.format(shard='all' if shard is None else shard,
+                            **fields)
+    if shard is None or '{shard}' in key_format:
+        return key
+    if key.endswith(']'):
+        return '{0},{1}]'.format(key[:-1], shard)
+    return '{0}[{1}]'.format(key, shard)
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+from StringIO import StringIO
+
+__doc__ = """Path expressions over xml documents, evaluated while parsing"""
+
+PATH_SEPARATOR = '/'
+CURRENT_NODE = '.'
+LIST_INDEX_INDICATORS = ('[', ']')
+ATTRIBUTE_INDICATOR = '@'
+TEXT_NODE = 'text()'
+
+# path string -> compiled path, filled by compiled_path()
+_compiled_paths = {}
+
+
+def xpath(xml_str, path):
+    """
+    Value at path in an xml document held in a string.
+
+    :param xml_str:
+    :param path:
+    :return:
+    """
+    return xpath_stream(StringIO(xml_str), [path])[path]
+
+
+def compile_path(path):
+    """
+    Turns an xpath like /feed/entry[2]/link/@href into a tuple of
+    (steps, attribute) which xpath_stream() matches while parsing.
+
+    This is the child axis subset of xpath: /root/child is absolute from
+    the root element, ./child is relative to the root element. A step
+    can select the nth element of that name with [n] (1-based), the
+    last step can be @attribute or text() (the default). A step written
+    in {namespace}name form must match the namespace, a plain name
+    matches elements of that name in any namespace.
+    Raises ValueError if the path can't be compiled.
+
+    :param path:
+    :return tuple: ((name, index), ...), attribute or None
+    """
+    if path.startswith(PATH_SEPARATOR):
+        path_list = _split(path[1:])
+    elif path.startswith(CURRENT_NODE + PATH_SEPARATOR):
+        path_list = ['*'] + _split(path[2:])
+    else:
+        raise ValueError("Path {0!r} must start with / or ./".format(path))
+
+    attribute = None
+    if path_list[-1].startswith(ATTRIBUTE_INDICATOR):
+        attribute = path_list.pop()[1:]
+        if not attribute:
+            raise ValueError("Empty attribute in path {0!r}".format(path))
+    elif path_list[-1] == TEXT_NODE:
+        path_list.pop()
+
+    steps = []
+    for name in path_list:
+        if not name or name in (CURRENT_NODE, '..'):
+            raise ValueError("Unsupported step {0!r} in path {1!r}, only "
+                             "child steps are supported".format(name, path))
+
+        if name[0] == '*' and name != '*':
+            raise ValueError("Unsupported step {0!r} in path {1!r}, a "
+                             "wildcard can't be indexed".format(name, path))
+
+        index = None
+        if name[-1] == LIST_INDEX_INDICATORS[1]:
+            left_indicator = name.rfind(LIST_INDEX_INDICATORS[0])
+            try:
+                index = int(name[left_indicator + 1:-1])
+            except ValueError:
+                raise ValueError("Invalid position {0!r} in path "
+                                 "{1!r}".format(name, path))
+            if left_indicator < 1 or index < 1:
+                raise ValueError("Invalid position {0!r} in path "
+                                 "{1!r}".format(name, path))
+            name = name[:left_indicator]
+        steps.append((name, index))
+
+    if not steps:
+        raise ValueError("Path {0!r} selects no element".format(path))
+    return tuple(steps), attribute
+
+
+def _split(path):
+    """
+    Split path on the separators outside of {namespace} uris.
+    """
+    steps = ['']
+    in_namespace = False
+    for char in path:
+        if char == PATH_SEPARATOR and not in_namespace:
+            steps.append('')
+            continue
+        if char == '{':
+            in_namespace = True
+        elif char == '}':
+            in_namespace = False
+        steps[-1] += char
+    return steps
+
+
+def compiled_path(path):
+    """
+    Returns the compiled path, compiling it on first use.
+
+    :param path:
+    :return tuple:
+    """
+    try:
+        return _compiled_paths[path]
+    except KeyError:
+        compiled = _compiled_paths[path] = compile_path(path)
+        return compiled
+
+
+def _local_name(tag):
+    """
+    Element name without its {namespace}.
+    """
+    if tag[:1] == '{':
+        return tag[tag.find('}') + 1:]
+    return tag
+
+
+def _step_matches(step, tag, local, position):
+    """
+    :param step: (name, index) from compile_path()
+    :param tag: element tag, with its {namespace}
+    :param local: tag without its namespace
+    :param position: counts of the element and its preceding siblings,
+                     by tag
+    """
+    name, index = step
+    if name == '*':
+        return index is None
+    if name[:1] == '{':
+        if name != tag:
+            return False
+        count = position[tag]
+    else:
+        if name != local:
+            return False
+        count = position[local]
+    return index is None or index == count
+
+
+def xpath_stream(stream, paths):
+    """
+    Resolves paths from an xml document read incrementally from stream, a
+    file like object, in a single pass. Every element is cleared as soon
+    as it has been passed, and reading stops once every path has been
+    resolved, so a large document is never held in memory.
+    Raises ValueError if the document is malformed before that point.
+
+    :param stream:
+    :param paths: list of path strings
+    :return dict: path -> value (stripped text or attribute), None for
+                  paths not in the document
+    """
+    values = dict.fromkeys(paths)
+    pending = {}  # path -> (steps, attribute), until resolved
+    for path in paths:
+        pending[path] = compiled_path(path)
+    if not pending:
+        return values
+
+    # One frame per open element: the paths still matching at that depth,
+    # the number of children seen so far by name and the element itself.
+    stack = [(list(pending), {}, None)]
+    try:
+        for event, element in ElementTree.iterparse(
+                stream, events=('start', 'end')):
+            if event == 'start':
+                candidates, siblings, _ = stack[-1]
+                tag = element.tag
+                local = _local_name(tag)
+                siblings[tag] = siblings.get(tag, 0) + 1
+                if local != tag:
+                    siblings[local] = siblings.get(local, 0) + 1
+
+                depth = len(stack) - 1
+                matching = []
+                for path in candidates:
+                    if path not in pending:
+                        continue
+                    steps, attribute = pending[path]
+                    if depth >= len(steps):
+                        continue  # inside the element, text is read at its end
+                    if not _step_matches(steps[depth], tag, local, siblings):
+                        continue
+                    if depth + 1 < len(steps):
+                        matching.append(path)
+                    elif attribute is not None:
+                        values[path] = element.get(attribute)
+                        del pending[path]
+                    else:
+                        matching.append(path)  # text is read at its end
+                stack.append((matching, {}, element))
+                if not pending:
+                    break
+                continue
+
+            # end event
+            matching, _, _ = stack.pop()
+            depth = len(stack) - 1
+            for path in matching:
+                steps, attribute = pending.get(path, ((), None))
+                if len(steps) == depth + 1 and attribute is None:
+                    values[path] = (element.text or '').strip()
+                    del pending[path]
+            element.clear()
+            parent = stack[-1][2]
+            if parent is not None:
+                parent.remove(element)  # its earlier siblings are gone too
+            if not pending:
+                break
+    except SyntaxError as err:  # ElementTree.ParseError
+        raise ValueError(str(err))
+    return values
@@ -1,8 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import logging
+import os
+import Queue
 import socket
 import struct
+import threading
 import time
 
 try:
@@ -25,6 +28,56 @@ class Metric(object):
         return 'Metric(%r, %r, %r, %r)' % (self.host, self.key, self.value, self.clock)
 
 
+PACKET_FORMAT = ('{\n'
+                 '\t"request":"sender data",\n'
+                 '\t"data":[\n%s]\n'
+                 '}')
+# ZBXD\1 plus the 8 byte data length
+HEADER_LENGTH = 13
+
+
+def _metric_data(m):
+    """
+    Formats one metric for the sender data packet.
+    :param m:
+    :return:
+    """
+    j = json.dumps
+    clock = m.clock or time.time()
+    return ('\t\t{\n'
+            '\t\t\t"host":%s,\n'
+            '\t\t\t"key":%s,\n'
+            '\t\t\t"value":%s,\n'
+            '\t\t\t"clock":%s}') % (j(m.host), j(m.key), j(m.value), clock)
+
+
+def chunk_metrics(metrics, max_values=250, max_bytes=1048576):
+    """
+    Splits metrics into lists that each fit in one sender packet of at
+    most max_values metrics and max_bytes bytes. A single metric bigger
+    than max_bytes still gets a packet of its own.
+    :param metrics:
+    :param max_values:
+    :param max_bytes:
+    :return: generator of metric lists
+    """
+    empty_packet = HEADER_LENGTH + len(PACKET_FORMAT % '')
+    chunk = []
+    chunk_bytes = empty_packet
+    for m in metrics:
+        # +2 for the ',\n' separator, less one on the first metric
+        metric_bytes = len(_metric_data(m)) + 2
+        if chunk and (len(chunk) >= max_values or
+                      chunk_bytes + metric_bytes > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = empty_packet
+        chunk.append(m)
+        chunk_bytes += metric_bytes
+    if chunk:
+        yield chunk
+
+
 def send_to_zabbix(logger, metrics, zabbix_host='127.0.0.1', zabbix_port=10051, timeout=15):
     """
     Send set of metrics to Zabbix server.
@@ -36,28 +89,17 @@ def send_to_zabbix(logger, metrics, zabbix_host='127.0.0.1', zabbix_port=10051,
     :return:
     """
 
-    j = json.dumps
     # Zabbix has very fragile JSON parser, and we cannot use json to dump
     # whole packet
-    metrics_data = []
-    for m in metrics:
-        clock = m.clock or time.time()
-        metrics_data.append(('\t\t{\n'
-                             '\t\t\t"host":%s,\n'
-                             '\t\t\t"key":%s,\n'
-                             '\t\t\t"value":%s,\n'
-                             '\t\t\t"clock":%s}') % (j(m.host), j(m.key), j(m.value), clock))
-    json_data = ('{\n'
-                 '\t"request":"sender data",\n'
-                 '\t"data":[\n%s]\n'
-                 '}') % (',\n'.join(metrics_data))
+    metrics_data = [_metric_data(m) for m in metrics]
+    json_data = PACKET_FORMAT % (',\n'.join(metrics_data))
 
     data_len = struct.pack('<Q', len(json_data))
     packet = 'ZBXD\1' + data_len + json_data
     try:
         zabbix = socket.socket()
-        zabbix.connect((zabbix_host, zabbix_port))
         zabbix.settimeout(timeout)
+        zabbix.connect((zabbix_host, zabbix_port))
         # send metrics to zabbix
         logger.debug('Sent payload: %s' % str(packet))
         zabbix.sendall(packet)
@@ -104,6 +146,244 @@ def _recv_all(sock, count):
     return buf
 
 
+class BackgroundSender(object):
+    """
+    Sends Metrics to zabbix from a background thread so a slow trapper
+    doesn't hold up the checks producing them.
+
+    Metrics are queued with put() and sent in batches once max_values are
+    waiting or flush_interval seconds have passed since the first of them
+    was queued. When the queue is full the overflow policy applies:
+      block        wait for the sender to make room (default)
+      drop-oldest  discard the oldest queued Metric
+      spill        append the Metric to spill_path, it is sent once the
+                   queue drains or by the next sender using the same file.
+                   Packets zabbix doesn't accept are spilled as well, and
+                   the spill file is only read back once a send succeeds
+                   or the retry delay has passed. The delay starts at
+                   flush_interval and doubles with every failed send, up
+                   to max_retry_delay seconds.
+    flush() waits until everything queued so far is sent, close() also
+    stops the thread.
+    """
+    OVERFLOW_POLICIES = ('block', 'drop-oldest', 'spill')
+
+    def __init__(self, logger, zabbix_host='127.0.0.1', zabbix_port=10051,
+                 timeout=15, queue_size=10000, max_values=250,
+                 max_bytes=1048576, flush_interval=1.0, overflow='block',
+                 spill_path=None, max_retry_delay=60.0):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        if overflow == 'spill' and not spill_path:
+            raise ValueError('The spill overflow policy needs a spill_path')
+
+        self.logger = logger
+        self.zabbix_host = zabbix_host
+        self.zabbix_port = zabbix_port
+        self.timeout = timeout
+        self.max_values = max_values
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = flush_interval
+        self.retry_at = 0  # spill is read back from then on
+
+        self.queue = Queue.Queue(queue_size)  # (tag, Metric) tuples
+        self.spill_lock = threading.Lock()
+        self.failed = set()  # tags of Metrics that never made it to zabbix
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0  # packets not accepted
+        self.send_seconds = 0.0  # spent in send_to_zabbix
+
+        self.thread = threading.Thread(target=self._run, name='zbxsender')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, metrics, tag=None):
+        """
+        Queue metrics for sending, tag is reported back by close() if any
+        of them fail to send.
+        :param metrics:
+        :param tag:
+        :return:
+        """
+        for m in metrics:
+            if m.clock is None:
+                m.clock = time.time()  # collected now, whenever it's sent
+            if self.overflow == 'block':
+                self.queue.put((tag, m))
+                continue
+            try:
+                self.queue.put_nowait((tag, m))
+            except Queue.Full:
+                if self.overflow == 'spill':
+                    self._spill([(tag, m)])
+                    continue
+                dropped = self._drop_oldest()
+                if dropped is not None:
+                    self.failed.add(dropped[0])
+                    self.dropped += 1
+                    self.logger.warning('Sender queue full, dropped %r' %
+                                        dropped[1])
+                self.queue.put((tag, m))
+
+    def _drop_oldest(self):
+        """
+        Remove the oldest queued Metric, queued flush() and close()
+        requests stay where they are.
+        :return: the (tag, Metric) removed, None if there is none
+        """
+        with self.queue.mutex:
+            for index, (tag, m) in enumerate(self.queue.queue):
+                if tag is not _FLUSH and tag is not _STOP:
+                    del self.queue.queue[index]
+                    self.queue.not_full.notify()
+                    return tag, m
+        return None
+
+    def add(self, tag, metrics):
+        """
+        Same as put(), argument order of action.check() telemetry sinks.
+        """
+        self.put(metrics, tag=tag)
+
+    def flush(self):
+        """
+        Wait until every Metric queued so far has been sent.
+        :return: sorted list of tags with Metrics that were not accepted
+                 since the last flush
+        """
+        done = threading.Event()
+        self.queue.put((_FLUSH, done))
+        done.wait()
+        failed, self.failed = self.failed, set()
+        return sorted(failed)
+
+    def close(self):
+        """
+        Flush every queued Metric and stop the sender thread.
+        :return: sorted list of tags with Metrics that were not accepted
+                 since the last flush
+        """
+        self.queue.put((_STOP, None))
+        self.thread.join()
+        return sorted(self.failed)
+
+    def _run(self):
+        """
+        Sender thread, drains the queue and the spill file in batches.
+        """
+        self._send(self._unspill())
+        pending = []
+        deadline = None
+        while True:
+            if pending:
+                wait = max(deadline - time.time(), 0)
+            else:
+                wait = self.flush_interval
+            try:
+                tag, m = self.queue.get(timeout=wait)
+            except Queue.Empty:
+                tag = None
+            else:
+                if tag is _STOP:
+                    self._send(pending + self._unspill())
+                    return
+                if tag is _FLUSH:
+                    self._send(pending)
+                    pending = []
+                    m.set()
+                    continue
+                if not pending:
+                    deadline = time.time() + self.flush_interval
+                pending.append((tag, m))
+
+            if pending and (len(pending) >= self.max_values or
+                            time.time() >= deadline):
+                self._send(pending)
+                pending = []
+            if not pending and self.queue.empty() and \
+                    time.time() >= self.retry_at:
+                pending = self._unspill()
+                deadline = time.time()
+
+    def _send(self, items):
+        """
+        Send (tag, Metric) items in as few packets as the limits allow.
+        """
+        metrics = [m for tag, m in items]
+        tags = dict((id(m), tag) for tag, m in items)
+        for packet in chunk_metrics(metrics, self.max_values, self.max_bytes):
+            started = time.time()
+            accepted = send_to_zabbix(self.logger, packet, self.zabbix_host,
+                                      self.zabbix_port, self.timeout)
+            self.send_seconds += time.time() - started
+            if accepted:
+                self.sent += len(packet)
+                self.retry_delay = self.flush_interval
+                self.retry_at = 0
+            else:
+                self.failures += 1
+                # Back off, or spilled packets are retried in a tight loop
+                # while zabbix is down
+                self.retry_at = time.time() + self.retry_delay
+                self.retry_delay = min(self.retry_delay * 2,
+                                       self.max_retry_delay)
+                self.failed.update(tags[id(m)] for m in packet)
+                if self.overflow == 'spill':  # retried later, maybe next run
+                    self._spill([(tags[id(m)], m) for m in packet])
+
+    def _spill(self, items):
+        """
+        Append (tag, Metric) items to the spill file.
+        """
+        with self.spill_lock:
+            try:
+                with open(self.spill_path, 'a') as spill:
+                    for tag, m in items:
+                        spill.write(json.dumps([tag, m.host, m.key, m.value,
+                                                m.clock]) + '\n')
+            except (IOError, OSError, TypeError, ValueError) as e:
+                self.logger.error('Could not spill metrics to %s: %s' % (
+                    self.spill_path, e))
+                self.failed.update(tag for tag, m in items)
+
+    def _unspill(self):
+        """
+        Read back and remove the spill file.
+        :return: list of (tag, Metric) items
+        """
+        if not self.spill_path:
+            return []
+        with self.spill_lock:
+            try:
+                with open(self.spill_path) as spill:
+                    lines = spill.readlines()
+                os.remove(self.spill_path)
+            except (IOError, OSError):
+                return []
+        items = []
+        for line in lines:
+            try:
+                tag, host, key, value, clock = json.loads(line)
+            except ValueError:
+                continue  # truncated by a crash mid write
+            items.append((tag, Metric(host, key, value, clock)))
+        if items:
+            self.logger.info('Sending %d spilled metrics from %s' % (
+                len(items), self.spill_path))
+        return items
+
+
+# queued by BackgroundSender.close() to stop the sender thread
+_STOP = object()
+# queued by BackgroundSender.flush() with an Event set once sent
+_FLUSH = object()
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     send_to_zabbix([Metric('localhost', 'bucks_earned', 99999)],